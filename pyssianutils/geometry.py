@@ -0,0 +1,321 @@
+"""
+Vectorized measurement of internal coordinates (distances, angles and
+dihedrals) over whole geometry histories. Geometries are stacked as a
+(frames, atoms, 3) array and each kind of coordinate is computed for all the
+frames and all the requested definitions at once. Bonds are perceived from 
+covalent radii using a cell list, so that the cost grows linearly with the
+number of atoms.
+"""
+import re
+import itertools
+
+import numpy as np
+
+from .initialize import load_app_defaults
+
+DEFAULTS = load_app_defaults()
+DEFAULT_BOND_FACTOR = DEFAULTS['geometry'].getfloat('bond_factor')
+DEFAULT_SUGGESTIONS = DEFAULTS['geometry'].getint('suggestions')
+
+DEFINITION_PATTERN = re.compile(r'^\s*([RAD])\(([0-9,\s]+)\)\s*$')
+KINDS = {2:'R',3:'A',4:'D'}
+UNITS = {'R':'Angstrom','A':'Degrees','D':'Degrees'}
+# Source: B. Cordero et al., Dalton Trans., 2008, 2832-2838. Index = atomic number
+COVALENT_RADII = np.array([
+    0.50,                                                           # X
+    0.31, 0.28,                                                     # H-He
+    1.28, 0.96, 0.84, 0.76, 0.71, 0.66, 0.57, 0.58,                 # Li-Ne
+    1.66, 1.41, 1.21, 1.11, 1.07, 1.05, 1.02, 1.06,                 # Na-Ar
+    2.03, 1.76, 1.70, 1.60, 1.53, 1.39, 1.39, 1.32, 1.26, 1.24,     # K-Ni
+    1.32, 1.22, 1.22, 1.20, 1.19, 1.20, 1.20, 1.16,                 # Cu-Kr
+    2.20, 1.95, 1.90, 1.75, 1.64, 1.54, 1.47, 1.46, 1.42, 1.39,     # Rb-Pd
+    1.45, 1.44, 1.42, 1.39, 1.39, 1.38, 1.39, 1.40,                 # Ag-Xe
+    2.44, 2.15, 2.07, 2.04, 2.03, 2.01, 1.99, 1.98, 1.98, 1.96,     # Cs-Gd
+    1.94, 1.92, 1.92, 1.89, 1.90, 1.87, 1.87, 1.75, 1.70, 1.62,     # Tb-W
+    1.51, 1.44, 1.41, 1.36, 1.36, 1.32, 1.45, 1.46, 1.48, 1.40,     # Re-Po
+    1.50, 1.50,                                                     # At-Rn
+    ])
+DEFAULT_RADIUS = 1.50
+
+# Utility Functions
+def stack_coordinates(links202:list) -> np.ndarray:
+    """
+    (frames, atoms, 3) array with the coordinates of the standard orientation
+    of each Link 202.
+    """
+    return np.array([[atom[3:] for atom in link.orientation] for link in links202],
+                    dtype=np.float64)
+def atomic_numbers_from_L202(link202) -> np.ndarray:
+    return np.array([int(atom[1]) for atom in link202.orientation],dtype=np.intp)
+def parse_definition(text:str) -> tuple[int,...]|None:
+    """
+    Atoms (first atom = 1) of a gaussian coordinate definition such as
+    'R(1,2)', 'A(2,1,3)' or 'D(4,1,2,3)'. Returns None for other definitions
+    (e.g. linear bends 'L(...)').
+    """
+    match = DEFINITION_PATTERN.match(text)
+    if match is None:
+        return None
+    atoms = tuple(int(i) for i in match.group(2).split(','))
+    if KINDS.get(len(atoms),None) != match.group(1):
+        return None
+    return atoms
+def label(atoms:tuple[int,...]) -> str:
+    """
+    Gaussian-like label of a coordinate, 'R(1,2)', 'A(2,1,3)' or 'D(4,1,2,3)'.
+    """
+    return f"{KINDS[len(atoms)]}({','.join(map(str,atoms))})"
+
+def _dot(a:np.ndarray,b:np.ndarray) -> np.ndarray:
+    return np.einsum('...i,...i->...',a,b)
+def _angle(v1:np.ndarray,v2:np.ndarray) -> np.ndarray:
+    # Angle in radians between the vectors of the last axis, 0 if any of
+    # them is null
+    n1 = np.linalg.norm(v1,axis=-1)
+    n2 = np.linalg.norm(v2,axis=-1)
+    valid = (n1 != 0) & (n2 != 0)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        cosine = _dot(v1,v2)/(n1*n2)
+    return np.where(valid,np.arccos(np.clip(cosine,-1.0,1.0)),0.0)
+
+def distances(xyz:np.ndarray,pairs:np.ndarray) -> np.ndarray:
+    """
+    Distances of the pairs of atoms (0-based indices, shape (M,2)) in all the
+    frames of xyz (F,N,3). Returns an (F,M) array.
+    """
+    pairs = np.asarray(pairs,dtype=np.intp).reshape(-1,2)
+    return np.linalg.norm(xyz[:,pairs[:,0]] - xyz[:,pairs[:,1]],axis=-1)
+def angles(xyz:np.ndarray,triples:np.ndarray) -> np.ndarray:
+    """
+    Angles i-j-k in radians of the triples of atoms (0-based indices, shape
+    (M,3)) in all the frames of xyz (F,N,3). Returns an (F,M) array.
+    """
+    triples = np.asarray(triples,dtype=np.intp).reshape(-1,3)
+    i,j,k = (xyz[:,triples[:,n]] for n in range(3))
+    return _angle(i-j,k-j)
+def dihedrals(xyz:np.ndarray,quads:np.ndarray) -> np.ndarray:
+    """
+    Dihedrals i-j-k-l in radians between the planes ijk and jkl of the
+    quadruples of atoms (0-based indices, shape (M,4)) in all the frames of
+    xyz (F,N,3). Returns an (F,M) array.
+    """
+    quads = np.asarray(quads,dtype=np.intp).reshape(-1,4)
+    i,j,k,l = (xyz[:,quads[:,n]] for n in range(4))
+    nijk = np.cross(i-j,k-j)
+    njkl = np.cross(j-k,l-k)
+    dihedral = _angle(nijk,njkl)
+    sign = _dot(np.cross(nijk,njkl),j-k)
+    return np.where(sign < 0.0,-dihedral,dihedral)
+
+def measure(xyz:np.ndarray,definitions:list[tuple[int,...]]) -> np.ndarray:
+    """
+    Values of the internal coordinates in all the frames. Distances are
+    returned in the units of xyz and angles and dihedrals in degrees.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        (frames, atoms, 3) or (atoms, 3) coordinates
+    definitions : list[tuple[int,...]]
+        atoms of each coordinate (first atom = 1). 2 atoms define a distance,
+        3 an angle and 4 a dihedral.
+
+    Returns
+    -------
+    np.ndarray
+        (frames, len(definitions)) values, or (len(definitions),) if xyz is
+        a single geometry
+    """
+    xyz = np.asarray(xyz,dtype=np.float64)
+    single = xyz.ndim == 2
+    if single:
+        xyz = xyz[np.newaxis]
+    values = np.empty((xyz.shape[0],len(definitions)),dtype=np.float64)
+    functions = {2:distances,3:angles,4:dihedrals}
+    unknown = [atoms for atoms in definitions if len(atoms) not in functions]
+    if unknown:
+        raise ValueError("the number of atom ids of each coordinate should be "
+                         f"2, 3 or 4. The input was: {unknown}")
+    for n,function in functions.items():
+        columns = [c for c,atoms in enumerate(definitions) if len(atoms) == n]
+        if not columns:
+            continue
+        indices = np.array([definitions[c] for c in columns],dtype=np.intp) - 1
+        if indices.min() < 0 or indices.max() >= xyz.shape[1]:
+            raise ValueError(f'Atom ids must be between 1 and {xyz.shape[1]}')
+        result = function(xyz,indices)
+        if n > 2:
+            result = np.rad2deg(result)
+        values[:,columns] = result
+    if single:
+        return values[0]
+    return values
+
+# Bond perception
+def covalent_radii(atomic_numbers:np.ndarray) -> np.ndarray:
+    atomic_numbers = np.asarray(atomic_numbers,dtype=np.intp)
+    radii = np.full(atomic_numbers.shape,DEFAULT_RADIUS)
+    known = (atomic_numbers >= 0) & (atomic_numbers < COVALENT_RADII.shape[0])
+    radii[known] = COVALENT_RADII[atomic_numbers[known]]
+    return radii
+def perceive_bonds(xyz:np.ndarray,
+                   atomic_numbers:np.ndarray,
+                   factor:float=DEFAULT_BOND_FACTOR) -> np.ndarray:
+    """
+    Finds the pairs of atoms closer than the sum of their covalent radii times
+    a factor. The space is divided in cubic cells as large as the longest
+    possible bond, so only atoms in the same or adjacent cells are compared.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        (atoms, 3) coordinates in Angstrom
+    atomic_numbers : np.ndarray
+        (atoms,) atomic numbers
+    factor : float, optional
+        tolerance factor applied to the sum of the radii, by default 
+        DEFAULT_BOND_FACTOR
+
+    Returns
+    -------
+    np.ndarray
+        (bonds, 2) 0-based indices of the bonded atoms with i < j
+    """
+    xyz = np.asarray(xyz,dtype=np.float64)
+    radii = covalent_radii(atomic_numbers)*factor
+    if xyz.shape[0] < 2:
+        return np.zeros((0,2),dtype=np.intp)
+    size = 2*radii.max()
+    cells = np.floor((xyz - xyz.min(axis=0))/size).astype(np.intp)
+    members = dict()
+    for atom,cell in enumerate(map(tuple,cells)):
+        members.setdefault(cell,[]).append(atom)
+    members = {cell:np.array(atoms,dtype=np.intp) for cell,atoms in members.items()}
+    # Each pair of adjacent cells is visited once
+    offsets = [o for o in itertools.product((-1,0,1),repeat=3) if o > (0,0,0)]
+    bonds = []
+    for cell,group in members.items():
+        for offset in [(0,0,0),]+offsets:
+            other = members.get(tuple(c+o for c,o in zip(cell,offset)),None)
+            if other is None:
+                continue
+            d = np.linalg.norm(xyz[group,np.newaxis] - xyz[np.newaxis,other],axis=-1)
+            cutoff = radii[group,np.newaxis] + radii[np.newaxis,other]
+            i,j = np.nonzero((d < cutoff) & (d > 0))
+            pairs = np.stack([group[i],other[j]],axis=1)
+            if offset == (0,0,0):
+                pairs = pairs[pairs[:,0] < pairs[:,1]]
+            bonds.append(np.sort(pairs,axis=1))
+    bonds = np.concatenate(bonds) if bonds else np.zeros((0,2),dtype=np.intp)
+    return bonds[np.lexsort((bonds[:,1],bonds[:,0]))]
+def bonded_coordinates(bonds:np.ndarray,n_atoms:int) -> tuple[np.ndarray,np.ndarray,np.ndarray]:
+    """
+    Distances, angles and dihedrals (0-based indices) defined by the bonds.
+    """
+    neighbors = [[] for _ in range(n_atoms)]
+    for i,j in bonds:
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+    angles = [(i,j,k) for j in range(n_atoms)
+              for i,k in itertools.combinations(sorted(neighbors[j]),2)]
+    dihedrals = [(i,j,k,l) for j,k in bonds
+                 for i in neighbors[j] if i != k
+                 for l in neighbors[k] if l != j and l != i]
+    return (np.asarray(bonds,dtype=np.intp).reshape(-1,2),
+            np.array(angles,dtype=np.intp).reshape(-1,3),
+            np.array(dihedrals,dtype=np.intp).reshape(-1,4))
+def _variation(xyz:np.ndarray,indices:np.ndarray,kind:str,chunk:int) -> np.ndarray:
+    # Largest change of each coordinate along the frames, computed by blocks of 
+    # coordinates to bound the memory used with many frames
+    function = {'R':distances,'A':angles,'D':dihedrals}[kind]
+    variation = np.zeros(indices.shape[0])
+    for start in range(0,indices.shape[0],chunk):
+        values = function(xyz,indices[start:start+chunk])
+        if kind == 'D':
+            values = np.unwrap(values,axis=0)
+        if kind != 'R':
+            values = np.rad2deg(values)
+        variation[start:start+chunk] = values.max(axis=0) - values.min(axis=0)
+    return variation
+def suggest_coordinates(xyz:np.ndarray,
+                        atomic_numbers:np.ndarray,
+                        n:int=DEFAULT_SUGGESTIONS,
+                        factor:float=DEFAULT_BOND_FACTOR,
+                        chunk:int=4096) -> list[tuple[tuple[int,...],float]]:
+    """
+    Proposes the bonds, angles and dihedrals that changed the most along the
+    frames. The bonds are perceived on the last frame.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        (frames, atoms, 3) coordinates in Angstrom
+    atomic_numbers : np.ndarray
+        (atoms,) atomic numbers
+    n : int, optional
+        number of coordinates of each kind, by default DEFAULT_SUGGESTIONS
+    factor : float, optional
+        tolerance factor of the bond perception, by default DEFAULT_BOND_FACTOR
+    chunk : int, optional
+        number of coordinates computed simultaneously, by default 4096
+
+    Returns
+    -------
+    list[tuple[tuple[int,...],float]]
+        atoms (first atom = 1) of each coordinate and its change along the 
+        frames (Angstrom or degrees), sorted by kind and decreasing change
+    """
+    xyz = np.asarray(xyz,dtype=np.float64)
+    bonds = perceive_bonds(xyz[-1],atomic_numbers,factor)
+    suggestions = []
+    for kind,indices in zip('RAD',bonded_coordinates(bonds,xyz.shape[1])):
+        if indices.shape[0] == 0:
+            continue
+        variation = _variation(xyz,indices,kind,chunk)
+        for c in np.argsort(-variation,kind='stable')[:n]:
+            suggestions.append((tuple(int(i)+1 for i in indices[c]),float(variation[c])))
+    return suggestions
+def all_bonded_definitions(xyz:np.ndarray,
+                           atomic_numbers:np.ndarray,
+                           factor:float=DEFAULT_BOND_FACTOR) -> list[tuple[int,...]]:
+    """
+    Atoms (first atom = 1) of all the distances, angles and dihedrals defined
+    by the bonds perceived in the geometry (atoms, 3).
+    """
+    bonds = perceive_bonds(xyz,atomic_numbers,factor)
+    definitions = []
+    for indices in bonded_coordinates(bonds,np.asarray(xyz).shape[0]):
+        definitions.extend(tuple(int(i)+1 for i in row) for row in indices)
+    return definitions
+
+# Structural comparison
+def kabsch_rmsd(references:np.ndarray,xyz:np.ndarray) -> np.ndarray:
+    """
+    RMSD of a geometry to each of the references after the optimal 
+    superposition (Kabsch algorithm), computed for all the references at once.
+    The atoms are compared in the order they are given.
+
+    Parameters
+    ----------
+    references : np.ndarray
+        (M, atoms, 3) coordinates
+    xyz : np.ndarray
+        (atoms, 3) coordinates
+
+    Returns
+    -------
+    np.ndarray
+        (M,) RMSD values
+    """
+    references = np.asarray(references,dtype=np.float64)
+    references = references - references.mean(axis=1,keepdims=True)
+    xyz = np.asarray(xyz,dtype=np.float64)
+    xyz = xyz - xyz.mean(axis=0)
+    covariance = np.einsum('mni,nj->mij',references,xyz)
+    u,s,vt = np.linalg.svd(covariance)
+    # Avoid improper rotations (reflections)
+    d = np.sign(np.linalg.det(u)*np.linalg.det(vt))
+    s[:,-1] *= np.where(d == 0,1.0,d)
+    e0 = np.einsum('mni,mni->m',references,references) + np.einsum('ni,ni->',xyz,xyz)
+    msd = np.maximum(e0 - 2*s.sum(axis=1),0.0)/xyz.shape[0]
+    return np.sqrt(msd)
@@ -2,4 +2,5 @@ from pathlib import Path
 
 from . import inputht
 from . import asinput
-from . import distortts
\ No newline at end of file
+from . import distortts
+from . import restart
@@ -3,14 +3,26 @@ Takes a gaussian output file and constructs a gaussian input file with its last
 geometry using its input file as template which is guessed as the {in_suffix} 
 file with the same name as the provided output file.
 """
+import re
+import csv
 import argparse
+import itertools
 from pathlib import Path
 
 from pyssian import GaussianOutFile, GaussianInFile
 from pyssian.classutils import Geometry
 
 from ..initialize import load_app_defaults
-from ..utils import DirectoryTree
+from ..utils import DirectoryTree, clone_gaussian_input, read_gaussian_input
+from ..utils import atomic_write, run_in_pool
+
+try:
+    import yaml
+except ImportError as e:
+    YAML_LOADED = False
+    YAML_ERROR = e
+else:
+    YAML_LOADED = True
 
 # Load app defaults
 DEFAULTS = load_app_defaults()
@@ -21,6 +33,10 @@ DEFAULT_MARKER = DEFAULTS['common']['default_marker']
 DEFAULT_SP_MARKER = DEFAULTS['input.asinput']['sp_marker']
 DEFAULT_SOFTWARE = DEFAULTS['input.asinput']['software']
 DEFAULT_SCRIPTNAME = DEFAULTS['input.asinput']['script_name']
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+
+# Order in which the variant axes are combined and named
+GRID_AXES = ('method','basis','solvent','smodel')
 
 class NotFoundError(RuntimeError):
     pass
@@ -182,8 +198,178 @@ def prepare_tail(filepath:Path|None) -> list[str]|None:
     
     while len(aux)>=1 and not aux[-1]:
         _ = aux.pop(-1)
-    
+
     return aux
+def prepare_grid(filepath:Path|str|None) -> list[dict[str,str]]:
+    """
+    Reads a variant grid specification and returns all the combinations of
+    the values provided. The specification is either a .csv file whose
+    header contains the axes names and each column the values of that axis
+    (empty cells are ignored) or a .yaml/.yml file that maps each axis name
+    to a list of values. Valid axes are 'method', 'basis', 'solvent' and
+    'smodel'.
+
+    Parameters
+    ----------
+    filepath : Path | str | None
+        path to the grid specification file.
+
+    Returns
+    -------
+    list[dict[str,str]]
+        Each item maps the axes names to the value of a single variant. The
+        order of the variants is deterministic, following the order of
+        GRID_AXES and the order of the values within the file. If no filepath
+        is provided it returns a single variant without any axis.
+    """
+    if filepath is None:
+        return [dict(),]
+
+    filepath = Path(filepath)
+    if filepath.suffix in ['.yaml','.yml']:
+        if not YAML_LOADED:
+            raise YAML_ERROR
+        with open(filepath,'r') as F:
+            data = yaml.safe_load(F)
+        axes = dict()
+        for k,v in data.items():
+            if not isinstance(v,list):
+                v = [v,]
+            axes[k] = [str(i) for i in v if i is not None]
+    else:
+        with open(filepath,'r',newline='') as F:
+            rows = list(csv.reader(F))
+        header = [k.strip() for k in rows[0]]
+        axes = {k:[] for k in header}
+        for row in rows[1:]:
+            for k,v in zip(header,row):
+                if v.strip():
+                    axes[k].append(v.strip())
+
+    unknown = [k for k in axes if k not in GRID_AXES]
+    if unknown:
+        raise ValueError(f"Unknown axes {unknown} in {filepath}. The valid "
+                         f"axes are {list(GRID_AXES)}")
+
+    keys = [k for k in GRID_AXES if axes.get(k,[])]
+    values = [axes[k] for k in keys]
+    return [dict(zip(keys,combination))
+            for combination in itertools.product(*values)]
+def variant_filepath(filepath:Path,variant:dict[str,str]) -> Path:
+    """
+    Appends to the stem of the filepath the values of the variant in the
+    order of GRID_AXES removing the characters that are not safe for filenames,
+    e.g. 'myfile.com' with {'method':'b3lyp','basis':'6-31+g(d)'} becomes
+    'myfile_b3lyp_6-31+gd.com'
+    """
+    if not variant:
+        return filepath
+    labels = [re.sub(r'[^\w+\-.]','',variant[k]) for k in GRID_AXES if k in variant]
+    return filepath.with_stem('_'.join([filepath.stem,]+labels))
+def apply_modifications(gif:GaussianInFile,
+                        method:str|None=None,
+                        basis:str|None=None,
+                        solvent:str|None=None,
+                        solvation_model:str|None=None,
+                        add_text:str|None=None,
+                        tail:list[str]|None=None,
+                        as_SP:bool=False):
+    """
+    Applies in-place the user requested changes to a GaussianInFile.
+    """
+    # Handle the additions to the tail and commandline
+    if tail is not None:
+        gif.parse_tail(tail)
+
+    if add_text is not None:
+        # This is fairly dirty but good enough for now
+        gif.commandline[add_text] = []
+
+    # Overwrite the method if the user specified so
+    if method is not None:
+        gif.method = method
+
+    # Overwrite the basis if the user specified so
+    if basis is not None:
+        gif.basis = basis
+
+    # Handle solvation substitutions
+    if solvent is not None:
+        if solvent.lower() in ['vacuum','gas']:
+            gif.commandline.pop('scrf',None)
+            # With the newest pyssian it should be
+            # gif.solvent = 'gas'
+        else:
+            gif.solvent = solvent
+
+    # The solvent model is only changed in inputs with solvent
+    if solvation_model is not None and 'scrf' in gif.commandline:
+        gif.solvent_model = solvation_model
+        if gif.solvent_model != solvation_model:
+            raise ValueError(f"The solvent model '{solvation_model}' could not "
+                             f"be set in '{gif.commandline_as_str()}'")
+
+    # Handle removal of opt, freq and scan keywords
+    if as_SP:
+        keys = ['opt','freq','scan']
+        for key in keys:
+            _ = gif.pop_kwd(key)
+
+def generate_variants(tfile:Path,
+                      ifile:Path,
+                      ofiles:list[Path],
+                      variants:list[dict[str,str]],
+                      method:str|None=None,
+                      basis:str|None=None,
+                      solvent:str|None=None,
+                      solvation_model:str|None=None,
+                      add_text:str|None=None,
+                      tail:list[str]|None=None,
+                      as_SP:bool=False) -> tuple[list[Path],list[tuple[Path,Path]]]:
+    """
+    Reads the template and the output file once and writes one new input per
+    variant. Each of the new inputs is written atomically. Variants identical
+    to a previous one but for the title (e.g. a solvent model in an input 
+    without solvent) are not written and are returned together with the 
+    input they are identical to.
+    """
+    template = read_gaussian_input(tfile)
+
+    with GaussianOutFile(ifile,[101,202]) as gof:
+        gof.read()
+        l101 = gof.get_links(101)[0]
+        l202 = gof.get_links(202)[-1]
+        geom = Geometry.from_L202(l202)
+
+    written = dict()
+    duplicates = []
+    for variant,ofile in zip(variants,ofiles):
+        gif = clone_gaussian_input(template)
+
+        # Overwrite the corresponding values of attributes of the GIF
+        gif.charge = l101.charge
+        gif.spin = l101.spin
+        gif.title = ''
+        gif.geometry = geom
+
+        apply_modifications(gif,
+                            method=variant.get('method',method),
+                            basis=variant.get('basis',basis),
+                            solvent=variant.get('solvent',solvent),
+                            solvation_model=variant.get('smodel',solvation_model),
+                            add_text=add_text,
+                            tail=tail,
+                            as_SP=as_SP)
+
+        key = str(gif)
+        if key in written:
+            duplicates.append((ofile,written[key]))
+            continue
+        written[key] = ofile
+        gif.title = ofile.stem
+        atomic_write(ofile,str(gif))
+
+    return list(written.values()), duplicates
 
 # Parser and Main Definition
 __doc__ = __doc__.format(in_suffix=GAUSSIAN_INPUT_SUFFIX)
@@ -275,6 +461,18 @@ parser.add_argument('--add-text',
                     help='Attempts to add literally the text provided to '
                     'the command line. Recommended: '
                     '"keyword=(value1,keyword2=value2)" ')
+parser.add_argument('--grid',
+                    default=None,
+                    help="csv or yaml file specifying multiple values of "
+                    "'method', 'basis', 'solvent' and/or 'smodel'. All their "
+                    "combinations are generated parsing each template and "
+                    "output file only once. The values of each variant are "
+                    "appended to the filename, e.g. "
+                    f"myfile_marker_b3lyp_6-31gd_water{GAUSSIAN_INPUT_SUFFIX}")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of parallel processes used to generate the "
+                    f"new files, by default {DEFAULT_JOBS}")
 parser.add_argument('--suffixes',
                     default=DEFAULT_SUFFIX,nargs=2,
                     help="Input and output suffix used for gaussian files")
@@ -296,10 +494,15 @@ def main(
          is_inplace:bool=False,
          do_overwrite:bool=False,
          tail:Path|str|None=None,
+         grid:Path|str|None=None,
+         jobs:int=DEFAULT_JOBS,
          ):
 
     # Prepare Tail
     tail = prepare_tail(tail)
+
+    # Prepare the variants, a single one without changes if no grid is used
+    variants = prepare_grid(grid)
     
     # Ensure proper suffixes
     in_suffix,out_suffix = map(prepare_suffix,suffixes)
@@ -316,73 +519,48 @@ def main(
                                                       is_inplace,
                                                       do_overwrite)
 
-    final_files = []
+    # Check all files before generating any, in the order provided
+    tasks = []
+    conflicts = []
     for tfile,ifile,ofile in zip(templates,geometries,newfiles):
-        print(f'Processing file {ifile}')
-
         # Check for file existence
-        
         if not tfile.exists() and ifile.exists():
             print(f"{tfile} not found for {ifile} proceeding with the next file")
             continue
-        elif tfile.exists() and ifile.exists():
-            pass
-        else:
-            print(f"{ofile} not found. Skipping to the next one")
+        elif not ifile.exists():
+            print(f"{ifile} not found. Skipping to the next one")
+            continue
 
-        if not do_overwrite and (tfile == ofile or ofile.exists()):
-            raise RuntimeError(f"""Attempted to overwrite {ofile} when '-ow' was
-                                not specified. Please check your files or file a
-                               bug issue""")
+        ofiles = [variant_filepath(ofile,variant) for variant in variants]
 
-        with GaussianInFile(tfile) as gif:
-            gif.read()
+        for o in ofiles:
+            if not do_overwrite and (tfile == o or o.exists()):
+                conflicts.append(o)
 
-        with GaussianOutFile(ifile,[101,202]) as gof:
-            gof.read()
-            l101 = gof.get_links(101)[0]
-            l202 = gof.get_links(202)[-1]
-            geom = Geometry.from_L202(l202)
+        tasks.append((tfile,ifile,ofiles,variants,
+                      method,basis,solvent,solvation_model,
+                      add_text,tail,as_SP))
 
-        # Overwrite the corresponding values of attributes of the GIF
-        gif.charge = l101.charge
-        gif.spin = l101.spin
-        gif.title = ofile.stem
-        gif.geometry = geom
+    if conflicts:
+        conflicts = '\n'.join(map(str,conflicts))
+        raise RuntimeError(f"""Attempted to overwrite the following files when
+                           '-ow' was not specified. Please check your files or
+                           file a bug issue:\n{conflicts}""")
 
-        # Handle the additions to the tail and commandlipathne
-        if tail is not None:
-            gif.parse_tail(tail)
-
-        if add_text is not None:
-            # This is fairly dirty but good enough for now
-            gif.commandline[add_text] = []
-        
-        # Overwrite the method if the user specified so
-        if method is not None:
-            gif.method = method
-        
-        # Overwrite the basis if the user specified so
-        if basis is not None:
-            gif.basis = basis
-
-        # Handle solvation substitutions
-        if solvent is not None:
-            if solvent.lower() in ['vacuum','gas']:
-                gif.commandline.pop('scrf')
-                # With the newest pyssian it should be 
-                # gif.solvent = 'gas'
-            else:
-                gif.solvent = solvent
-            
-        if solvation_model is not None:
-            gif.solvation_model = solvation_model
-        
-        # Handle removal of opt, freq and scan keywords
-        if as_SP:
-            keys = ['opt','freq','scan']
-            for key in keys:
-                _ = gif.pop_kwd(key)
+    final_files = []
+    errors = []
+    results = run_in_pool(generate_variants,tasks,jobs)
+    for task,(result,error) in zip(tasks,results):
+        ifile = task[1]
+        print(f'Processing file {ifile}')
+        if error is not None:
+            print(f'    Error: {error}')
+            errors.append(ifile)
+            continue
+        ofiles,duplicates = result
+        for duplicate,original in duplicates:
+            print(f'    {duplicate} not written, identical to {original}')
+        final_files.extend(ofiles)
 
-        gif.write(ofile)
-        final_files.append(ofile)
\ No newline at end of file
+    if errors:
+        raise RuntimeError(f'{len(errors)} files could not be processed')
@@ -5,17 +5,20 @@ frequency and using as template the {in_suffix} file with the same name as the
 provided output file. This approach is sometimes termed (unofficialy) as 
 "poorman's irc", but in no case it substitutes a proper IRC calculation.
 """
+import copy
 import argparse
+import itertools
 from pathlib import Path
 from typing import Tuple
 
-from pyssian import GaussianOutFile, GaussianInFile
+from pyssian import GaussianOutFile
 from pyssian.classutils import Geometry
 
 import numpy as np
 
 from ..initialize import load_app_defaults
-from ..utils import DirectoryTree
+from ..utils import DirectoryTree, atomic_write, run_in_pool
+from ..utils import read_gaussian_input
 
 DEFAULTS = load_app_defaults()
 GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
@@ -25,6 +28,7 @@ DEFAULT_MARKER = DEFAULTS['common']['default_marker']
 FORWARD_MARK = DEFAULTS['input.distortts']['forward_mark']
 REVERSE_MARK = DEFAULTS['input.distortts']['reverse_mark']
 DEFAULT_FACTOR = DEFAULTS['input.distortts'].getfloat('factor')
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
 
 class NotFoundError(RuntimeError):
     pass
@@ -172,21 +176,122 @@ def prepare_suffix(suffix:str) -> str:
 
     return suffix
 
-def apply_distortions(gau_log:str|Path,factor:float=DEFAULT_FACTOR) -> Tuple[Geometry,Geometry]:
+def load_normal_modes(gau_log:str|Path,
+                      modes:list[int]=[1,]) -> tuple[Geometry,np.ndarray,np.ndarray]:
+    """
+    Reads once the last geometry and the requested normal modes of a gaussian
+    output file.
+
+    Parameters
+    ----------
+    gau_log : str | Path
+        gaussian output file of a frequency calculation
+    modes : list[int], optional
+        normal modes to load, starting at 1 for the first (lowest) 
+        frequency, by default [1,]
 
-    with GaussianOutFile(gau_log) as GOF:
+    Returns
+    -------
+    tuple[Geometry,np.ndarray,np.ndarray]
+        last geometry, its coordinates as an array of shape (atoms,3) and the
+        displacements of the modes as an array of shape (modes,atoms,3)
+    """
+    with GaussianOutFile(gau_log,[202,716]) as GOF:
         GOF.read()
         l716 = GOF.get_links(716)[-1]
         l202 = GOF.get_links(202)[-1]
 
-    geom_f = Geometry.from_L202(l202)
-    geom_r = Geometry.from_L202(l202)
-    disp_matrix = np.array(l716.freq_displacements[0].xyz)
+    available = len(l716.freq_displacements)
+    for mode in modes:
+        if not (1 <= mode <= available):
+            raise ValueError(f'Mode {mode} requested but {gau_log} only has '
+                             f'{available} normal modes')
+
+    geom = Geometry.from_L202(l202)
+    coordinates = np.array(geom.coordinates,dtype=float)
+    displacements = np.array([l716.freq_displacements[mode-1].xyz 
+                              for mode in modes],dtype=float)
+    return geom, coordinates, displacements
+def distort_coordinates(coordinates:np.ndarray,
+                        displacements:np.ndarray,
+                        factors:list[float]) -> np.ndarray:
+    """
+    Displaces the coordinates along each mode, for each factor, in the forward
+    and reverse direction.
+
+    Parameters
+    ----------
+    coordinates : np.ndarray
+        array of shape (atoms,3)
+    displacements : np.ndarray
+        array of shape (modes,atoms,3)
+    factors : list[float]
+        scaling factors of the displacements
+
+    Returns
+    -------
+    np.ndarray
+        array of shape (modes,factors,2,atoms,3) where the third axis holds the
+        forward (0) and reverse (1) coordinates
+    """
+    factors = np.asarray(factors,dtype=float)
+    signs = np.array([1.0,-1.0])
+    scale = factors[None,:,None,None,None]*signs[None,None,:,None,None]
+    return coordinates + scale*displacements[:,None,None,:,:]
+def with_coordinates(geom:Geometry,coordinates:np.ndarray) -> Geometry:
+    new = copy.deepcopy(geom)
+    new.coordinates = coordinates.tolist()
+    return new
+def apply_distortions(gau_log:str|Path,factor:float=DEFAULT_FACTOR) -> Tuple[Geometry,Geometry]:
 
-    geom_f.coordinates = (np.array(geom_f.coordinates) + factor*disp_matrix).tolist()
-    geom_r.coordinates = (np.array(geom_r.coordinates) - factor*disp_matrix).tolist()
+    geom,coordinates,displacements = load_normal_modes(gau_log,[1,])
+    forward,reverse = distort_coordinates(coordinates,displacements,[factor,])[0,0]
     
-    return geom_f, geom_r
+    return with_coordinates(geom,forward), with_coordinates(geom,reverse)
+def distortion_label(mode:int,factor:float) -> str:
+    return f'm{mode}_{factor:g}'
+def labeled_filepath(filepath:Path,label:str,mark:str,marker:str) -> Path:
+    """
+    Inserts the label before the forward/reverse mark of a file generated by 
+    prepare_filepaths. i.e. 'file_f_marker' -> 'file_label_f_marker' 
+    """
+    end = f'_{mark}_{marker}' if marker else f'_{mark}'
+    base = filepath.stem[:-len(end)]
+    return filepath.with_stem(f'{base}_{label}{end}')
+def distort_file(tfile:Path,
+                 ifile:Path,
+                 ofiles:list[tuple[Path,Path]],
+                 modes:list[int]=[1,],
+                 factors:list[float]=[DEFAULT_FACTOR,]) -> list[tuple[Path,Path]]:
+    """
+    Writes the forward and reverse inputs for every combination of mode and 
+    factor. ofiles are ordered as itertools.product(modes,factors).
+    """
+    GIF = read_gaussian_input(tfile)
+
+    # Handle removal of opt, freq and scan keywords
+    _ = GIF.pop_kwd('opt')
+    _ = GIF.pop_kwd('freq')
+    _ = GIF.pop_kwd('scan')
+
+    # Ensure optimizations to minima
+    GIF.add_kwd('opt')
+    GIF.add_kwd('freq')
+
+    geom,coordinates,displacements = load_normal_modes(ifile,modes)
+    distorted = distort_coordinates(coordinates,displacements,factors)
+    distorted = distorted.reshape(-1,2,*coordinates.shape)
+
+    for (ofile_f,ofile_r),(forward,reverse) in zip(ofiles,distorted):
+        GIF.title = ofile_f.stem
+        GIF.geometry = with_coordinates(geom,forward)
+        atomic_write(ofile_f,str(GIF))
+
+        GIF.title = ofile_r.stem
+        GIF.geometry = with_coordinates(geom,reverse)
+        atomic_write(ofile_r,str(GIF))
+
+    return ofiles
 
 # Parser and Main definition
 __doc__ = __doc__.format(in_suffix=GAUSSIAN_INPUT_SUFFIX)
@@ -194,12 +299,22 @@ __doc__ = __doc__.format(in_suffix=GAUSSIAN_INPUT_SUFFIX)
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('files',help='Gaussian Output Files',nargs='+')
 parser.add_argument('--factor',
-                    type=float,default=DEFAULT_FACTOR,
+                    type=float,default=[DEFAULT_FACTOR,],nargs='+',
                     help="factor used to scale the displacement of the "
                     "imaginary frequency. In general a small distortion is "
                     "desired but at the same time, a really small distortion "
                     "risks having both (forward and reverse) geometries "
-                    "converging to the same minima")
+                    "converging to the same minima. If several are provided "
+                    "a pair of files is generated for each factor")
+parser.add_argument('--modes',
+                    type=int,default=[1,],nargs='+',
+                    help="Normal modes used to distort the geometry, starting "
+                    "at 1 for the lowest frequency. If several are provided a "
+                    "pair of files is generated for each mode. If more than "
+                    "one mode or factor is requested the mode and factor are "
+                    "included in the names of the files, i.e. "
+                    f"myfile_m1_0.13_{FORWARD_MARK}_{DEFAULT_MARKER}"
+                    f"{GAUSSIAN_INPUT_SUFFIX}")
 group_input = parser.add_mutually_exclusive_group()
 group_input.add_argument('-l','--listfile',
                          dest='is_listfile',
@@ -246,13 +361,17 @@ parser.add_argument('-ow','--overwrite',
                     "same name exists overwrites its contents. (The default "
                     "behaviour is to raise an error to notify the user before "
                     "overwriting).")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of parallel processes used to generate the "
+                    f"new files, by default {DEFAULT_JOBS}")
 parser.add_argument('--suffix',
                     default=DEFAULT_SUFFIX,nargs=2,
                     help="Input and output suffix used for gaussian files") 
 
 def main(
          files:list[str|Path],
-         factor:float=DEFAULT_FACTOR,
+         factor:float|list[float]=DEFAULT_FACTOR,
          outdir:str|Path|None=None,
          suffix:tuple[str]=DEFAULT_SUFFIX,
          is_folder:bool=False,
@@ -261,8 +380,16 @@ def main(
          no_marker:bool=False,
          is_inplace:bool=False,
          do_overwrite:bool=False,
+         jobs:int=DEFAULT_JOBS,
+         modes:list[int]=[1,],
          ):
 
+    factors = [factor,] if isinstance(factor,(int,float)) else list(factor)
+    combinations = list(itertools.product(modes,factors))
+    labels = [distortion_label(mode,f) for mode,f in combinations]
+    if no_marker:
+        marker = ''
+
     # Ensure proper suffixes
     in_suffix,out_suffix = map(prepare_suffix,suffix)
 
@@ -277,42 +404,44 @@ def main(
                                                          is_inplace,
                                                          do_overwrite)
 
+    # Check all files before generating any, in the order provided
+    tasks = []
+    conflicts = []
     for tfile,ifile,ofile_f,ofile_r in zip(templates,geometries,new_f,new_r):
-        print(f'Processing File {ifile}')
         # Check for file existence
         if not tfile.exists() and ifile.exists():
             print(f"{tfile} not found for {ifile} proceeding with the next file")
             continue
-        elif tfile.exists() and ifile.exists():
-            pass
-        else:
+        elif not ifile.exists():
             print(f"{ifile} not found. Skipping to the next one")
+            continue
 
-        output_exists = ofile_r.exists() or ofile_f.exists()
-        
-        if not do_overwrite and output_exists:
-            raise RuntimeError(f"""Attempted to overwrite {ofile_f} and {ofile_r}
-                               when '-ow' was not specified """)
-
-        with GaussianInFile(tfile) as GIF:
-            GIF.read()
-
-        # Handle removal of opt, freq and scan keywords
-        _ = GIF.pop_kwd('opt')
-        _ = GIF.pop_kwd('freq')
-        _ = GIF.pop_kwd('scan')
+        if len(combinations) == 1:
+            ofiles = [(ofile_f,ofile_r),]
+        else:
+            ofiles = [(labeled_filepath(ofile_f,label,FORWARD_MARK,marker),
+                       labeled_filepath(ofile_r,label,REVERSE_MARK,marker))
+                      for label in labels]
 
-        # Ensure optimizations to minima
-        GIF.add_kwd('opt')
-        GIF.add_kwd('freq')
+        for o_f,o_r in ofiles:
+            output_exists = o_r.exists() or o_f.exists()
+            if not do_overwrite and output_exists:
+                conflicts.append(f'{o_f} and {o_r}')
 
-        geom_f, geom_r = apply_distortions(ifile,factor)
+        tasks.append((tfile,ifile,ofiles,modes,factors))
 
-        GIF.title = ofile_f.stem
-        GIF.geometry = geom_f
-        GIF.write(ofile_f)
+    if conflicts:
+        conflicts = '\n'.join(conflicts)
+        raise RuntimeError(f"""Attempted to overwrite the following files
+                           when '-ow' was not specified:\n{conflicts}""")
 
-        GIF.title = ofile_r.stem
-        GIF.geometry = geom_r
-        GIF.write(ofile_r)
+    errors = []
+    results = run_in_pool(distort_file,tasks,jobs)
+    for (tfile,ifile,*_),(_,error) in zip(tasks,results):
+        print(f'Processing File {ifile}')
+        if error is not None:
+            print(f'    Error: {error}')
+            errors.append(ifile)
 
+    if errors:
+        raise RuntimeError(f'{len(errors)} files could not be processed')
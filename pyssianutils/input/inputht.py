@@ -10,6 +10,7 @@ import argparse
 from pyssian import GaussianOutFile, GaussianInFile
 from pyssian.classutils import Geometry
 from ..initialize import load_app_defaults
+from ..utils import atomic_write, run_in_pool
 
 # Load app defaults
 DEFAULTS = load_app_defaults()
@@ -21,6 +22,7 @@ GAUSSIAN_IN_SUFFIXES = DEFAULTS['common']['gaussian_in_suffixes'][1:-1].split(',
 GAUSSIAN_OUT_SUFFIXES = DEFAULTS['common']['gaussian_out_suffixes'][1:-1].split(',')
 DEFAULT_CHARGE = DEFAULTS['input.inputht'].getint('charge')
 DEFAULT_SPIN = DEFAULTS['input.inputht'].getint('spin')
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
 
 # Utility Functions
 def select_input_files(files:list[Path|str],is_listfile:bool=False) -> list[Path]: 
@@ -103,6 +105,22 @@ def extract_geom_spin_and_charge(filepath:str|Path,
     if suffix == '.xyz': 
         return Geometry.from_xyz(filepath), charge, spin
     raise NotImplementedError(f'files with suffix "{suffix}" cannot be interpreted')
+def write_input(infilepath:Path,
+                ofile:Path,
+                template:str,
+                charge:int|None=None,
+                spin:int|None=None,
+                step:int|None=None) -> Path:
+    geom,charge,spin = extract_geom_spin_and_charge(infilepath,
+                                                    charge=charge,
+                                                    spin=spin,
+                                                    step=step)
+    txt = template.format(title=ofile.stem,
+                          charge=charge,
+                          spin=spin,
+                          coords=str(geom))
+    atomic_write(ofile,txt)
+    return ofile
 
 # Parser and Main Definition
 parser = argparse.ArgumentParser(description=__doc__)
@@ -152,6 +170,10 @@ parser.add_argument('--spin',
                     default=DEFAULT_SPIN,
                     type=int,
                     help="""spin of the system""")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help=f"""Number of parallel processes used to generate the 
+                    new files, by default {DEFAULT_JOBS}""")
 parser.add_argument('--suffix',
                     default=DEFAULT_SUFFIX,
                     help='Input suffix used for gaussian files, e.g. ".com"')
@@ -167,6 +189,7 @@ def main(files:list[str|Path],
          spin:int=DEFAULT_SPIN,
          step:None|int=None,
          no_marker:bool=False,
+         jobs:int=DEFAULT_JOBS,
          ):
 
     inputfiles = select_input_files(files,is_listfile)
@@ -181,18 +204,20 @@ def main(files:list[str|Path],
 
     template = f'{header}\n\n{{title}}\n\n{{charge}} {{spin}}\n{{coords}}\n\n{tail}\n\n\n'
 
+    tasks = []
     for ifile in inputfiles:
-        print(ifile)
         infilepath = Path(ifile)
         stem = infilepath.stem
         ofile = outdir/f'{stem}_{marker}{suffix}'
-        geom,charge,spin = extract_geom_spin_and_charge(infilepath,
-                                                        charge=charge,
-                                                        spin=spin,
-                                                        step=step)
-        with open(ofile,'w') as F:
-            txt = template.format(title=f'{stem}_{marker}',
-                                  charge=charge,
-                                  spin=spin,
-                                  coords=str(geom))
-            F.write(txt)
+        tasks.append((infilepath,ofile,template,charge,spin,step))
+
+    errors = []
+    results = run_in_pool(write_input,tasks,jobs)
+    for (infilepath,*_),(_,error) in zip(tasks,results):
+        print(infilepath)
+        if error is not None:
+            print(f'    Error: {error}')
+            errors.append(infilepath)
+
+    if errors:
+        raise RuntimeError(f'{len(errors)} files could not be processed')
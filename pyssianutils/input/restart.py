@@ -0,0 +1,343 @@
+__doc__ = """
+Finds recursively the gaussian output files that did not finish with a 'Normal
+termination' (reading only their last lines) and creates restart inputs using
+their {in_suffix} files as templates. If the checkpoint file of a calculation
+exists the geometry is read from it ('geom=check guess=read'), otherwise the
+last geometry of the output is used. Outputs modified recently or whose jobs
+are still in the slurm queue are considered running and ignored.
+"""
+import os
+import time
+import shutil
+import getpass
+import argparse
+import subprocess
+from pathlib import Path
+from itertools import groupby
+
+from pyssian import GaussianOutFile
+from pyssian.classutils import Geometry
+
+from ..initialize import load_app_defaults
+from ..utils import (DirectoryTree, read_gaussian_input, clone_gaussian_input,
+                     atomic_write, run_in_pool, read_tail,
+                     has_normal_termination)
+from ..submit.custom import submitline
+
+# Load app defaults
+DEFAULTS = load_app_defaults()
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_SUFFIX = (GAUSSIAN_INPUT_SUFFIX,GAUSSIAN_OUTPUT_SUFFIX)
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+DEFAULT_MARKER = DEFAULTS['input.restart']['marker']
+DEFAULT_SOFTWARE = DEFAULTS['input.restart']['software']
+DEFAULT_SCRIPTNAME = DEFAULTS['input.restart']['script_name']
+DEFAULT_MIN_AGE = DEFAULTS['input.restart'].getfloat('min_age')
+# Options of geom that select where the geometry is read from
+GEOM_SOURCES = ('check','allcheck','checkpoint','step')
+
+# Utility Functions
+def failure_reason(ofile:Path) -> str:
+    """
+    Short description of why a calculation did not finish, read from the end
+    of its output file.
+    """
+    lines = [line.strip() for line in read_tail(ofile).splitlines() if line.strip()]
+    for line in reversed(lines):
+        if line.startswith('Error termination'):
+            link = line.split('/')[-1].split('.')[0] if '/' in line else ''
+            return f'error termination {link}'.strip()
+    return 'killed or running'
+def queued_jobs() -> dict[Path,set[str]]:
+    """
+    Names of the jobs of the user in the slurm queue grouped by their working
+    directory. Empty if slurm is not available.
+    """
+    squeue = shutil.which('squeue')
+    if squeue is None:
+        return dict()
+    try:
+        process = subprocess.run([squeue,'-h','-u',getpass.getuser(),'-o','%Z|%j'],
+                                 capture_output=True,text=True,timeout=60,
+                                 check=True)
+    except (OSError,subprocess.SubprocessError):
+        print('The slurm queue could not be read, only --min-age is used')
+        return dict()
+    jobs = dict()
+    for line in process.stdout.splitlines():
+        folder,_,name = line.strip().rpartition('|')
+        if folder:
+            jobs.setdefault(Path(folder).resolve(),set()).add(name)
+    return jobs
+def is_queued(ofile:Path,in_suffix:str,jobs:dict[Path,set[str]]) -> bool:
+    """
+    True if a job of the queue may be running the calculation: a job in its
+    folder named as the output or with a name that is not an input of the 
+    folder (e.g. array or packed jobs).
+    """
+    names = jobs.get(ofile.parent.resolve(),None)
+    if not names:
+        return False
+    if ofile.stem in names:
+        return True
+    inputs = {f.stem for f in ofile.parent.glob(f'*{in_suffix}')}
+    return bool(names - inputs)
+def find_failed(folders:list[Path],
+                in_suffix:str,
+                out_suffix:str,
+                min_age:float=DEFAULT_MIN_AGE,
+                check_queue:bool=True) -> list[Path]:
+    """
+    Returns the outputs in the folders without a normal termination that were
+    last modified more than min_age minutes ago and, if check_queue, whose
+    jobs are not in the slurm queue.
+    """
+    now = time.time()
+    jobs = queued_jobs() if check_queue else dict()
+    failed = []
+    for folder in folders:
+        for ofile in DirectoryTree(folder,in_suffix,out_suffix).outfiles:
+            ofile = Path(ofile)
+            if now - ofile.stat().st_mtime < min_age*60:
+                continue
+            if has_normal_termination(ofile):
+                continue
+            if is_queued(ofile,in_suffix,jobs):
+                print(f'{ofile}: still in the queue')
+                continue
+            failed.append(ofile)
+    return failed
+def is_optimization(commandline:dict) -> bool:
+    return any(key.lower() == 'opt' for key in commandline)
+def pop_keyword(gif,keyword:str) -> list[str]:
+    """
+    Removes a keyword from the route regardless of its case and returns its
+    options.
+    """
+    options = []
+    for key in [k for k in gif.commandline if k.lower() == keyword]:
+        values = gif.commandline.pop(key)
+        if isinstance(values,list):
+            options.extend(values)
+        elif values:
+            options.append(values)
+    return options
+def write_restart(tfile:Path,
+                  ofile:Path,
+                  newfile:Path,
+                  use_check:bool=True,
+                  opt_restart:bool=False) -> str:
+    """
+    Writes the restart input of a calculation and returns a short description
+    of the strategy used.
+
+    Parameters
+    ----------
+    tfile : Path
+        original input file, used as template
+    ofile : Path
+        output of the calculation that did not finish
+    newfile : Path
+        restart input to write
+    use_check : bool, optional
+        If True and the checkpoint file exists, the geometry and guess are
+        read from it, by default True
+    opt_restart : bool, optional
+        If True, optimizations with an existing checkpoint are restarted with
+        'opt=restart', which continues the optimization with its Hessian. Any
+        other job keyword (e.g. freq) is dropped, by default False
+
+    Returns
+    -------
+    str
+        strategy used
+    """
+    template = read_gaussian_input(tfile)
+    gif = clone_gaussian_input(template)
+    gif.title = newfile.stem
+
+    chk = gif.preprocessing.get('chk',None)
+    has_chk = chk is not None and (tfile.parent/chk).exists()
+
+    if has_chk and opt_restart and is_optimization(gif.commandline):
+        options = []
+        for key,values in gif.commandline.items():
+            if key.lower() == 'opt':
+                options = [v for v in values if v.lower() != 'restart']
+        options = ','.join(['restart',]+options)
+        text = f"{gif.preprocessing_as_str()}\n#p opt=({options})\n\n"
+        atomic_write(newfile,text)
+        return f'opt=restart from {chk}'
+
+    if has_chk and use_check:
+        # Other geom options (e.g. connectivity, modredundant) are kept as
+        # their sections are still in the input
+        options = [o for o in pop_keyword(gif,'geom')
+                   if o.lower().split('=')[0] not in GEOM_SOURCES]
+        pop_keyword(gif,'guess')
+        gif.commandline['geom'] = ['check',] + options
+        gif.commandline['guess'] = ['read',]
+        gif.geometry = ''
+        atomic_write(newfile,str(gif))
+        return f'geom=check guess=read from {chk}'
+
+    with GaussianOutFile(ofile,[202]) as gof:
+        gof.read()
+        l202 = gof.get_links(202)
+    if not l202:
+        atomic_write(newfile,str(gif))
+        return 'no geometry in the output, original geometry'
+    gif.geometry = Geometry.from_L202(l202[-1])
+    atomic_write(newfile,str(gif))
+    return 'last geometry of the output'
+def write_submit_script(filepath:Path,
+                        ifiles:list[Path],
+                        software:str=DEFAULT_SOFTWARE):
+    """
+    Writes a script that submits the inputs moving to their folders, using the
+    same queue selection as 'submit custom'.
+    """
+    root = Path.cwd().resolve()
+    lines = ['#!/bin/bash',
+             '# Automated Submit Script',
+             'BASEDIR=$PWD;']
+    ifiles = sorted(ifiles,key=lambda p: str(p.parent))
+    for folder,group in groupby(ifiles,key=lambda p: p.parent):
+        # The folders may be outside of the current directory (e.g. ../runs)
+        relpath = os.path.relpath(Path(folder).resolve(),root)
+        if relpath != '.':
+            lines.append(f'cd {relpath};')
+        for ifile in group:
+            lines.append(submitline(ifile,software=software,
+                                    ascomment=False,norun=False))
+        if relpath != '.':
+            lines.append('cd ${BASEDIR};')
+    lines.append('echo "Finished submiting calculations";')
+    with open(filepath,'w') as F:
+        F.write('\n'.join(lines)+'\n')
+
+# Parser and Main Definition
+__doc__ = __doc__.format(in_suffix=GAUSSIAN_INPUT_SUFFIX)
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('folders',
+                    nargs='*',default=[Path.cwd(),],type=Path,
+                    help="Folders where the outputs are searched recursively, "
+                    "by default the current directory")
+parser.add_argument('-m','--marker',
+                    default=DEFAULT_MARKER,
+                    help="Text added to the filename of the restart inputs, "
+                    f"myfile{GAUSSIAN_INPUT_SUFFIX} becomes "
+                    f"myfile_{DEFAULT_MARKER}{GAUSSIAN_INPUT_SUFFIX}")
+parser.add_argument('-ow','--overwrite',
+                    dest='do_overwrite',
+                    action='store_true',default=False,
+                    help="Overwrite previously existing restart inputs")
+parser.add_argument('--no-check',
+                    dest='use_check',
+                    action='store_false',default=True,
+                    help="Always use the last geometry of the output even "
+                    "if the checkpoint file exists")
+parser.add_argument('--opt-restart',
+                    dest='opt_restart',
+                    action='store_true',default=False,
+                    help="Restart optimizations with an existing checkpoint "
+                    "with 'opt=restart'. Other job keywords such as freq are "
+                    "dropped.")
+parser.add_argument('--min-age',
+                    dest='min_age',
+                    type=float,default=DEFAULT_MIN_AGE,
+                    help="Ignore outputs modified in the last minutes, to "
+                    f"avoid calculations still running, by default {DEFAULT_MIN_AGE}")
+parser.add_argument('--ignore-queue',
+                    dest='check_queue',
+                    action='store_false',default=True,
+                    help="Do not ignore the outputs whose jobs are in the slurm "
+                    "queue (only --min-age is used)")
+parser.add_argument('--dry-run',
+                    dest='dry_run',
+                    action='store_true',default=False,
+                    help="Only display the calculations that would be restarted")
+parser.add_argument('--script',
+                    dest='scriptname',
+                    default=DEFAULT_SCRIPTNAME,
+                    help="Name of the submit script created in the current "
+                    f"directory, by default {DEFAULT_SCRIPTNAME}")
+parser.add_argument('--no-script',
+                    dest='scriptname',
+                    action='store_const',const=None,
+                    help="Do not create the submit script")
+parser.add_argument('--software',
+                    choices=['g09','g16'],
+                    default=DEFAULT_SOFTWARE)
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of parallel processes used to generate the "
+                    f"new files, by default {DEFAULT_JOBS}")
+parser.add_argument('--suffixes',
+                    default=DEFAULT_SUFFIX,nargs=2,
+                    help="Input and output suffix used for gaussian files")
+
+def main(
+         folders:list[Path],
+         marker:str=DEFAULT_MARKER,
+         do_overwrite:bool=False,
+         use_check:bool=True,
+         opt_restart:bool=False,
+         min_age:float=DEFAULT_MIN_AGE,
+         check_queue:bool=True,
+         dry_run:bool=False,
+         scriptname:str|None=DEFAULT_SCRIPTNAME,
+         software:str=DEFAULT_SOFTWARE,
+         jobs:int=DEFAULT_JOBS,
+         suffixes:tuple[str]=DEFAULT_SUFFIX,
+         ):
+
+    in_suffix,out_suffix = suffixes
+    failed = find_failed(folders,in_suffix,out_suffix,min_age,check_queue)
+
+    tasks = []
+    for ofile in failed:
+        tfile = ofile.with_suffix(in_suffix)
+        print(f'{ofile}: {failure_reason(ofile)}')
+        if not tfile.exists():
+            print(f'    {tfile} not found. Skipping to the next one')
+            continue
+        # A failed restart is restarted again in-place
+        if ofile.stem.endswith(f'_{marker}'):
+            newfile = tfile
+            if not do_overwrite:
+                print(f'    {newfile} is a restart, use -ow to overwrite it')
+                continue
+        else:
+            newfile = tfile.with_stem(f'{tfile.stem}_{marker}')
+            if newfile.with_suffix(out_suffix).exists():
+                print(f'    already restarted as {newfile}')
+                continue
+            if newfile.exists() and not do_overwrite:
+                print(f'    {newfile} already exists, use -ow to overwrite it')
+                continue
+        tasks.append((tfile,ofile,newfile,use_check,opt_restart))
+
+    if dry_run or not tasks:
+        print(f'{len(tasks)} calculations to restart')
+        return
+
+    newfiles = []
+    errors = []
+    for task,(strategy,error) in zip(tasks,run_in_pool(write_restart,tasks,jobs)):
+        newfile = task[2]
+        if error is not None:
+            print(f'Error creating {newfile}: {error}')
+            errors.append(newfile)
+            continue
+        print(f'Creating file {newfile} ({strategy})')
+        newfiles.append(newfile)
+
+    if scriptname is not None and newfiles:
+        write_submit_script(Path(scriptname),newfiles,software)
+        print(f'Submit script written at {scriptname}')
+
+    if errors:
+        raise RuntimeError(f'{len(errors)} files could not be processed')
@@ -7,6 +7,8 @@ from ..utils import add_parser_as_subparser
 
 from . import track
 from . import cubestddft
+from . import scaling
+from . import dedup
 
 parser = argparse.ArgumentParser(description=__doc__)
 subparsers = parser.add_subparsers(help='sub-command help',dest='other_command')
@@ -16,6 +18,12 @@ add_parser_as_subparser(subparsers,
 add_parser_as_subparser(subparsers,
                         cubestddft.parser, 'cubes-tddft',
                         help=cubestddft.__doc__)
+add_parser_as_subparser(subparsers,
+                        scaling.parser, 'scaling',
+                        help=scaling.__doc__)
+add_parser_as_subparser(subparsers,
+                        dedup.parser, 'dedup',
+                        help=dedup.__doc__)
 
 def main(
          other_command:str|None=None,
@@ -25,5 +33,9 @@ def main(
         track.main(**kwargs)
     elif other_command == 'cubes-tddft': 
         cubestddft.main(**kwargs)
+    elif other_command == 'scaling':
+        scaling.main(**kwargs)
+    elif other_command == 'dedup':
+        dedup.main(**kwargs)
 
     
\ No newline at end of file
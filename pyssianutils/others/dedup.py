@@ -0,0 +1,174 @@
+"""
+Finds duplicated conformers among gaussian outputs. The final geometry and
+energy of each output are extracted as in 'toxyz', the structures are grouped
+by their atoms and by energy windows, and within each group the structures are
+compared, in increasing energy, by their RMSD after the optimal superposition.
+A structure is a duplicate of the first representative closer than the RMSD
+threshold. Atoms are compared in the order of the files, as in the outputs of
+a conformer search of a single molecule.
+"""
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from ..initialize import load_app_defaults
+from ..utils import DirectoryTree, run_in_pool
+from ..toxyz import trajectory_arrays
+from ..geometry import kabsch_rmsd
+
+HARTREE2KCAL = 627.5094740631 # Source: https://physics.nist.gov/cgi-bin/cuu/Value?hr (in kcal/mol)
+
+# Load app defaults
+DEFAULTS = load_app_defaults()
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+DEFAULT_RMSD = DEFAULTS['others.dedup'].getfloat('rmsd')
+DEFAULT_WINDOW = DEFAULTS['others.dedup'].getfloat('energy_window')
+
+# Utility Functions
+def final_structure(filepath:Path) -> tuple[tuple[int,...],np.ndarray,float|None]:
+    """
+    Atomic numbers, coordinates and energy of the last geometry of a file.
+    """
+    numbers, coordinates, energy, _ = trajectory_arrays(filepath,last=True)[-1]
+    return tuple(numbers), np.array(coordinates,dtype=np.float64), energy
+def energy_bins(energies:np.ndarray,window:float) -> list[np.ndarray]:
+    """
+    Splits the structures, sorted by energy, wherever two consecutive
+    energies differ more than the window, so that any two structures within
+    the window end up in the same bin. Structures without energy form their
+    own bin.
+    """
+    known = np.flatnonzero(~np.isnan(energies))
+    unknown = np.flatnonzero(np.isnan(energies))
+    order = known[np.argsort(energies[known],kind='stable')]
+    bins = []
+    if order.size:
+        cuts = np.flatnonzero(np.diff(energies[order]) > window) + 1
+        bins.extend(np.split(order,cuts))
+    if unknown.size:
+        bins.append(unknown)
+    return bins
+def deduplicate(coordinates:np.ndarray,threshold:float) -> np.ndarray:
+    """
+    Greedy clustering of the structures of a bin in the order provided.
+    Returns, for each structure, the position of its representative.
+
+    Parameters
+    ----------
+    coordinates : np.ndarray
+        (structures, atoms, 3) coordinates
+    threshold : float
+        structures with a RMSD lower than the threshold are duplicates
+
+    Returns
+    -------
+    np.ndarray
+        (structures,) position of the representative of each structure
+    """
+    representatives = []
+    assignment = np.empty(coordinates.shape[0],dtype=np.intp)
+    for i,xyz in enumerate(coordinates):
+        if representatives:
+            rmsd = kabsch_rmsd(coordinates[representatives],xyz)
+            closest = int(np.argmin(rmsd))
+            if rmsd[closest] < threshold:
+                assignment[i] = representatives[closest]
+                continue
+        representatives.append(i)
+        assignment[i] = i
+    return assignment
+def find_outputs(paths:list[Path],suffix:str=GAUSSIAN_OUTPUT_SUFFIX) -> list[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            tree = DirectoryTree(path,GAUSSIAN_INPUT_SUFFIX,suffix)
+            files.extend(Path(f) for f in tree.outfiles)
+        else:
+            files.append(path)
+    return sorted(set(files))
+
+# Parser and main definition
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('paths',
+                    nargs='+',type=Path,
+                    help="Gaussian output files or folders where they are "
+                    "searched recursively")
+parser.add_argument('--rmsd',
+                    type=float,default=DEFAULT_RMSD,
+                    help="Structures with a RMSD (Angstrom) lower than this "
+                    f"are duplicates, by default {DEFAULT_RMSD}")
+parser.add_argument('--energy-window',
+                    dest='window',
+                    type=float,default=DEFAULT_WINDOW,
+                    help="Only structures whose energies differ less than "
+                    f"this (kcal/mol) are compared, by default {DEFAULT_WINDOW}")
+parser.add_argument('-o','--outfile',
+                    type=Path,default=None,
+                    help="json file where the duplicates of each "
+                    "representative are written")
+parser.add_argument('--suffix',
+                    default=GAUSSIAN_OUTPUT_SUFFIX,
+                    help="suffix of the gaussian output files searched in "
+                    "the folders")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of parallel processes used to read the "
+                    f"outputs and compare the structures, by default {DEFAULT_JOBS}")
+
+def main(
+         paths:list[Path],
+         rmsd:float=DEFAULT_RMSD,
+         window:float=DEFAULT_WINDOW,
+         outfile:Path|None=None,
+         suffix:str=GAUSSIAN_OUTPUT_SUFFIX,
+         jobs:int=DEFAULT_JOBS,
+         ):
+
+    files = find_outputs(paths,suffix)
+    structures = dict() # atomic numbers -> [(file,coordinates,energy),...]
+    errors = []
+    for ofile,(result,error) in zip(files,run_in_pool(final_structure,((f,) for f in files),jobs)):
+        if error is not None:
+            print(f'Error reading {ofile}: {error}')
+            errors.append(ofile)
+            continue
+        numbers, coordinates, energy = result
+        structures.setdefault(numbers,[]).append((ofile,coordinates,energy))
+
+    # Each bin is compared independently
+    bins = []
+    for numbers,group in structures.items():
+        energies = np.array([np.nan if e is None else e for _,_,e in group])
+        coordinates = np.stack([xyz for _,xyz,_ in group])
+        for indices in energy_bins(energies,window/HARTREE2KCAL):
+            bins.append(([group[i][0] for i in indices],coordinates[indices]))
+    tasks = ((xyz,rmsd) for _,xyz in bins)
+    duplicates = dict()
+    for (ofiles,_),(assignment,error) in zip(bins,run_in_pool(deduplicate,tasks,jobs)):
+        if error is not None:
+            print(f'Error comparing {ofiles[0]} and {len(ofiles)-1} more: {error}')
+            errors.extend(ofiles)
+            continue
+        for ofile,representative in zip(ofiles,assignment):
+            duplicates.setdefault(str(ofiles[representative]),[])
+            if ofiles[representative] != ofile:
+                duplicates[str(ofiles[representative])].append(str(ofile))
+
+    n_duplicates = sum(len(v) for v in duplicates.values())
+    for representative,items in sorted(duplicates.items()):
+        print(representative)
+        for item in items:
+            print(f'    {item}')
+    print(f'{len(duplicates)} unique structures, {n_duplicates} duplicates, '
+          f'{len(structures)} different sets of atoms')
+
+    if outfile is not None:
+        with open(outfile,'w') as F:
+            json.dump(dict(sorted(duplicates.items())),F,indent=1)
+        print(f'Duplicates written to {outfile}')
+    if errors:
+        raise RuntimeError(f'{len(errors)} files could not be processed')
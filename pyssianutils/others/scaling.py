@@ -0,0 +1,300 @@
+"""
+Analyzes the parallel efficiency of finished gaussian calculations. The
+outputs are grouped by method, basis and system size (number of basis
+functions) and within each group the elapsed times of the different core
+counts ('%nprocshared') are compared to estimate the speedup and parallel
+efficiency of each core count, fit the serial fraction of Amdahl's law and 
+recommend the core count that maximizes the number of calculations per 
+node-hour.
+"""
+import json
+import math
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from ..initialize import load_app_defaults, _defaults_set
+from ..utils import DirectoryTree, harvest_output, run_in_pool
+
+# Load app defaults
+DEFAULTS = load_app_defaults()
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+DEFAULT_NODE_CORES = DEFAULTS['others.scaling'].getint('node_cores')
+DEFAULT_TOLERANCE = DEFAULTS['others.scaling'].getfloat('tolerance')
+DEFAULT_SIZE_EXPONENT = DEFAULTS['others.scaling'].getfloat('size_exponent')
+
+# Utility Functions
+def size_bin(nbasis:int) -> str:
+    """
+    Groups the number of basis functions in powers of 2 (e.g. '256-511').
+    """
+    low = 2**int(math.log2(nbasis))
+    return f'{low}-{2*low-1}'
+def group_records(records:list[dict]) -> dict[tuple,list[dict]]:
+    """
+    Groups the records by method, basis and size_bin. Only records with a
+    normal termination and both cpu and elapsed times are kept.
+    """
+    groups = dict()
+    for r in records:
+        if not (r['normal'] and r['cpu_time'] and r['elapsed'] and r['nbasis']):
+            continue
+        key = (r['method'],r['basis'],size_bin(r['nbasis']))
+        groups.setdefault(key,[]).append(r)
+    return groups
+def serial_fraction(cores:np.ndarray,efficiency:np.ndarray) -> float|None:
+    """
+    Least squares fit of the serial fraction f of Amdahl's law. With the
+    efficiency relative to the smallest core count p0, 1/E(p) is linear in p:
+    1/E(p) = (1 + f*(p-1))/(1 + f*(p0-1)) = c0 + c1*p, thus f = c1/(c0+c1).
+    Returns None if less than two core counts are provided.
+    """
+    if np.unique(cores).shape[0] < 2:
+        return None
+    c1,c0 = np.polyfit(cores,1.0/efficiency,1)
+    if c0 + c1 <= 0:
+        return 1.0
+    return min(max(float(c1/(c0 + c1)),0.0),1.0)
+def amdahl_efficiency(cores:int,f:float,reference:int=1) -> float:
+    """
+    Efficiency of a core count relative to the reference core count.
+    """
+    return (1.0 + f*(reference-1))/(1.0 + f*(cores-1))
+def _add_throughput(rows:list[dict],node_cores:int) -> list[dict]:
+    rows = [row for row in rows if row['cores'] <= node_cores]
+    rows.sort(key=lambda row: row['cores'])
+    for row in rows:
+        row['speedup'] = row['cores']*row['efficiency']
+        row['per_node'] = node_cores//row['cores']
+        row['throughput'] = row['per_node']*row['speedup']
+    best = max((row['throughput'] for row in rows),default=0.0)
+    for row in rows:
+        row['throughput'] = row['throughput']/best if best else 0.0
+    return rows
+def scaling_table(records:list[dict],
+                  node_cores:int,
+                  candidates:list[int]|None=None,
+                  size_exponent:float=DEFAULT_SIZE_EXPONENT) -> dict:
+    """
+    Computes, for each core count p of a group of similar calculations, the
+    speedup S(p) = T(p0)*p0/T(p) relative to the smallest core count p0, 
+    where T(p) is the median elapsed time of the runs with p cores normalized
+    by nbasis**size_exponent, the parallel efficiency E(p) = S(p)/p and the
+    relative throughput per node-hour, where a node runs node_cores//p 
+    calculations simultaneously.
+
+    Parameters
+    ----------
+    records : list[dict]
+        outputs harvested with utils.harvest_output of the same method, basis
+        and size
+    node_cores : int
+        cores of a node
+    candidates : list[int] | None, optional
+        additional core counts, not present in the records, whose efficiency
+        is extrapolated with Amdahl's law, by default None
+    size_exponent : float, optional
+        exponent of the cost with the number of basis functions used to 
+        compare runs of different sizes
+
+    Returns
+    -------
+    dict
+        'serial_fraction' (None if only one core count was measured) and 
+        'rows', a list of dicts with the keys 'cores', 'runs', 'efficiency', 
+        'speedup', 'per_node' and 'throughput' (normalized to the best core 
+        count)
+    """
+    cores = np.array([r['nprocs'] for r in records],dtype=float)
+    nbasis = np.array([r['nbasis'] for r in records],dtype=float)
+    elapsed = np.array([r['elapsed'] for r in records],dtype=float)
+    times = elapsed/(nbasis/np.median(nbasis))**size_exponent
+    measured = sorted(set(int(p) for p in cores))
+    medians = np.array([np.median(times[cores == p]) for p in measured])
+    reference = measured[0]
+    speedup = medians[0]*reference/medians
+    efficiency = speedup/np.array(measured,dtype=float)
+    f = serial_fraction(np.array(measured,dtype=float),efficiency)
+
+    rows = []
+    for p,e in zip(measured,efficiency):
+        rows.append(dict(cores=p,runs=int(np.sum(cores == p)),efficiency=float(e)))
+    if f is not None:
+        for p in sorted(set(candidates or []) - set(measured)):
+            rows.append(dict(cores=p,runs=0,
+                             efficiency=amdahl_efficiency(p,f,reference)))
+    return dict(serial_fraction=f,rows=_add_throughput(rows,node_cores))
+def amdahl_table(f:float,
+                 cores:list[int],
+                 node_cores:int) -> dict:
+    """
+    Same as scaling_table but with the efficiencies, relative to a single
+    core, given by Amdahl's law with the serial fraction f.
+    """
+    rows = [dict(cores=p,runs=0,efficiency=amdahl_efficiency(p,f))
+            for p in sorted(set(cores))]
+    return dict(serial_fraction=f,rows=_add_throughput(rows,node_cores))
+def recommend_cores(table:dict,tolerance:float=DEFAULT_TOLERANCE) -> int|None:
+    """
+    Returns the largest core count whose throughput is within the tolerance
+    of the best one, which reduces the time to solution at a negligible cost
+    in node-hours. Without an estimate of the serial fraction (a single core 
+    count) the measured core count is returned.
+    """
+    if table['serial_fraction'] is None:
+        return table['rows'][0]['cores'] if table['rows'] else None
+    rows = [row for row in table['rows'] if row['throughput'] >= 1.0 - tolerance]
+    if not rows:
+        return None
+    return max(row['cores'] for row in rows)
+def print_table(title:str,table:dict,recommended:int|None):
+    f = table['serial_fraction']
+    f = 'n/a (a single core count)' if f is None else f'{f:.3f}'
+    print(f"{title}    serial fraction={f}")
+    print(f"    {'cores':>5} {'runs':>5} {'efficiency':>10} {'speedup':>8} "
+          f"{'per node':>8} {'throughput':>10}")
+    for row in table['rows']:
+        mark = ' *' if row['cores'] == recommended else ''
+        print(f"    {row['cores']:>5d} {row['runs']:>5d} "
+              f"{row['efficiency']:>10.2f} {row['speedup']:>8.2f} "
+              f"{row['per_node']:>8d} {row['throughput']:>10.2f}{mark}")
+
+def set_custom_default(cores:int):
+    """
+    Sets as the default queue of 'submit custom' the one with the cores
+    provided.
+    """
+    from ..submit.custom import QUEUES
+    for key,queue in QUEUES.items():
+        if key != 'default' and queue.nprocesors == cores:
+            break
+    else:
+        raise ValueError(f'No queue in [submit.custom.queues] with {cores} cores')
+    _defaults_set('default',key,section='submit.custom.queues')
+def set_template_default(name:str,cores:int):
+    """
+    Sets the default cores of a slurm template
+    """
+    from ..submit.slurm import USERTEMPLATES
+    if name not in USERTEMPLATES:
+        raise ValueError(f"Template '{name}' not found. Available templates: "
+                         f"{list(USERTEMPLATES.keys())}")
+    slurmpath,json_t = USERTEMPLATES[name]
+    if 'cores' in json_t.choices and cores not in json_t.choices['cores']:
+        raise ValueError(f"{cores} cores are not among the choices of template "
+                         f"'{name}': {list(json_t.choices['cores'].keys())}")
+    jsonpath = slurmpath.with_suffix('.json')
+    with open(jsonpath,'r') as F:
+        data = json.load(F)
+    data['defaults']['cores'] = cores
+    with open(jsonpath,'w') as F:
+        json.dump(data,F,indent=4,separators=(',', ': '))
+    print(f'    setting default cores = {cores} in {jsonpath}')
+
+# Define Parser and main
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('folders',
+                    nargs='+',type=Path,
+                    help="Folders with gaussian output files, searched "
+                    "recursively")
+parser.add_argument('--suffix',
+                    default=GAUSSIAN_OUTPUT_SUFFIX,
+                    help="suffix of the gaussian output files")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of parallel processes used to read the "
+                    f"outputs, by default {DEFAULT_JOBS}")
+parser.add_argument('--node-cores',
+                    dest='node_cores',
+                    type=int,default=DEFAULT_NODE_CORES,
+                    help="Cores of a node, used to compute the throughput, by "
+                    f"default {DEFAULT_NODE_CORES}")
+parser.add_argument('--cores',
+                    dest='candidates',
+                    nargs='+',type=int,default=None,
+                    help="Additional core counts whose efficiency is "
+                    "extrapolated with Amdahl's law")
+parser.add_argument('--size-exponent',
+                    dest='size_exponent',
+                    type=float,default=DEFAULT_SIZE_EXPONENT,
+                    help="Elapsed times of outputs with different number of "
+                    "basis functions are compared divided by nbasis to this "
+                    f"power, by default {DEFAULT_SIZE_EXPONENT}")
+parser.add_argument('--tolerance',
+                    type=float,default=DEFAULT_TOLERANCE,
+                    help="The largest core count with a throughput within this "
+                    "fraction of the best one is recommended, by default "
+                    f"{DEFAULT_TOLERANCE}")
+parser.add_argument('--set-custom',
+                    dest='set_custom',
+                    action='store_true',default=False,
+                    help="Store the overall recommendation as the default "
+                    "queue of 'submit custom'")
+parser.add_argument('--set-template',
+                    dest='set_template',
+                    metavar='TEMPLATE',default=None,
+                    help="Store the overall recommendation as the default "
+                    "cores of the slurm template")
+
+def main(
+         folders:list[Path],
+         suffix:str=GAUSSIAN_OUTPUT_SUFFIX,
+         jobs:int=DEFAULT_JOBS,
+         node_cores:int=DEFAULT_NODE_CORES,
+         candidates:list[int]|None=None,
+         tolerance:float=DEFAULT_TOLERANCE,
+         size_exponent:float=DEFAULT_SIZE_EXPONENT,
+         set_custom:bool=False,
+         set_template:str|None=None,
+         ):
+
+    ofiles = []
+    for folder in folders:
+        ofiles.extend(DirectoryTree(folder,GAUSSIAN_INPUT_SUFFIX,suffix).outfiles)
+
+    records = []
+    for ofile,(record,error) in zip(ofiles,run_in_pool(harvest_output,
+                                                       [(f,) for f in ofiles],
+                                                       jobs)):
+        if error is not None:
+            print(f'Could not read {ofile}: {error}')
+        elif record is not None:
+            records.append(record)
+
+    groups = group_records(records)
+    if not groups:
+        raise RuntimeError('No finished outputs with cpu and elapsed times found')
+
+    fractions, weights, cores = [], [], set(candidates or [])
+    for (method,basis,size),items in sorted(groups.items(),key=str):
+        table = scaling_table(items,node_cores,candidates,size_exponent)
+        recommended = recommend_cores(table,tolerance)
+        print_table(f'{method}/{basis} nbasis {size} ({len(items)} outputs)',
+                    table,recommended)
+        cores.update(row['cores'] for row in table['rows'])
+        if table['serial_fraction'] is not None:
+            fractions.append(table['serial_fraction'])
+            weights.append(len(items))
+
+    # Different groups can not be compared directly, so the overall
+    # recommendation uses the typical serial fraction of the groups
+    if not fractions:
+        print('Recommended cores: None (no group was run with more than one core count)')
+        return
+    order = np.argsort(fractions)
+    cumulative = np.cumsum(np.array(weights)[order])
+    f = float(np.array(fractions)[order][np.searchsorted(cumulative,cumulative[-1]/2)])
+    table = amdahl_table(f,sorted(cores),node_cores)
+    recommended = recommend_cores(table,tolerance)
+    print_table(f'All ({sum(weights)} outputs in {len(fractions)} groups)',table,recommended)
+    print(f'Recommended cores: {recommended}')
+
+    if recommended is None:
+        return
+    if set_custom:
+        set_custom_default(recommended)
+    if set_template is not None:
+        set_template_default(set_template,recommended)
@@ -11,6 +11,8 @@ from pathlib import Path
 
 from pyssian import GaussianOutFile
 from ..utils import write_2_file
+from ..geometry import (stack_coordinates, atomic_numbers_from_L202, 
+                        suggest_coordinates, label, UNITS)
 from ..initialize import load_app_defaults
 
 # Typing imports
@@ -96,6 +98,18 @@ def get_cartesian_forces_max(link:Link716):
     else:
         return FORCES_FMT.format(float(re_match[0]))
 
+def print_suggestions(GOF:GaussianOutFile):
+    links202 = GOF.get_links(202)
+    if len(links202) < 2:
+        return
+    xyz = stack_coordinates(links202)
+    suggestions = suggest_coordinates(xyz,atomic_numbers_from_L202(links202[-1]))
+    print('Coordinates between bonded atoms that changed the most')
+    print(f'    {"Definition":<16}  Change')
+    for atoms,change in suggestions:
+        name = label(atoms)
+        print(f'    {name:<16} {change: 8.3f} {UNITS[name[0]]}')
+
 # Parser and Main definition
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('ifile',
@@ -134,11 +148,13 @@ def main(
         GOF.update()
     
     if variable is None and not scan: 
-        link = GOF.get_links(103)[0]
-        print(f'Available parameters to track for {ifile}')
-        print(f'      Name    Definition    ')
-        for parameter in link.parameters:
-            print(f'    {parameter.Name:>6}    {parameter.Definition:<10}')
+        links103 = GOF.get_links(103)
+        if links103 and links103[0].parameters:
+            print(f'Available parameters to track for {ifile}')
+            print(f'      Name    Definition    ')
+            for parameter in links103[0].parameters:
+                print(f'    {parameter.Name:>6}    {parameter.Definition:<10}')
+        print_suggestions(GOF)
         return
 
     # Header to know which is each column
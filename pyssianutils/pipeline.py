@@ -0,0 +1,328 @@
+"""
+Runs the steps of a pipeline file (json or yaml) as a make-like build. Each
+step has a shell 'command' (usually a pyssianutils command), its 'inputs'
+(paths or glob patterns) and 'outputs'. Steps whose inputs match the outputs
+of other steps run after them, independent steps run in parallel and a step is
+only re-executed if its outputs are missing or its command or inputs changed
+since its last successful execution.
+"""
+import os
+import json
+import shlex
+import fnmatch
+import hashlib
+import argparse
+import subprocess
+import concurrent.futures
+from pathlib import Path
+
+from .initialize import load_app_defaults
+from .utils import atomic_write
+
+try:
+    import yaml
+except ImportError as e:
+    YAML_LOADED = False
+    YAML_ERROR = e
+else:
+    YAML_LOADED = True
+
+DEFAULTS = load_app_defaults()
+DEFAULT_STATE = DEFAULTS['pipeline']['state_file']
+DEFAULT_CHECK = DEFAULTS['pipeline']['check']
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+CHECKS = ('mtime','hash')
+
+# Utility Functions and classes
+class Step(object):
+    """
+    A step of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        name of the step
+    command : str
+        shell command. '{inputs}' and '{outputs}' are replaced by the expanded
+        inputs and the outputs.
+    inputs : list[str]
+        paths or glob patterns relative to the pipeline folder
+    outputs : list[str]
+        paths relative to the pipeline folder
+    after : list[str]
+        names of steps that must run before, additionally to the ones
+        inferred from the inputs and outputs
+    """
+    def __init__(self,
+                 name:str,
+                 command:str,
+                 inputs:list[str]|None=None,
+                 outputs:list[str]|None=None,
+                 after:list[str]|None=None):
+        self.name = name
+        self.command = command
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.after = list(after or [])
+    def __repr__(self):
+        return f'<{type(self).__name__}({self.name})>'
+
+    def consumes(self,other:'Step') -> bool:
+        """
+        True if any of the inputs of this step is an output of the other step
+        or lies within a folder output of the other step.
+        """
+        for pattern in self.inputs:
+            pattern = os.path.normpath(pattern)
+            for output in other.outputs:
+                output = os.path.normpath(output)
+                if (fnmatch.fnmatch(output,pattern) or
+                    pattern.startswith(output + os.sep) or
+                    fnmatch.fnmatch(pattern,output)):
+                    return True
+        return False
+
+    def expanded_inputs(self,rootdir:Path) -> list[Path]:
+        paths = []
+        for pattern in self.inputs:
+            matches = sorted(rootdir.glob(pattern))
+            if not matches and not any(c in pattern for c in '*?['):
+                matches = [rootdir/pattern,]
+            paths.extend(matches)
+        return paths
+
+    def shell_command(self,rootdir:Path) -> str:
+        inputs = [os.path.relpath(p,rootdir) for p in self.expanded_inputs(rootdir)]
+        # Only the placeholders are replaced, other braces (e.g. awk programs
+        # or brace expansions) are left untouched
+        command = self.command.replace('{inputs}',' '.join(map(shlex.quote,inputs)))
+        return command.replace('{outputs}',' '.join(map(shlex.quote,self.outputs)))
+
+def read_pipeline(filepath:Path) -> list[Step]:
+    """
+    Reads a pipeline file with a mapping 'steps' of step names to their
+    'command', 'inputs', 'outputs' and optionally 'after'.
+    """
+    filepath = Path(filepath)
+    with open(filepath,'r') as F:
+        if filepath.suffix in ['.yaml','.yml']:
+            if not YAML_LOADED:
+                raise YAML_ERROR
+            data = yaml.safe_load(F)
+        else:
+            data = json.load(F)
+    steps = []
+    for name,item in data['steps'].items():
+        if 'command' not in item:
+            raise ValueError(f"step '{name}' has no command")
+        unknown = set(item) - {'command','inputs','outputs','after'}
+        if unknown:
+            raise ValueError(f"Unknown keys {sorted(unknown)} in step '{name}'")
+        steps.append(Step(name,**item))
+    return steps
+def build_graph(steps:list[Step]) -> dict[str,set[str]]:
+    """
+    Returns the steps that each step depends on, raising an error if the
+    dependencies contain a cycle.
+    """
+    names = {step.name for step in steps}
+    graph = dict()
+    for step in steps:
+        unknown = set(step.after) - names
+        if unknown:
+            raise ValueError(f"step '{step.name}' is after unknown steps {sorted(unknown)}")
+        deps = set(step.after)
+        for other in steps:
+            if other is not step and step.consumes(other):
+                deps.add(other.name)
+        graph[step.name] = deps
+    # Check for cycles
+    done = set()
+    pending = dict(graph)
+    while pending:
+        ready = [n for n,deps in pending.items() if deps <= done]
+        if not ready:
+            raise ValueError(f'The steps {sorted(pending)} form a cycle')
+        done.update(ready)
+        for n in ready:
+            del pending[n]
+    return graph
+def select_targets(graph:dict[str,set[str]],targets:list[str]|None) -> set[str]:
+    """
+    Returns the targets and all the steps they depend on.
+    """
+    if not targets:
+        return set(graph)
+    unknown = set(targets) - set(graph)
+    if unknown:
+        raise ValueError(f'Unknown steps {sorted(unknown)}')
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(graph[name])
+    return selected
+
+class PipelineState(object):
+    """
+    Signatures of the last successful execution of each step and a cache of
+    the content hashes of the files, stored as a json file.
+    """
+    def __init__(self,filepath:Path,check:str=DEFAULT_CHECK):
+        self.filepath = Path(filepath)
+        self.check = check
+        self.signatures:dict[str,str] = dict()
+        # path -> [size, mtime_ns, sha256]
+        self.hashes:dict[str,list] = dict()
+        if self.filepath.exists():
+            with open(self.filepath,'r') as F:
+                data = json.load(F)
+            self.signatures = data.get('signatures',dict())
+            self.hashes = data.get('hashes',dict())
+
+    def fingerprint(self,path:Path) -> str:
+        if not path.exists():
+            return 'missing'
+        if path.is_dir():
+            return 'dir:' + ','.join(self.fingerprint(p) for p in sorted(path.rglob('*'))
+                                     if p.is_file())
+        stat = path.stat()
+        if self.check == 'mtime':
+            return f'{stat.st_size}:{stat.st_mtime_ns}'
+        cached = self.hashes.get(str(path),None)
+        if cached is not None and cached[:2] == [stat.st_size,stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path,'rb') as F:
+            for chunk in iter(lambda: F.read(1 << 20),b''):
+                digest.update(chunk)
+        self.hashes[str(path)] = [stat.st_size,stat.st_mtime_ns,digest.hexdigest()]
+        return digest.hexdigest()
+
+    def signature(self,step:Step,rootdir:Path) -> str:
+        digest = hashlib.sha256(step.shell_command(rootdir).encode())
+        for path in step.expanded_inputs(rootdir):
+            digest.update(f'{os.path.relpath(path,rootdir)}={self.fingerprint(path)}\n'.encode())
+        return digest.hexdigest()
+
+    def is_outdated(self,step:Step,rootdir:Path) -> bool:
+        if any(not (rootdir/output).exists() for output in step.outputs):
+            return True
+        return self.signatures.get(step.name,None) != self.signature(step,rootdir)
+
+    def save(self):
+        data = dict(signatures=self.signatures,hashes=self.hashes)
+        atomic_write(self.filepath,json.dumps(data,indent=1))
+
+def run_step(command:str,rootdir:Path) -> tuple[int,str]:
+    process = subprocess.run(command,shell=True,cwd=rootdir,
+                             stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+                             text=True)
+    return process.returncode, process.stdout
+
+# Define Parser and main
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('pipelinefile',
+                    type=Path,
+                    help="json or yaml file with the steps of the pipeline")
+parser.add_argument('targets',
+                    nargs='*',
+                    help="Steps to run, with the steps they depend on. By "
+                    "default all the steps")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of steps run simultaneously, by default "
+                    f"{DEFAULT_JOBS}")
+parser.add_argument('--check',
+                    choices=CHECKS,default=DEFAULT_CHECK,
+                    help="How changes in the inputs are detected: by size and "
+                    "modification time or by the hash of their contents, by "
+                    f"default {DEFAULT_CHECK}")
+parser.add_argument('--force',
+                    action='store_true',default=False,
+                    help="Run the steps even if they are up to date")
+parser.add_argument('--dry-run',
+                    dest='dry_run',
+                    action='store_true',default=False,
+                    help="Only display the steps that are out of date")
+
+def main(
+         pipelinefile:Path,
+         targets:list[str]|None=None,
+         jobs:int=DEFAULT_JOBS,
+         check:str=DEFAULT_CHECK,
+         force:bool=False,
+         dry_run:bool=False,
+         ):
+
+    rootdir = Path(pipelinefile).resolve().parent
+    steps = {step.name:step for step in read_pipeline(pipelinefile)}
+    graph = build_graph(list(steps.values()))
+    selected = select_targets(graph,targets)
+    state = PipelineState(rootdir/DEFAULT_STATE,check)
+
+    if dry_run:
+        # Steps that depend on an outdated step are also outdated
+        outdated = set()
+        done = set()
+        while len(done) < len(selected):
+            for name in sorted(selected - done):
+                if not graph[name] & selected <= done:
+                    continue
+                if force or graph[name] & outdated or state.is_outdated(steps[name],rootdir):
+                    outdated.add(name)
+                    print(f'{name}: {steps[name].shell_command(rootdir)}')
+                done.add(name)
+        print(f'{len(outdated)} of {len(selected)} steps out of date')
+        return
+
+    finished, failed, skipped = set(), set(), set()
+    executed = 0
+    running = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs,1)) as pool:
+        while len(finished | failed | skipped) < len(selected):
+            # Submit every step whose dependencies are finished
+            for name in sorted(selected - finished - failed - skipped - set(running.values())):
+                deps = graph[name] & selected
+                if deps & (failed | skipped):
+                    print(f'{name}: skipped, it depends on a failed step')
+                    skipped.add(name)
+                    continue
+                if not deps <= finished:
+                    continue
+                step = steps[name]
+                if not force and not state.is_outdated(step,rootdir):
+                    print(f'{name}: up to date')
+                    finished.add(name)
+                    continue
+                command = step.shell_command(rootdir)
+                print(f'{name}: {command}',flush=True)
+                running[pool.submit(run_step,command,rootdir)] = name
+            if not running:
+                continue
+            done,_ = concurrent.futures.wait(running,
+                                             return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                returncode, output = future.result()
+                missing = [o for o in steps[name].outputs if not (rootdir/o).exists()]
+                if returncode != 0 or missing:
+                    failed.add(name)
+                    state.signatures.pop(name,None)
+                    print(f'{name}: failed (exit code {returncode}'
+                          f'{", missing "+", ".join(missing) if missing else ""})')
+                    if output.strip():
+                        print(output.rstrip())
+                else:
+                    finished.add(name)
+                    executed += 1
+                    state.signatures[name] = state.signature(steps[name],rootdir)
+                state.save()
+
+    state.save()
+    print(f'{executed} steps executed, {len(selected)-executed-len(failed)-len(skipped)} '
+          f'up to date, {len(failed)} failed, {len(skipped)} skipped')
+    if failed:
+        raise RuntimeError(f'The steps {sorted(failed)} failed')
@@ -0,0 +1,140 @@
+"""
+Cache of the series that the plotting utilities extract from gaussian outputs.
+Each entry is a compressed .npz file with the arrays extracted from an output
+together with the size and modification time of the output and the version of
+the extractor, so that outputs that changed are parsed again. Entries are
+stored in the 'cache' folder of the app data or next to each output, and the
+least recently used entries of the app data are removed when the cache grows
+beyond its maximum size.
+"""
+import os
+import hashlib
+import zipfile
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from ..initialize import load_app_defaults, get_appdir
+
+DEFAULTS = load_app_defaults()
+ENABLED = DEFAULTS['plot.cache'].getboolean('enabled')
+LOCATION = DEFAULTS['plot.cache']['location']
+MAX_SIZE = DEFAULTS['plot.cache'].getfloat('max_size')
+SIGNATURE = '__signature__'
+
+# Utility Functions
+def cache_path(ifile:str|Path,key:str,location:str=LOCATION) -> Path|None:
+    """
+    Path of the cache entry of an output and key. Returns None if the cache
+    is kept in the app data but it has not been created.
+    """
+    ifile = Path(ifile).resolve()
+    digest = hashlib.sha1(f'{ifile}\n{key}'.encode()).hexdigest()
+    if location == 'output':
+        return ifile.parent/f'.{ifile.name}.{digest[:12]}.npz'
+    if location != 'appdir':
+        raise ValueError(f"Unknown cache location '{location}', use 'appdir' or 'output'")
+    appdir = get_appdir()
+    if not appdir.exists():
+        return None
+    return appdir/'cache'/f'{digest}.npz'
+def signature(ifile:str|Path,key:str,version:int) -> np.ndarray:
+    stat = os.stat(ifile)
+    return np.array([str(stat.st_size),str(stat.st_mtime_ns),str(version),key])
+def read_entry(path:Path,expected:np.ndarray) -> dict[str,np.ndarray]|None:
+    """
+    Arrays of a cache entry, or None if it does not exist or it does not
+    match the expected signature.
+    """
+    try:
+        with np.load(path) as data:
+            if SIGNATURE not in data.files or not np.array_equal(data[SIGNATURE],expected):
+                return None
+            arrays = {k:data[k] for k in data.files if k != SIGNATURE}
+    except (OSError,ValueError,EOFError,zipfile.BadZipFile):
+        return None
+    try:
+        os.utime(path) # The modification time is the last use
+    except OSError:
+        pass
+    return arrays
+def write_entry(path:Path,arrays:dict[str,np.ndarray],sign:np.ndarray):
+    """
+    Writes a cache entry atomically, so that other processes never read a
+    partially written entry.
+    """
+    path.parent.mkdir(parents=True,exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent,suffix='.tmp',delete=False) as F:
+        tmpfile = Path(F.name)
+        try:
+            np.savez_compressed(F,**{SIGNATURE:sign},**arrays)
+        except Exception:
+            F.close()
+            tmpfile.unlink(missing_ok=True)
+            raise
+    os.replace(tmpfile,path)
+def evict(folder:Path,max_size:float=MAX_SIZE):
+    """
+    Removes the least recently used entries of the folder until their total
+    size is below max_size (in MB).
+    """
+    entries = []
+    with os.scandir(folder) as iterator:
+        for entry in iterator:
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime,stat.st_size,Path(entry.path)))
+    total = sum(size for _,size,_ in entries)
+    limit = max_size*1024**2
+    for _,size,path in sorted(entries,key=lambda x: x[0]):
+        if total <= limit:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+def load_or_extract(ifile:str|Path,
+                    key:str,
+                    version:int,
+                    extract:Callable[[Path],dict[str,np.ndarray]]) -> dict[str,np.ndarray]:
+    """
+    Returns the arrays of the cache entry of the output if it is up to date,
+    otherwise extracts them and stores them in the cache.
+
+    Parameters
+    ----------
+    ifile : str | Path
+        gaussian output file
+    key : str
+        identifies what is extracted, including any parameter of the extractor
+    version : int
+        version of the extractor, it has to be increased whenever the
+        extracted arrays change for the same output
+    extract : Callable[[Path],dict[str,np.ndarray]]
+        function that extracts the arrays from the output
+
+    Returns
+    -------
+    dict[str,np.ndarray]
+    """
+    ifile = Path(ifile)
+    path = cache_path(ifile,key,LOCATION) if ENABLED else None
+    if path is None:
+        return extract(ifile)
+    sign = signature(ifile,key,version)
+    arrays = read_entry(path,sign)
+    if arrays is not None:
+        return arrays
+    arrays = extract(ifile)
+    try:
+        write_entry(path,arrays,sign)
+        if LOCATION == 'appdir':
+            evict(path.parent)
+    except OSError:
+        pass # A read-only folder only disables the cache
+    return arrays
@@ -1,136 +1,128 @@
 """
-Generate an interactive figure for a multiple gaussian output calculation 
-including key convergence variables of an optimization. 
+Generate an interactive figure for a multiple gaussian output calculation
+including key convergence variables of an optimization. With --scalable the
+figure is split into a light html page, a shared plotly.js bundle and a
+compact data file with the (downsampled) series of each output, which are only
+drawn, with WebGL, when the output is selected.
 """
 
+import json
+import time
 import argparse
+import webbrowser
 from pathlib import Path
 
-from pyssian import GaussianOutFile
 from ..initialize import load_app_defaults
+from .series import ConvergenceSeries, ConvergenceFollower, iter_convergence, decimate
 
 try:
     import numpy as np
 
-    from matplotlib.cm import get_cmap
+    from matplotlib import colormaps
     from matplotlib.colors import to_hex
 
     import plotly.graph_objects as go
     from plotly.subplots import make_subplots
     from plotly.io import to_html
-except ImportError as e: 
+except ImportError as e:
     LIBRARIES_LOADED = False
     LIBRARIES_ERROR = e
 else:
     LIBRARIES_LOADED = True
 
 DEFAULTS = load_app_defaults()
+MAX_POINTS = DEFAULTS['plot.optmulti'].getint('max_points')
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+FOLLOW_INTERVAL = DEFAULTS['plot.optmulti'].getfloat('follow_interval')
+
+# (series attribute, row, col, axis title) of each panel
+PANELS = (('forces',1,1,'Maximum Force'),
+          ('rmsforces',1,2,'RMS Force'),
+          ('energies',1,3,'Energy, hartree'),
+          ('displacements',2,1,'Maximum Displacement'),
+          ('rmsdisplacements',2,2,'RMS Displacement'))
+# Index of the threshold of each criterion in ConvergenceSeries.thresholds
+THRESHOLDS = dict(forces=0,rmsforces=1,displacements=2,rmsdisplacements=3)
+
+SCALABLE_SCRIPT = """
+var gd = document.getElementById('{plot_id}');
+var loader = document.createElement('script');
+loader.src = '@SIDECAR@';
+loader.onload = function(){
+    var data = window.PYSSIANUTILS_OPTMULTI;
+    var loaded = {};
+    function load(name){
+        if (name in loaded) { return; }
+        var traces = data.panels.map(function(panel,k){
+            var xy = data.series[name][panel.key];
+            return {type:'scattergl', mode:'lines+markers',
+                    x:xy[0], y:xy[1], xaxis:panel.xaxis, yaxis:panel.yaxis,
+                    name:name, legendgroup:name, showlegend:(k == 0),
+                    hoverinfo:'skip', line:{color:data.colors[name]},
+                    marker:{color:data.colors[name], size:data.marker_size,
+                            opacity:data.marker_opacity}};
+        });
+        var start = gd.data.length;
+        loaded[name] = traces.map(function(t,k){ return start+k; });
+        Plotly.addTraces(gd,traces);
+    }
+    function show(selected){
+        var names = (selected === '') ? data.names : [selected];
+        names.forEach(load);
+        var indices = [];
+        var visible = [];
+        data.names.forEach(function(name){
+            if (!(name in loaded)) { return; }
+            loaded[name].forEach(function(i){
+                indices.push(i);
+                visible.push(names.indexOf(name) >= 0);
+            });
+        });
+        Plotly.restyle(gd,{visible:visible},indices);
+    }
+    var select = document.createElement('select');
+    select.add(new Option('All',''));
+    data.names.forEach(function(name){ select.add(new Option(name,name)); });
+    select.onchange = function(){ show(select.value); };
+    gd.parentNode.insertBefore(select,gd);
+    if (data.names.length) {
+        select.value = data.names[0];
+        show(data.names[0]);
+    }
+};
+document.head.appendChild(loader);
+"""
 
+RELOAD_SCRIPT = "setTimeout(function(){ window.location.reload(); }, @INTERVAL@);"
 
 # Utility Functions
-def get_energy(l502,l508):
-    if l508.energy is not None: 
-        return l508.energy
-    return l502.energy
-
-def parse_gaussian_data(ifile):
-
-    with GaussianOutFile(ifile) as GOF:
-            GOF.read()
-    
-    if len(GOF) > 1: 
-        links_502 = GOF[0].get_links(502) + GOF[1].get_links(502)
-        links_508 = GOF[0].get_links(508) + GOF[1].get_links(508) 
-        links_103 = GOF[0].get_links(103) + GOF[1].get_links(103)[1:]
-    else:
-        links_502 = GOF[0].get_links(502)
-        links_508 = GOF[0].get_links(508)
-        links_103 = GOF[0].get_links(103)
-    
-    has_508 = len(links_508) > 0
-
-    energies = []
-    forces = []
-    rmsforces = []
-    displacements = []
-    rmsdisplacements = []
-    #Maximum Displacement     0.723929     0.001800     NO
-    thresholds = None
-    ylabels = None
-
-    _error_count = 0
-
-    if has_508:
-        items = (links_502,links_508,links_103[1:])
-    else:
-        items = (links_502,links_103[1:])
-
-    for links in zip(*items):
-        
-        l502 = links[0]
-        l103 = links[-1]
-        
-        try:
-            force,rmsforce,displacement,rmsdisplacement = l103.convergence
-        except ValueError:
-            force,rmsforce,displacement,rmsdisplacement = np.nan,np.nan,np.nan,np.nan
-            _error_count += 1
-            if _error_count >= 3: 
-                raise ValueError
-        energy = l502.energy
-
-        if has_508: 
-            l508 = links[1]
-            if l508.energy is not None: 
-                energy = l508.energy
-        energies.append(energy)
-
-        forces.append(force.Value)
-        rmsforces.append(rmsforce.Value)
-        displacements.append(displacement.Value)
-        rmsdisplacements.append(rmsdisplacement.Value)
-        if thresholds is None: 
-            thresholds = (force.Threshold, rmsforce.Threshold, 
-                        displacement.Threshold, rmsdisplacement.Threshold)
-            ylabels = (force.Item, rmsforce.Item, displacement.Item, rmsdisplacement.Item)
-
-    return energies, forces, rmsforces, displacements, rmsdisplacements, thresholds
-
-
-# Parser and main definition
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('files',help='Gaussian Output Files',nargs='+')
-parser.add_argument('--outfile',nargs='?',
-                    default=DEFAULTS['plot.optmulti']['outfile'],
-                    help="Output html file where the interactive figure will "
-                    "be written to")
-parser.add_argument('--browser',
-                    dest='in_browser',
-                    action='store_true',default=False,
-                    help="If enabled instead of saving to a file it will "
-                    "open a browser window and show the figure. To exit the "
-                    "process in the terminal remember to Ctrl+C")
-
-def main(
-         files:list[str|Path],
-         outfile:str|Path,
-         in_browser:bool=False
-         ):
-    
-    # We want to delay any errors of optional libraries to the 
-    # actual moment when they would be required
-    if not LIBRARIES_LOADED: 
-        raise LIBRARIES_ERROR
-    
-    files = [Path(f) for f in files]
+def get_colors(names:list[str],cmap_name:str) -> dict[str,str]:
+    cmap = colormaps[cmap_name].resampled(max(len(names),1))
+    return {name:to_hex(cmap(i)) for i,name in enumerate(names)}
+def read_series(files:list[Path],jobs:int=1) -> list[tuple[str,ConvergenceSeries]]:
+    """
+    Reads the convergence series of each file, in parallel if jobs > 1, 
+    skipping the ones that can not be read or that do not contain any 
+    optimization step.
+    """
+    items = []
+    for ifile,(series,error) in zip(files,iter_convergence(files,jobs)):
+        if error is not None:
+            print(f'Skipping {ifile}: {error}')
+            continue
+        if not len(series):
+            continue
+        items.append((ifile.stem,series))
+    return items
+def create_layout(thresholds:tuple[float,...]|None):
+    """
+    Creates the figure with the five panels and the convergence thresholds
+    but without any data.
+    """
     vertical_spacing    = DEFAULTS['plot.optmulti'].getfloat('vertical_spacing')
-    marker_size         = DEFAULTS['plot.optmulti'].getfloat('marker_size')
-    marker_opacity      = DEFAULTS['plot.optmulti'].getfloat('marker_opacity')
     threshold_color     = DEFAULTS['plot.optmulti']['threshold_color']
     threshold_linewidth = DEFAULTS['plot.optmulti'].getfloat('threshold_linewidth')
-    cmap_name           = DEFAULTS['plot.optmulti']['cmap_name']
 
-    # Create subplots
     fig = make_subplots(2, 4,
                         shared_xaxes=True,
                         shared_yaxes=False,
@@ -138,112 +130,56 @@ def main(
                                [{"type": "scatter"}, {"type": "scatter"}, None, None]],
                         vertical_spacing = vertical_spacing
                         )
-    #fig['layout']['xaxis']['title']  = 'iteration'
-    #fig['layout']['xaxis2']['title'] = 'iteration'
-    fig['layout']['xaxis3']['title'] = 'iteration'     # 2x2
-    fig['layout']['xaxis4']['title'] = 'iteration'    
-    fig['layout']['xaxis5']['title'] = 'iteration'
-
-    fig['layout']['yaxis']['title']  = 'Maximum Force'
-    fig['layout']['yaxis2']['title'] = 'RMS Force'
-    fig['layout']['yaxis3']['title'] = 'Energy, hartree'    # 2x2
-    fig['layout']['yaxis4']['title'] = 'Maximum Displacement'    # None
-    fig['layout']['yaxis5']['title'] = 'RMS Displacement'
-
-    cmap = get_cmap(cmap_name,len(files))
-    colors = {f.stem:to_hex(cmap(i)) for i,f in enumerate(files)}
+    for key,row,col,title in PANELS:
+        subplot = fig.get_subplot(row,col)
+        fig['layout'][subplot.yaxis.plotly_name]['title'] = title
+        if row == 2 or col == 3:
+            fig['layout'][subplot.xaxis.plotly_name]['title'] = 'iteration'
+        if thresholds is not None and key in THRESHOLDS:
+            fig.add_hline(y=thresholds[THRESHOLDS[key]], row=row, col=col,
+                          exclude_empty_subplots=False,
+                          line_color=threshold_color,
+                          line_width=threshold_linewidth)
+    fig.update_xaxes(matches='x')
+    return fig
+def build_figure(items:list[tuple[str,ConvergenceSeries]],
+                 colors:dict[str,str]):
+    """
+    Creates the figure with the traces of all the outputs and a dropdown menu
+    to select which one is shown.
+    """
+    marker_size         = DEFAULTS['plot.optmulti'].getfloat('marker_size')
+    marker_opacity      = DEFAULTS['plot.optmulti'].getfloat('marker_opacity')
+
+    thresholds = next((s.thresholds for _,s in items if s.thresholds is not None),None)
+    fig = create_layout(thresholds)
     button_list = []
 
-    thresholds = None
+    for legendname,series in items:
 
-    for ifile in files: 
-        
-        legendname = ifile.stem
         color = colors[legendname]
-        try: 
-            energies, forces, rmsforces, displacements, rmsdisplacements, _thresholds = parse_gaussian_data(ifile)
-        except (AttributeError,ValueError):
-            continue
-
-        if (not energies and 
-            not forces and 
-            not rmsforces and 
-            not displacements and
-            not rmsdisplacements):
-            continue
-        
-        if (thresholds is None) and (_thresholds is not None):
-            thresholds = _thresholds
-
-        x = [i+1 for i in range(len(energies))]
-        fig.add_trace(go.Scatter(x=x,
-                                 y=energies,
-                                 marker=dict(color=color,opacity=marker_opacity,size=marker_size),
-                                 line=dict(color=color),
-                                 mode='lines+markers',
-                                 hoverinfo='skip',
-                                 name=legendname,
-                                 legendgroup=legendname,
-                                 showlegend=True),
-                     row=1,col=3)
-        fig.add_trace(go.Scatter(x=x,
-                                 y=forces,
-                                 marker=dict(color=color,opacity=marker_opacity,size=marker_size),
-                                 line=dict(color=color),
-                                 mode='lines+markers',
-                                 hoverinfo='skip',
-                                 name=legendname,
-                                 legendgroup=legendname,
-                                 showlegend=False),
-                     row=1,col=1)
-        fig.add_trace(go.Scatter(x=x,
-                                 y=rmsforces,
-                                 marker=dict(color=color,opacity=marker_opacity,size=marker_size),
-                                 line=dict(color=color),
-                                 mode='lines+markers',
-                                 hoverinfo='skip',
-                                 name=legendname,
-                                 legendgroup=legendname,
-                                 showlegend=False),
-                     row=1,col=2)
-        fig.add_trace(go.Scatter(x=x,
-                                 y=displacements,
-                                 marker=dict(color=color,opacity=marker_opacity,size=marker_size),
-                                 line=dict(color=color),
-                                 mode='lines+markers',
-                                 hoverinfo='skip',
-                                 name=legendname,
-                                 legendgroup=legendname,
-                                 showlegend=False),
-                     row=2,col=1)
-        fig.add_trace(go.Scatter(x=x,
-                                 y=rmsdisplacements,
-                                 marker=dict(color=color,opacity=marker_opacity,size=marker_size),
-                                 line=dict(color=color),
-                                 mode='lines+markers',
-                                 hoverinfo='skip',
-                                 name=legendname,
-                                 legendgroup=legendname,
-                                 showlegend=False),
-                     row=2,col=2)
+        x = [i+1 for i in range(len(series))]
+        for key,row,col,_ in PANELS:
+            fig.add_trace(go.Scatter(x=x,
+                                     y=getattr(series,key),
+                                     marker=dict(color=color,opacity=marker_opacity,size=marker_size),
+                                     line=dict(color=color),
+                                     mode='lines+markers',
+                                     hoverinfo='skip',
+                                     name=legendname,
+                                     legendgroup=legendname,
+                                     showlegend=(key == 'energies')),
+                          row=row,col=col)
 
         button_list.append(legendname)
-    
-    #if thresholds is not None:
-    fig.add_hline(y=thresholds[0], row=1, col=1, line_color=threshold_color, line_width=threshold_linewidth)
-    fig.add_hline(y=thresholds[1], row=1, col=2, line_color=threshold_color, line_width=threshold_linewidth)
-    fig.add_hline(y=thresholds[2], row=2, col=1, line_color=threshold_color, line_width=threshold_linewidth)
-    fig.add_hline(y=thresholds[3], row=2, col=2, line_color=threshold_color, line_width=threshold_linewidth)
-
-    fig.update_xaxes(matches='x')
 
     updatemenus=[dict(active=0,buttons=[]),]
     buttons = updatemenus[0]['buttons']
 
-    ntraces_per_item = 5
+    ntraces_per_item = len(PANELS)
     total_traces = ntraces_per_item*len(button_list)
 
-    for i,button_label in enumerate(button_list): 
+    for i,button_label in enumerate(button_list):
         visible = [False,]*total_traces
         start = ntraces_per_item*i
         stop = ntraces_per_item*(i+1)
@@ -251,7 +187,7 @@ def main(
         button = dict(method='update',
                       label=button_label,
                       visible=True,
-                      args=[{"visible": visible*5}])
+                      args=[{"visible": visible}])
         buttons.append(button)
 
     # add a button to toggle all traces on and off
@@ -259,18 +195,194 @@ def main(
                 label='All',
                 visible=True,
                 args=[{'visible':True}])
-    
+
     buttons.append(button)
 
     # add dropdown menus to the figure
     fig.update_layout(updatemenus=updatemenus)
 
-    # LEGACY CODE:
-    #if enable_legend:
-    #    fig.update_layout(showlegend=True)
+    return fig
+def compact(values:np.ndarray,digits:int) -> list[float|None]:
+    """
+    Rounds the values to the significant digits and replaces nan with None
+    so that they are written as null in json.
+    """
+    return [None if np.isnan(v) else float(f'{v:.{digits}g}') for v in values]
+def scalable_data(fig,
+                  items:list[tuple[str,ConvergenceSeries]],
+                  colors:dict[str,str],
+                  max_points:int=MAX_POINTS) -> dict:
+    """
+    Data of the sidecar file of the scalable figure: the downsampled series
+    of each output and the axes of each panel of the figure.
+    """
+    panels = []
+    for key,row,col,_ in PANELS:
+        subplot = fig.get_subplot(row,col)
+        panels.append(dict(key=key,
+                           xaxis=subplot.xaxis.plotly_name.replace('axis',''),
+                           yaxis=subplot.yaxis.plotly_name.replace('axis','')))
+    series = dict()
+    for name,item in items:
+        x = np.arange(1,len(item)+1,dtype=np.float64)
+        series[name] = dict()
+        for key,_,_,_ in PANELS:
+            threshold = None
+            if item.thresholds is not None and key in THRESHOLDS:
+                threshold = item.thresholds[THRESHOLDS[key]]
+            _x, _y = decimate(x,getattr(item,key),max_points,threshold)
+            digits = 12 if key == 'energies' else 6
+            series[name][key] = [[int(i) for i in _x],compact(_y,digits)]
+    return dict(names=[name for name,_ in items],
+                colors=colors,
+                panels=panels,
+                series=series,
+                marker_size=DEFAULTS['plot.optmulti'].getfloat('marker_size'),
+                marker_opacity=DEFAULTS['plot.optmulti'].getfloat('marker_opacity'))
+def write_scalable(items:list[tuple[str,ConvergenceSeries]],
+                   outfile:Path,
+                   colors:dict[str,str],
+                   max_points:int=MAX_POINTS,
+                   refresh:float|None=None) -> Path:
+    """
+    Writes the html page, the data file next to it ({outfile stem}.data.js)
+    and plotly.min.js, shared by all the figures in the same folder. If 
+    refresh is provided the page reloads itself every refresh seconds. Returns
+    the path of the data file.
+    """
+    thresholds = next((s.thresholds for _,s in items if s.thresholds is not None),None)
+    fig = create_layout(thresholds)
+    # The data is wrapped in a script instead of a plain json so that
+    # it can be loaded when the page is opened from the filesystem
+    sidecar = outfile.with_name(f'{outfile.stem}.data.js')
+    data = scalable_data(fig,items,colors,max_points)
+    with open(sidecar,'w') as F:
+        F.write('window.PYSSIANUTILS_OPTMULTI = ')
+        json.dump(data,F,separators=(',',':'))
+        F.write(';\n')
+    scripts = [SCALABLE_SCRIPT.replace('@SIDECAR@',sidecar.name),]
+    if refresh is not None:
+        scripts.append(RELOAD_SCRIPT.replace('@INTERVAL@',str(int(refresh*1000))))
+    fig.write_html(outfile,include_plotlyjs='directory',post_script=scripts)
+    return sidecar
+
+
+# Parser and main definition
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('files',help='Gaussian Output Files',nargs='+')
+parser.add_argument('--outfile',nargs='?',
+                    default=DEFAULTS['plot.optmulti']['outfile'],
+                    help="Output html file where the interactive figure will "
+                    "be written to")
+parser.add_argument('--browser',
+                    dest='in_browser',
+                    action='store_true',default=False,
+                    help="If enabled instead of saving to a file it will "
+                    "open a browser window and show the figure. To exit the "
+                    "process in the terminal remember to Ctrl+C")
+parser.add_argument('--scalable',
+                    action='store_true',default=False,
+                    help="Write the figure as an html page that loads the "
+                    "traces of each output on demand from a data file next "
+                    "to it and draws them with WebGL. Suited for hundreds "
+                    "of outputs or very long optimizations")
+parser.add_argument('--max-points',
+                    type=int,default=MAX_POINTS,
+                    help="With --scalable, longer series are downsampled to "
+                    "about this number of points, always keeping the steps "
+                    f"where a criterion crosses its threshold, by default {MAX_POINTS}")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of parallel processes used to read the "
+                    f"outputs, by default {DEFAULT_JOBS}")
+parser.add_argument('--follow',
+                    action='store_true',default=False,
+                    help="Keep watching running calculations and write the "
+                    "figure again whenever new steps are written to any of "
+                    "them. Only the text appended to the outputs is parsed "
+                    "and the html page reloads itself. Stop with Ctrl+C")
+parser.add_argument('--interval',
+                    type=float,default=FOLLOW_INTERVAL,
+                    help="Seconds between checks of the outputs with --follow, "
+                    f"by default {FOLLOW_INTERVAL}")
+
+def main(
+         files:list[str|Path],
+         outfile:str|Path,
+         in_browser:bool=False,
+         scalable:bool=False,
+         max_points:int=MAX_POINTS,
+         jobs:int=DEFAULT_JOBS,
+         follow:bool=False,
+         interval:float=FOLLOW_INTERVAL
+         ):
+
+    # We want to delay any errors of optional libraries to the
+    # actual moment when they would be required
+    if not LIBRARIES_LOADED:
+        raise LIBRARIES_ERROR
+
+    files = [Path(f) for f in files]
+    cmap_name           = DEFAULTS['plot.optmulti']['cmap_name']
 
-    if in_browser: 
+    colors = get_colors([f.stem for f in files],cmap_name)
+    if follow:
+        _main_follow(files,Path(outfile),colors,in_browser,scalable,max_points,interval)
+        return
+    items = read_series(files,jobs)
+
+    if scalable:
+        outfile = Path(outfile)
+        sidecar = write_scalable(items,outfile,colors,max_points)
+        print(f'Figure written to {outfile} with the data in {sidecar}')
+        if in_browser:
+            webbrowser.open(outfile.resolve().as_uri())
+        return
+
+    fig = build_figure(items,colors)
+
+    if in_browser:
         fig.show()
     else:
-        with open(outfile,'w') as F: 
+        with open(outfile,'w') as F:
             F.write(to_html(fig))
+
+def _main_follow(files:list[Path],
+                 outfile:Path,
+                 colors:dict[str,str],
+                 in_browser:bool=False,
+                 scalable:bool=False,
+                 max_points:int=MAX_POINTS,
+                 interval:float=FOLLOW_INTERVAL):
+
+    followers = [ConvergenceFollower(f) for f in files]
+    opened = False
+    try:
+        while True:
+            updated = [follower.update() for follower in followers]
+            if any(updated):
+                items = []
+                for follower in followers:
+                    try:
+                        series = follower.series
+                    except (AttributeError,ValueError):
+                        continue
+                    if len(series):
+                        items.append((follower.ifile.stem,series))
+                if scalable:
+                    write_scalable(items,outfile,colors,max_points,interval)
+                else:
+                    script = RELOAD_SCRIPT.replace('@INTERVAL@',str(int(interval*1000)))
+                    fig = build_figure(items,colors)
+                    fig.write_html(outfile,include_plotlyjs='directory',post_script=script)
+                steps = sum(len(series) for _,series in items)
+                print(f'writing -> {outfile} ({steps} steps of {len(items)} outputs)')
+                if in_browser and not opened:
+                    webbrowser.open(outfile.resolve().as_uri())
+                    opened = True
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for follower in followers:
+            follower.close()
@@ -1,18 +1,25 @@
 """
 Generate a figure for a single gaussian output calculation including key 
-convergence variables of an optimization. 
+convergence variables of an optimization. When several files or folders (with
+-r) are provided, a figure is generated for each output in parallel, skipping
+the ones whose figure is newer than the output, and optionally all of them are
+assembled in a multipage pdf.
 """
 
+import os
+import time
 import argparse
 import warnings
 from pathlib import Path
 
-from pyssian import GaussianOutFile
 from ..initialize import load_app_defaults
+from ..utils import DirectoryTree, run_in_pool
+from .series import ConvergenceSeries, ConvergenceFollower, load_convergence
 
 try:
     import matplotlib
     import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
 except ImportError as e: 
     LIBRARIES_LOADED = False
     LIBRARIES_ERROR = e
@@ -23,20 +30,138 @@ DEFAULTS = load_app_defaults()
 WIDTH = DEFAULTS['plot.optview'].getfloat('width')
 HEIGHT = DEFAULTS['plot.optview'].getfloat('height')
 DPI = DEFAULTS['plot.optview'].getfloat('dpi')
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+FOLLOW_INTERVAL = DEFAULTS['plot.optview'].getfloat('follow_interval')
 
 
 # Utility Functions
-def get_energy(l502,l508):
-    if l508.energy is not None: 
-        return l508.energy
-    return l502.energy
+def find_outputs(paths:list[Path],
+                 recursive:bool=False,
+                 suffix:str=GAUSSIAN_OUTPUT_SUFFIX) -> list[Path]:
+    files = []
+    for path in map(Path,paths):
+        if path.is_dir():
+            if not recursive:
+                raise ValueError(f'{path} is a folder, use -r to search it recursively')
+            tree = DirectoryTree(path,GAUSSIAN_INPUT_SUFFIX,suffix)
+            files.extend(Path(f) for f in tree.outfiles)
+        else:
+            files.append(path)
+    return sorted(set(files))
+def is_up_to_date(ifile:Path,outfile:Path) -> bool:
+    return outfile.exists() and os.stat(outfile).st_mtime >= os.stat(ifile).st_mtime
+def draw_convergence(series:ConvergenceSeries,
+                     width:float=WIDTH,
+                     height:float=HEIGHT,
+                     dpi:float|None=None,
+                     title:str|None=None,
+                     fig=None):
+    """
+    Creates the figure with the four convergence criteria and the energy of 
+    each step of an optimization. If a figure is provided it is cleared and
+    drawn again instead of creating a new one.
+    """
+    if fig is not None:
+        fig.clf()
+    elif dpi is None:
+        fig = plt.figure(figsize=(width,height))
+    else: 
+        fig = plt.figure(figsize=(width,height),dpi=dpi)
+
+    # We create the grid_A
+    gridspec_A_kwds = dict()
+    gridspec_A_kwds['left'] = DEFAULTS['plot.optview.gridA'].getfloat('left')
+    gridspec_A_kwds['right'] = DEFAULTS['plot.optview.gridA'].getfloat('right')
+    gridspec_A_kwds['top'] = DEFAULTS['plot.optview.gridA'].getfloat('top')
+    gridspec_A_kwds['bottom'] = DEFAULTS['plot.optview.gridA'].getfloat('bottom')
+    gridspec_A_kwds['ncols'] = 2
+    gridspec_A_kwds['nrows'] = 2
+    gridspec_A_kwds['hspace'] = DEFAULTS['plot.optview.gridA'].getfloat('hspace')
+    gridspec_A_kwds['wspace'] = DEFAULTS['plot.optview.gridA'].getfloat('wspace')
+
+    subgrid = fig.add_gridspec(**gridspec_A_kwds)
+
+    # We create the grid_B
+    gridspec_B_kwds = dict()
+    gridspec_B_kwds['left'] = DEFAULTS['plot.optview.gridB'].getfloat('left')
+    gridspec_B_kwds['right'] = DEFAULTS['plot.optview.gridB'].getfloat('right')
+    gridspec_B_kwds['top'] = DEFAULTS['plot.optview.gridB'].getfloat('top')
+    gridspec_B_kwds['bottom'] = DEFAULTS['plot.optview.gridB'].getfloat('bottom')
+
+    grid_B = fig.add_gridspec(**gridspec_B_kwds)
+
+    # Now we create the axes
+    ax_A00 = fig.add_subplot(subgrid[0,0])
+    ax_A01 = fig.add_subplot(subgrid[0,1])
+    ax_A10 = fig.add_subplot(subgrid[1,0])
+    ax_A11 = fig.add_subplot(subgrid[1,1])
+    A_axes = [ax_A00,ax_A10,ax_A01,ax_A11]
+    ax_B = fig.add_subplot(grid_B[0])
+
+    # Drawing
+    x = [i+1 for i in range(len(series))]
+
+    # Energies
+    color_B = DEFAULTS['plot.optview.gridB']['color']
+    size_B = DEFAULTS['plot.optview.gridB'].getfloat('scattersize')
+    ax_B.plot(x,series.energies,color=color_B)
+    ax_B.scatter(x,series.energies, facecolor=color_B, s=size_B)
+    ax_B.set_xlabel('iteration')
+    ax_B.set_ylabel('energy, hartree')
+    if title is not None:
+        ax_B.set_title(title)
+
+    if series.thresholds is None:
+        return fig
+
+    # Convergence
+    color_A = DEFAULTS['plot.optview.gridA']['color']
+    threshold_color_A = DEFAULTS['plot.optview.gridA']['threshold_color']
+    size_A = DEFAULTS['plot.optview.gridA'].getfloat('scattersize')
+    xlims = min(x), max(x)
+    for ax,t,yl,y in zip(A_axes,series.thresholds,series.labels,series.criteria):
+        ax.hlines([t,],xlims[0],xlims[1],color=threshold_color_A)
+        ax.set_ylabel(yl)
+        ax.set_xlabel('iteration')
+        ax.plot(x,y,color=color_A)
+        ax.scatter(x,y,facecolor=color_A,s=size_A)
+
+    return fig
+def render_file(ifile:Path,
+                outfile:Path|None,
+                width:float=WIDTH,
+                height:float=HEIGHT,
+                dpi:float=DPI,
+                keep_series:bool=False) -> ConvergenceSeries|None:
+    """
+    Writes the figure of an output with the non-interactive Agg backend. If 
+    outfile is None only the series are read. Returns the series if 
+    keep_series is True.
+    """
+    series = load_convergence(ifile)
+    if not len(series):
+        raise ValueError('No optimization steps found')
+    if outfile is not None:
+        matplotlib.use('Agg')
+        fig = draw_convergence(series,width,height,dpi)
+        fig.savefig(outfile,dpi=dpi)
+        plt.close(fig)
+    if keep_series:
+        return series
+    return None
 
 # Parser and main definition
 parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('ifile',help='Gaussian Output File')
+parser.add_argument('files',
+                    nargs='+',
+                    help='Gaussian Output Files (or folders with -r)')
 parser.add_argument('--outfile',
                     nargs='?',default=Path('screen.png'),
-                    help='Output image file')
+                    help="Output image file. When several files are provided "
+                    "the figure of each one is written next to it (or in "
+                    "--outdir) with the same name and the suffix of the outfile")
 parser.add_argument('--width',
                     type=float,default=WIDTH,
                     help=f'figure width in inches (default {WIDTH})')
@@ -56,20 +181,67 @@ else:
                         dest='is_interactive',
                         action='store_true',default=False,
                         help="Instead of writing to a file open a window showing the figure")
+batch = parser.add_argument_group('batch options')
+batch.add_argument('-r','--recursive',
+                   action='store_true',default=False,
+                   help="Search the output files recursively in the folders provided")
+batch.add_argument('--outdir',
+                   type=Path,default=None,
+                   help="Folder where the figures are written, by default "
+                   "next to each output")
+batch.add_argument('--pdf',
+                   type=Path,default=None,
+                   help="Also assemble the figures of all the outputs as the "
+                   "pages of this pdf file")
+batch.add_argument('--force',
+                   action='store_true',default=False,
+                   help="Write the figures even if they are newer than the outputs")
+batch.add_argument('-j','--jobs',
+                   type=int,default=DEFAULT_JOBS,
+                   help="Number of parallel processes used to draw the "
+                   f"figures, by default {DEFAULT_JOBS}")
+parser.add_argument('--follow',
+                    action='store_true',default=False,
+                    help="Keep watching a running calculation and update the "
+                    "figure (the window with --interactive or the outfile "
+                    "otherwise) whenever new steps are written. Only the text "
+                    "appended to the output is parsed. Stop with Ctrl+C")
+parser.add_argument('--interval',
+                    type=float,default=FOLLOW_INTERVAL,
+                    help="Seconds between checks of the output with --follow, "
+                    f"by default {FOLLOW_INTERVAL}")
 
 def main(
-        ifile:str|Path,
-        outfile:str|Path,
+        files:list[str|Path],
+        outfile:str|Path=Path('screen.png'),
         width:float=WIDTH,
         height:float=HEIGHT,
         dpi:float=DPI,
-        is_interactive:bool=False
+        is_interactive:bool=False,
+        recursive:bool=False,
+        outdir:Path|None=None,
+        pdf:Path|None=None,
+        force:bool=False,
+        jobs:int=DEFAULT_JOBS,
+        follow:bool=False,
+        interval:float=FOLLOW_INTERVAL,
         ):
     
     # We want to delay any errors of optional libraries to the 
     # actual moment when they would be required
     if not LIBRARIES_LOADED: 
         raise LIBRARIES_ERROR
+
+    files = find_outputs(files,recursive)
+    if follow:
+        if len(files) > 1:
+            raise ValueError("--follow requires a single output, use 'plot optmulti --follow' for several")
+        _main_follow(files[0],Path(outfile),width,height,dpi,is_interactive,interval)
+        return
+    if len(files) > 1 or recursive or outdir is not None or pdf is not None:
+        _main_batch(files,Path(outfile).suffix,width,height,dpi,outdir,pdf,force,jobs)
+        return
+    ifile = files[0]
     
     if Path(outfile).suffix == '.svg':
         matplotlib.rcParams['svg.fonttype'] = 'none'
@@ -81,105 +253,113 @@ def main(
               "fontsizes and relative positions are not respected.")
         warnings.warn(msg)
     
-    with GaussianOutFile(ifile) as GOF:
-        GOF.read()
-
-    if len(GOF) > 1: 
-        links_502 = GOF[0].get_links(502) + GOF[1].get_links(502)
-        links_508 = GOF[0].get_links(508) + GOF[1].get_links(508) 
-        links_103 = GOF[0].get_links(103) + GOF[1].get_links(103)[1:]
-    else:
-        links_502 = GOF[0].get_links(502)
-        links_508 = GOF[0].get_links(508)
-        links_103 = GOF[0].get_links(103)
-
-    energies = []
-    forces = []
-    rmsforces = []
-    displacements = []
-    rmsdisplacements = []
-    #Maximum Displacement     0.723929     0.001800     NO 
-    thresholds = None
-    ylabels = None
-
-    for l502,l508,l103 in zip(links_502,links_508,links_103[1:]): 
-        force,rmsforce,displacement,rmsdisplacement = l103.convergence
-        energy = l502.energy
-        if l508.energy is not None: 
-            energy = l508.energy
-        energies.append(energy)
-
-        forces.append(force.Value)
-        rmsforces.append(rmsforce.Value)
-        displacements.append(displacement.Value)
-        rmsdisplacements.append(rmsdisplacement.Value)
-        if thresholds is None: 
-            thresholds = (force.Threshold, rmsforce.Threshold, 
-                        displacement.Threshold, rmsdisplacement.Threshold)
-            ylabels = (force.Item, rmsforce.Item, displacement.Item, rmsdisplacement.Item)
+    series = load_convergence(ifile)
 
     # prepare figure
     if is_interactive:
-        fig = plt.figure(figsize=(width,height))
+        fig = draw_convergence(series,width,height)
     else: 
-        fig = plt.figure(figsize=(width,height),dpi=dpi)
+        fig = draw_convergence(series,width,height,dpi)
 
-    # We create the grid_A
-    gridspec_A_kwds = dict()
-    gridspec_A_kwds['left'] = DEFAULTS['plot.optview.gridA'].getfloat('left')
-    gridspec_A_kwds['right'] = DEFAULTS['plot.optview.gridA'].getfloat('right')
-    gridspec_A_kwds['top'] = DEFAULTS['plot.optview.gridA'].getfloat('top')
-    gridspec_A_kwds['bottom'] = DEFAULTS['plot.optview.gridA'].getfloat('bottom')
-    gridspec_A_kwds['ncols'] = 2
-    gridspec_A_kwds['nrows'] = 2
-    gridspec_A_kwds['hspace'] = DEFAULTS['plot.optview.gridA'].getfloat('hspace')
-    gridspec_A_kwds['wspace'] = DEFAULTS['plot.optview.gridA'].getfloat('wspace')
+    if is_interactive:
+        plt.show(block=True)
+    else:
+        print(f'writing -> {outfile}')
+        fig.savefig(outfile,dpi=dpi)
 
-    subgrid = grid_A = fig.add_gridspec(**gridspec_A_kwds)
+def _main_batch(files:list[Path],
+                suffix:str,
+                width:float=WIDTH,
+                height:float=HEIGHT,
+                dpi:float=DPI,
+                outdir:Path|None=None,
+                pdf:Path|None=None,
+                force:bool=False,
+                jobs:int=DEFAULT_JOBS):
 
-    # We create the grid_B
-    gridspec_B_kwds = dict()
-    gridspec_B_kwds['left'] = DEFAULTS['plot.optview.gridB'].getfloat('left')
-    gridspec_B_kwds['right'] = DEFAULTS['plot.optview.gridB'].getfloat('right')
-    gridspec_B_kwds['top'] = DEFAULTS['plot.optview.gridB'].getfloat('top')
-    gridspec_B_kwds['bottom'] = DEFAULTS['plot.optview.gridB'].getfloat('bottom')
-
-    grid_B = fig.add_gridspec(**gridspec_B_kwds)
+    matplotlib.use('Agg')
+    if suffix == '.svg':
+        matplotlib.rcParams['svg.fonttype'] = 'none'
+    if outdir is not None:
+        outdir.mkdir(parents=True,exist_ok=True)
 
-    # Now we create the axes
-    ax_A00 = fig.add_subplot(subgrid[0,0])
-    ax_A01 = fig.add_subplot(subgrid[0,1])
-    ax_A10 = fig.add_subplot(subgrid[1,0])
-    ax_A11 = fig.add_subplot(subgrid[1,1])
-    A_axes = [ax_A00,ax_A10,ax_A01,ax_A11]
-    ax_B = fig.add_subplot(grid_B[0])
+    tasks = []
+    skipped = 0
+    for ifile in files:
+        folder = ifile.parent if outdir is None else outdir
+        outfile = folder/f'{ifile.stem}{suffix}'
+        if not force and is_up_to_date(ifile,outfile):
+            skipped += 1
+            if pdf is None:
+                continue
+            outfile = None
+        tasks.append((ifile,outfile,width,height,dpi,pdf is not None))
 
-    # Drawing
-    x = [i+1 for i in range(len(energies))]
+    errors = []
+    written = 0
+    pages = PdfPages(pdf) if pdf is not None else None
+    for task,(series,error) in zip(tasks,run_in_pool(render_file,tasks,jobs)):
+        ifile, outfile = task[:2]
+        if error is not None:
+            print(f'Error drawing {ifile}: {error}')
+            errors.append(ifile)
+            continue
+        if outfile is not None:
+            print(f'writing -> {outfile}')
+            written += 1
+        if pages is not None:
+            fig = draw_convergence(series,width,height,title=ifile.stem)
+            pages.savefig(fig)
+            plt.close(fig)
+    if pages is not None:
+        pages.close()
+        print(f'writing -> {pdf}')
 
-    # Energies
-    color_B = DEFAULTS['plot.optview.gridB']['color']
-    size_B = DEFAULTS['plot.optview.gridB'].getfloat('scattersize')
-    ax_B.plot(x,energies,color=color_B)
-    ax_B.scatter(x,energies, facecolor=color_B, s=size_B)
-    ax_B.set_xlabel('iteration')
-    ax_B.set_ylabel('energy, hartree')
+    print(f'{written} figures written, {skipped} up to date, {len(errors)} failed')
+    if errors:
+        raise RuntimeError(f'{len(errors)} files could not be processed')
 
-    # Convergence
-    color_A = DEFAULTS['plot.optview.gridA']['color']
-    threshold_color_A = DEFAULTS['plot.optview.gridA']['threshold_color']
-    size_A = DEFAULTS['plot.optview.gridA'].getfloat('scattersize')
-    xlims = min(x), max(x)
-    yvals = [forces,rmsforces,displacements,rmsdisplacements]
-    for ax,t,yl,y in zip(A_axes,thresholds,ylabels,yvals):
-        ax.hlines([t,],xlims[0],xlims[1],color=threshold_color_A)
-        ax.set_ylabel(yl)
-        ax.set_xlabel('iteration')
-        ax.plot(x,y,color=color_A)
-        ax.scatter(x,y,facecolor=color_A,s=size_A)
+def _main_follow(ifile:Path,
+                 outfile:Path,
+                 width:float=WIDTH,
+                 height:float=HEIGHT,
+                 dpi:float=DPI,
+                 is_interactive:bool=False,
+                 interval:float=FOLLOW_INTERVAL):
 
     if is_interactive:
-        plt.show(block=True)
+        plt.ion()
     else:
-        print(f'writing -> {outfile}')
-        fig.savefig(outfile,dpi=dpi)
\ No newline at end of file
+        matplotlib.use('Agg')
+    if outfile.suffix == '.svg':
+        matplotlib.rcParams['svg.fonttype'] = 'none'
+
+    follower = ConvergenceFollower(ifile)
+    fig = None
+    try:
+        while True:
+            series = None
+            if follower.update():
+                # The tables may not be readable until the output is updated
+                try:
+                    series = follower.series
+                except (AttributeError,ValueError):
+                    pass
+            if series is not None and len(series):
+                if is_interactive:
+                    fig = draw_convergence(series,width,height,title=ifile.stem,fig=fig)
+                    fig.canvas.draw_idle()
+                else:
+                    fig = draw_convergence(series,width,height,dpi,fig=fig)
+                    fig.savefig(outfile,dpi=dpi)
+                    print(f'writing -> {outfile} ({len(series)} steps)')
+            if not is_interactive:
+                time.sleep(interval)
+            elif fig is not None and not plt.fignum_exists(fig.number):
+                break # The window was closed
+            else:
+                plt.pause(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        follower.close()
@@ -1,17 +1,22 @@
 """
 Generate a quick figure for a single property of a single gaussian output 
-calculation file. 
+calculation file or of a trajectory store generated with 
+'pyssianutils toxyz --format npy'. 
 """
 
 import argparse
 from pathlib import Path
 
 from pyssian import GaussianOutFile
-from pyssian.classutils import Geometry
 from pyssian.chemistryutils import is_method
 
 from ..utils import ALLOWEDMETHODS, potential_energies
+from ..geometry import (stack_coordinates, parse_definition, measure, label, 
+                        atomic_numbers_from_L202, suggest_coordinates, 
+                        all_bonded_definitions, KINDS, UNITS)
+from ..trajectory import Trajectory, is_store
 from ..initialize import load_app_defaults
+from .cache import load_or_extract
 
 try:
     import numpy as np
@@ -28,6 +33,8 @@ DEFAULTS = load_app_defaults()
 DEFAULT_OUTFILE = Path(DEFAULTS['plot.property']['outfile'])
 DEFAULT_PLOT = DEFAULTS['plot.property']['default_plot']
 DEFAULT_COLOR = DEFAULTS['plot.property']['color']
+# Increase whenever the series extracted from the same output change
+EXTRACTOR_VERSION = 1
 
 # Utility functions
 def guess_method(GOF:GaussianOutFile): 
@@ -44,37 +51,12 @@ def guess_method(GOF:GaussianOutFile):
         return method
     else: 
         return 'default'
-def angle_between(v1:np.array,v2:np.array):
-    # Computes the angle between two vectors
-    # Inputs two vectors numpy.array and returns the angle in radians
-    # Handles vector with the same direction
-    # Requires numpy library
-    # Reference:   "http://stackoverflow.com/a/13849249/71522"
-    n1 = np.linalg.norm(v1)
-    n2 = np.linalg.norm(v2)
-    if n1!=0 and n2!=0:
-        v1_u = v1/n1
-        v2_u = v2/n2
-        return np.arccos(np.clip(np.dot(v1_u, v2_u),-1.0,1.0))
-    else:
-        return 0
-def get_dihedral(i:np.array,j:np.array,k:np.array,l:np.array):
-    # Inputs 4 Points as numpy.array and returns the dihedral between the
-    # planes ijk and jkl in radians
-    # Get the normal vector for the planes
-    nijk = np.cross(i-j,k-j)
-    njkl = np.cross(j-k,l-k)
-    # Get vector normal to both normal vectors
-    normal = np.cross(nijk,njkl)
-    # Calculate angle using the function already defined
-    dihedral = angle_between(nijk,njkl)
-    # Assign sign criteria
-    if np.dot(normal,j-k) < 0.0:
-        dihedral = -dihedral
-    return dihedral
-
 def add_common_arguments(parser:argparse.ArgumentParser): 
-    parser.add_argument('ifile',help='Gaussian Output File')
+    parser.add_argument('ifile',help='Gaussian Output File or trajectory store')
+    parser.add_argument('--source',
+                        default=None,
+                        help="Only for trajectory stores, use only the frames "
+                        "that come from this file. By default all the frames")
     parser.add_argument('--outfile',
                         default=DEFAULT_OUTFILE,
                         help='Output image file')
@@ -119,12 +101,26 @@ geometry = subparsers.add_parser('geometry',
                                  help="Draw a geometric parameter that may "
                                  "not be a internal parameter. If 2 atom "
                                  "ids are provided it will assume that it is a "
-                                 "distance, 3 for an angle and 4 for a dihedral")
+                                 "distance, 3 for an angle and 4 for a dihedral. "
+                                 "If none are provided it suggests the ones "
+                                 "that changed the most")
 add_common_arguments(geometry)
 geometry.add_argument('atoms',
-                      nargs='+',type=int,
+                      nargs='*',type=int,
                       help="Atom numerical ids following the convention: "
                       "first atom = 1")
+geometry.add_argument('-c','--coordinate',
+                      dest='coordinates',
+                      action='append',nargs='+',type=int,default=None,
+                      help="Atom ids of an additional parameter to draw in the "
+                      "same figure. Can be used multiple times")
+geometry.add_argument('--all',
+                      dest='dump_all',
+                      action='store_true',default=False,
+                      help="Instead of drawing, write a csv file (the outfile "
+                      "with suffix .csv) with the values at each step of all "
+                      "the internal coordinates defined in the output or, if "
+                      "there are none, of all the ones between bonded atoms")
 
 def main(
          ifile:str|Path,
@@ -137,6 +133,21 @@ def main(
          **kwargs):  
     
     assert DEFAULT_PLOT in ['line','scatter','both']
+    # Writing the csv or the suggestions does not require matplotlib
+    source = kwargs.pop('source',None)
+    dump_all = kwargs.pop('dump_all',False)
+    if target == 'geometry' and (dump_all or not (kwargs['atoms'] or kwargs['coordinates'])):
+        xyz, atomic_numbers, definitions = load_geometries(ifile,source)
+        if not dump_all:
+            print_suggestions(xyz,atomic_numbers)
+            return
+        if not definitions:
+            definitions = all_bonded_definitions(xyz[-1],atomic_numbers)
+        csvfile = Path(outfile).with_suffix('.csv')
+        print(f'writing -> {csvfile}')
+        dump_internal_coordinates(xyz,definitions,csvfile)
+        return
+
     # We want to delay any errors of optional libraries to the 
     # actual moment when they would be required
     if not LIBRARIES_LOADED: 
@@ -144,21 +155,27 @@ def main(
     
     if Path(outfile).suffix == '.svg':
         matplotlib.rcParams['svg.fonttype'] = 'none'
-        
-    with GaussianOutFile(ifile) as GOF: 
-        GOF.read()
 
-    match target:
-        case 'energy':
-            x,y,xlabel,ylabel = _main_energy(GOF,**kwargs)
-        case 'parameter':
-            x,y,xlabel,ylabel = _main_parameter(GOF,**kwargs)
-        case 'geometry':
-            x,y,xlabel,ylabel = _main_geometry(GOF,**kwargs)
-        case _: 
-            raise NotImplementedError(f'Plotting of property={target} is not implemented')
+    if is_store(ifile):
+        trajectory = Trajectory(ifile)
+        match target:
+            case 'energy':
+                x,y,xlabel,ylabel = _store_energy(trajectory,source)
+            case 'geometry':
+                x,y,xlabel,ylabel = _store_geometry(trajectory,source,**kwargs)
+            case _: 
+                raise NotImplementedError(f'Plotting of property={target} is '
+                                          'not available for trajectory stores')
+    else:
+        x,y,xlabel,ylabel = _from_output(ifile,target,**kwargs)
     
-    if not line and not scatter:
+    if y.ndim == 2:
+        # Several parameters at once
+        for column,name in zip(y.T,ylabel):
+            plt.plot(x,column,label=name)
+        plt.legend()
+        ylabel = ', '.join(sorted({UNITS[name[0]] for name in ylabel}))
+    elif not line and not scatter:
         if DEFAULT_PLOT in ['line','both']:
             plt.plot(x,y,color=color)
         if DEFAULT_PLOT in ['scatter','both']:
@@ -178,6 +195,28 @@ def main(
         print(f'writing -> {outfile}')
         plt.savefig(outfile,bbox_inches='tight')
 
+def _from_output(ifile:str|Path,target:str,**kwargs):
+    if target == 'geometry':
+        xyz = load_geometries(ifile)[0]
+        return _geometry_series(xyz,geometry_definitions(**kwargs),'iteration')
+    key = ' '.join([target,]+[f'{k}={v}' for k,v in sorted(kwargs.items())])
+    extract = lambda f: _extract_series(f,target,**kwargs)
+    arrays = load_or_extract(ifile,key,EXTRACTOR_VERSION,extract)
+    return arrays['x'], arrays['y'], str(arrays['xlabel']), str(arrays['ylabel'])
+def _extract_series(ifile:Path,target:str,**kwargs) -> dict[str,np.ndarray]:
+    with GaussianOutFile(ifile) as GOF: 
+        GOF.read()
+
+    match target:
+        case 'energy':
+            x,y,xlabel,ylabel = _main_energy(GOF,**kwargs)
+        case 'parameter':
+            x,y,xlabel,ylabel = _main_parameter(GOF,**kwargs)
+        case _: 
+            raise NotImplementedError(f'Plotting of property={target} is not implemented')
+    return dict(x=x,y=np.asarray(y,dtype=np.float64),
+                xlabel=np.array(xlabel),ylabel=np.array(ylabel))
+
 def _main_energy(
         GOF:GaussianOutFile,
         method:str,
@@ -227,35 +266,100 @@ def _main_parameter(
     xlabel = 'iteration'
     return x,y,xlabel,ylabel
 
-def _main_geometry(GOF:GaussianOutFile,
-                   atoms:tuple[int]):
-    n = len(atoms)
-
-    xlabel = 'iteration'
+def geometry_definitions(atoms:list[int],
+                         coordinates:list[list[int]]|None=None) -> list[tuple[int,...]]:
+    definitions = [tuple(atoms),] if atoms else []
+    definitions.extend(tuple(c) for c in coordinates or [])
+    if not definitions:
+        raise ValueError('No atom ids were provided')
+    for definition in definitions:
+        if len(definition) not in KINDS:
+            raise ValueError("the number of atom ids provided should be 2, 3 "
+                             f"or 4. The input was: {definition}")
+    return definitions
+def _geometry_series(xyz:np.ndarray,
+                     definitions:list[tuple[int,...]],
+                     xlabel:str):
+    y = measure(xyz,definitions)
+    x = np.arange(y.shape[0])
+    if len(definitions) > 1:
+        return x,y,xlabel,[label(d) for d in definitions]
+    atoms = definitions[0]
+    name = {2:'Distance',3:'Angle',4:'Dihedral'}[len(atoms)]
+    ylabel = f"{name}({','.join(map(str,atoms))}) {UNITS[KINDS[len(atoms)]]}"
+    return x,y[:,0],xlabel,ylabel
+def internal_definitions(GOF:GaussianOutFile) -> list[tuple[int,...]]:
+    """
+    Atoms of the internal coordinates defined in the first Link 103 of the 
+    output that prints them.
+    """
+    for l103 in GOF.get_links(103):
+        if l103.mode == 'Iteration':
+            continue
+        definitions = [parse_definition(str(p.Definition)) for p in l103.parameters]
+        definitions = [d for d in definitions if d is not None]
+        if definitions:
+            return definitions
+    return []
+def load_geometries(ifile:str|Path,
+                    source:str|None=None) -> tuple[np.ndarray,np.ndarray,list[tuple[int,...]]]:
+    """
+    Coordinates of all the steps, atomic numbers and internal coordinates 
+    defined in the output (none for trajectory stores).
+    """
+    if is_store(ifile):
+        trajectory = Trajectory(ifile)
+        xyz = trajectory.coordinates[store_frames(trajectory,source)]
+        return xyz, np.asarray(trajectory.atomic_numbers), []
+    arrays = load_or_extract(ifile,'geometries',EXTRACTOR_VERSION,_extract_geometries)
+    # Definitions are stored as rows padded with 0 (atom ids start at 1)
+    definitions = [tuple(int(i) for i in row if i) for row in arrays['definitions']]
+    return arrays['coordinates'], arrays['atomic_numbers'], definitions
+def _extract_geometries(ifile:Path) -> dict[str,np.ndarray]:
+    with GaussianOutFile(ifile,[1,103,202]) as GOF:
+        GOF.read()
+    links202 = GOF.get_links(202)
+    if not links202:
+        raise ValueError(f'No geometries found in {ifile}')
+    padded = np.zeros((0,4),dtype=np.int32)
+    definitions = internal_definitions(GOF)
+    if definitions:
+        padded = np.array([d+(0,)*(4-len(d)) for d in definitions],dtype=np.int32)
+    return dict(coordinates=stack_coordinates(links202),
+                atomic_numbers=np.asarray(atomic_numbers_from_L202(links202[-1])),
+                definitions=padded)
+def print_suggestions(xyz:np.ndarray,atomic_numbers:np.ndarray):
+    print('No atom ids were provided. Coordinates between bonded atoms that '
+          'changed the most:')
+    for atoms,change in suggest_coordinates(xyz,atomic_numbers):
+        name = label(atoms)
+        print(f"    {' '.join(map(str,atoms)):<16} {name:<16} {change: 8.3f} {UNITS[name[0]]}")
+def dump_internal_coordinates(xyz:np.ndarray,
+                              definitions:list[tuple[int,...]],
+                              csvfile:str|Path):
+    values = measure(xyz,definitions)
+    header = ','.join(['step',]+[label(d) for d in definitions])
+    steps = np.arange(values.shape[0])[:,np.newaxis]
+    np.savetxt(csvfile,np.hstack([steps,values]),delimiter=',',
+               header=header,comments='',fmt=['%d',]+['%.6f',]*values.shape[1])
 
-    match n: 
-        case 2:
-            i,j = atoms
-            getter = lambda xyz: np.linalg.norm(xyz[i-1,:] - xyz[j-1,:])
-            ylabel = f'Distance({i},{j}) Angstrom'
-        case 3:
-            i,j,k = atoms
-            getter = lambda xyz: np.rad2deg(angle_between(xyz[i-1]-xyz[j-1],xyz[k-1]-xyz[j-1]))
-            ylabel = f'Angle({i},{j},{k}) Degrees'
-        case 4:
-            i,j,k,l = atoms
-            getter = lambda xyz: np.rad2deg(get_dihedral(xyz[i-1],xyz[j-1],xyz[k-1],xyz[l-1]))
-            ylabel = f'Dihedral({i},{j},{k},{l}) Degrees'
-        case _: 
-            raise argparse.ArgumentError("the number of atom ids provided "
-                                f"should be 2, 3 or 4. The input was: {atoms}")
-    
-    y = []
-    for l202 in GOF.get_links(202):
-        xyz = np.array(Geometry.from_L202(l202).coordinates)
-        y.append(getter(xyz))
-    
-    y = np.array(y)
+def store_frames(trajectory:Trajectory,source:str|None=None):
+    if source is None:
+        return slice(None)
+    return trajectory.frames_of(source)
+def _store_energy(trajectory:Trajectory,
+                  source:str|None=None,
+                  **kwargs):
+    frames = store_frames(trajectory,source)
+    y = np.asarray(trajectory.energies[frames])
     x = np.arange(y.shape[0])
-    
-    return x,y,xlabel,ylabel
\ No newline at end of file
+    ylabel = 'Potential Energy, hartree'
+    xlabel = 'frame'
+    return x,y,xlabel,ylabel
+def _store_geometry(trajectory:Trajectory,
+                    source:str|None,
+                    atoms:list[int],
+                    coordinates:list[list[int]]|None=None):
+    definitions = geometry_definitions(atoms,coordinates)
+    xyz = trajectory.coordinates[store_frames(trajectory,source)]
+    return _geometry_series(xyz,definitions,'frame')
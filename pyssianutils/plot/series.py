@@ -0,0 +1,346 @@
+"""
+Reads the convergence series of gaussian optimizations (energy, forces and
+displacements of each step) shared by the plotting utilities.
+"""
+import io
+import os
+import warnings
+from pathlib import Path
+from typing import Iterator
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from pyssian import GaussianOutFile
+from ..utils import run_in_pool
+from .cache import load_or_extract
+
+# Links required to build the convergence series
+CONVERGENCE_LINKS = [103,502,508]
+# Increase whenever read_convergence returns different series for the same file
+CONVERGENCE_VERSION = 1
+
+# Utility Functions and classes
+class ConvergenceSeries(object):
+    """
+    Energy and convergence criteria at each step of an optimization.
+
+    Parameters
+    ----------
+    energies : np.ndarray
+        energy of each step
+    forces, rmsforces, displacements, rmsdisplacements : np.ndarray
+        value of each convergence criterion at each step, nan if it could not
+        be read
+    thresholds : tuple[float,...] | None
+        thresholds of the four criteria
+    labels : tuple[str,...] | None
+        names of the four criteria as printed by gaussian
+    """
+    def __init__(self,
+                 energies:np.ndarray,
+                 forces:np.ndarray,
+                 rmsforces:np.ndarray,
+                 displacements:np.ndarray,
+                 rmsdisplacements:np.ndarray,
+                 thresholds:tuple[float,...]|None=None,
+                 labels:tuple[str,...]|None=None):
+        self.energies = np.asarray(energies,dtype=np.float64)
+        self.forces = np.asarray(forces,dtype=np.float64)
+        self.rmsforces = np.asarray(rmsforces,dtype=np.float64)
+        self.displacements = np.asarray(displacements,dtype=np.float64)
+        self.rmsdisplacements = np.asarray(rmsdisplacements,dtype=np.float64)
+        self.thresholds = thresholds
+        self.labels = labels
+    def __len__(self):
+        return self.energies.shape[0]
+    def __repr__(self):
+        return f'<{type(self).__name__} steps={len(self)}>'
+
+    @property
+    def criteria(self) -> tuple[np.ndarray,...]:
+        """
+        Maximum force, RMS force, maximum displacement and RMS displacement.
+        """
+        return (self.forces,self.rmsforces,self.displacements,self.rmsdisplacements)
+
+    def as_arrays(self) -> dict[str,np.ndarray]:
+        arrays = dict(energies=self.energies,
+                      forces=self.forces,
+                      rmsforces=self.rmsforces,
+                      displacements=self.displacements,
+                      rmsdisplacements=self.rmsdisplacements)
+        if self.thresholds is not None:
+            arrays['thresholds'] = np.array(self.thresholds,dtype=np.float64)
+            arrays['labels'] = np.array(self.labels,dtype=str)
+        return arrays
+    @classmethod
+    def from_arrays(cls,arrays:dict[str,np.ndarray]) -> 'ConvergenceSeries':
+        thresholds, labels = None, None
+        if 'thresholds' in arrays:
+            thresholds = tuple(float(t) for t in arrays['thresholds'])
+            labels = tuple(str(l) for l in arrays['labels'])
+        return cls(arrays['energies'],arrays['forces'],arrays['rmsforces'],
+                   arrays['displacements'],arrays['rmsdisplacements'],
+                   thresholds,labels)
+
+def read_convergence(ifile:str|Path,max_errors:int=3) -> ConvergenceSeries:
+    """
+    Reads the energy and convergence criteria of each step of an optimization.
+    For outputs with two jobs (e.g. opt freq) the second job is appended to
+    the first one.
+
+    Parameters
+    ----------
+    ifile : str | Path
+        gaussian output file
+    max_errors : int, optional
+        number of steps whose convergence table can not be read before
+        raising an error, by default 3
+
+    Returns
+    -------
+    ConvergenceSeries
+    """
+    with GaussianOutFile(ifile,CONVERGENCE_LINKS) as GOF:
+        GOF.read()
+    return _series_from_links(GOF,ifile,max_errors)
+def load_convergence(ifile:str|Path,max_errors:int=3) -> ConvergenceSeries:
+    """
+    Same as read_convergence but the series are taken from the cache of the
+    plotting utilities when the output has not changed since they were read.
+    """
+    extract = lambda f: read_convergence(f,max_errors).as_arrays()
+    arrays = load_or_extract(ifile,f'convergence max_errors={max_errors}',
+                             CONVERGENCE_VERSION,extract)
+    return ConvergenceSeries.from_arrays(arrays)
+def _series_from_links(GOF:GaussianOutFile,
+                       ifile:str|Path,
+                       max_errors:int=3) -> ConvergenceSeries:
+
+    if len(GOF) > 1:
+        links_502 = GOF[0].get_links(502) + GOF[1].get_links(502)
+        links_508 = GOF[0].get_links(508) + GOF[1].get_links(508)
+        links_103 = GOF[0].get_links(103) + GOF[1].get_links(103)[1:]
+    else:
+        links_502 = GOF[0].get_links(502)
+        links_508 = GOF[0].get_links(508)
+        links_103 = GOF[0].get_links(103)
+
+    if not links_508:
+        links_508 = [None,]*len(links_502)
+
+    energies = []
+    values = [[],[],[],[]]
+    thresholds = None
+    labels = None
+    errors = 0
+    for l502,l508,l103 in zip(links_502,links_508,links_103[1:]):
+        energy = l502.energy
+        if l508 is not None and l508.energy is not None:
+            energy = l508.energy
+        energies.append(energy)
+        try:
+            items = tuple(l103.convergence)
+            if len(items) != 4:
+                raise ValueError(f'{len(items)} convergence criteria found')
+        except (ValueError,TypeError):
+            errors += 1
+            if errors >= max_errors:
+                raise ValueError(f'The convergence criteria of {ifile} could not be read')
+            for column in values:
+                column.append(np.nan)
+            continue
+        for column,item in zip(values,items):
+            column.append(item.Value)
+        if thresholds is None:
+            thresholds = tuple(item.Threshold for item in items)
+            labels = tuple(item.Item for item in items)
+
+    return ConvergenceSeries(energies,*values,thresholds,labels)
+
+# Incremental reading
+class _CompleteLines(io.TextIOBase):
+    """
+    Read-only text file that only returns complete lines, so that a line that
+    is still being written is returned once it is finished.
+    """
+    def __init__(self,path:str|Path):
+        self._file = open(path,'r')
+        self.name = self._file.name
+    def readable(self):
+        return True
+    def readline(self,size=-1):
+        position = self._file.tell()
+        line = self._file.readline()
+        if line and not line.endswith('\n'):
+            self._file.seek(position)
+            return ''
+        return line
+    def tell(self):
+        return self._file.tell()
+    def close(self):
+        self._file.close()
+        super().close()
+
+class ConvergenceFollower(object):
+    """
+    Follows a gaussian output that is still being written. Each update only 
+    parses the text appended since the previous one, starting at the byte 
+    offset where the previous update stopped.
+
+    Parameters
+    ----------
+    ifile : str | Path
+        gaussian output file
+    max_errors : int, optional
+        number of steps whose convergence table can not be read before
+        raising an error, by default 3
+    """
+    def __init__(self,ifile:str|Path,max_errors:int=3):
+        self.ifile = Path(ifile)
+        self.max_errors = max_errors
+        self.offset = 0
+        self._GOF = GaussianOutFile(_CompleteLines(self.ifile),CONVERGENCE_LINKS)
+        self._series:ConvergenceSeries|None = None
+    def __repr__(self):
+        return f'<{type(self).__name__}({self.ifile}) offset={self.offset}>'
+    def close(self):
+        self._GOF.close()
+
+    def update(self) -> bool:
+        """
+        Parses the text appended to the file. Returns True if there was new
+        text.
+        """
+        if os.path.getsize(self.ifile) == self.offset:
+            return False
+        self._GOF.update()
+        offset = self._GOF._file.tell()
+        if offset == self.offset:
+            return False
+        self.offset = offset
+        self._series = None
+        return True
+    @property
+    def series(self) -> ConvergenceSeries:
+        """
+        Convergence series of the steps parsed so far.
+        """
+        if self._series is None:
+            self._series = _series_from_links(self._GOF,self.ifile,self.max_errors)
+        return self._series
+
+# Parallel reading
+def _share_convergence(ifile:str|Path) -> tuple[str,int,tuple|None,tuple|None]:
+    """
+    Reads the convergence series of a file in a worker process and copies its
+    arrays to a new shared memory block, which is released by the parent in
+    _collect_convergence. Only the name of the block and the metadata are 
+    pickled back to the parent.
+    """
+    series = load_convergence(ifile)
+    n = len(series)
+    block = shared_memory.SharedMemory(create=True,size=max(5*n*8,1))
+    try:
+        arrays = np.ndarray((5,n),dtype=np.float64,buffer=block.buf)
+        arrays[0] = series.energies
+        for i,values in enumerate(series.criteria,1):
+            arrays[i] = values
+        del arrays
+    except Exception:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return block.name, n, series.thresholds, series.labels
+def _collect_convergence(handle:tuple[str,int,tuple|None,tuple|None]) -> ConvergenceSeries:
+    name, n, thresholds, labels = handle
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        arrays = np.ndarray((5,n),dtype=np.float64,buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+    return ConvergenceSeries(*arrays,thresholds,labels)
+def iter_convergence(files:list[str|Path],
+                     jobs:int=1) -> Iterator[tuple[ConvergenceSeries|None,str|None]]:
+    """
+    Reads the convergence series of each file, in worker processes if 
+    jobs > 1, in the same order as the files are provided.
+
+    Parameters
+    ----------
+    files : list[str | Path]
+        gaussian output files
+    jobs : int, optional
+        number of worker processes, by default 1
+
+    Yields
+    ------
+    tuple[ConvergenceSeries|None,str|None]
+        series of the file (None if it failed) and the error message (None
+        if it succeeded)
+    """
+    if jobs <= 1:
+        yield from run_in_pool(load_convergence,((f,) for f in files))
+        return
+    # The workers have to register the shared memory in the tracker of the 
+    # parent, otherwise it may be released when they exit
+    if os.name == 'posix':
+        resource_tracker.ensure_running()
+    for handle,error in run_in_pool(_share_convergence,((f,) for f in files),jobs):
+        if error is not None:
+            yield None, error
+        else:
+            yield _collect_convergence(handle), None
+
+# Decimation
+def lttb_indices(x:np.ndarray,y:np.ndarray,n_out:int) -> np.ndarray:
+    """
+    Indices of the points kept by the Largest-Triangle-Three-Buckets 
+    downsampling, which preserves the visual shape of a series. The first 
+    and last points are always kept.
+    """
+    n = x.shape[0]
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1,n-1,n_out-1).astype(np.intp)
+    selected = [0,]
+    a = 0
+    with warnings.catch_warnings():
+        # Buckets with only nan values
+        warnings.simplefilter('ignore',RuntimeWarning)
+        for i in range(n_out-2):
+            start, end = edges[i], max(edges[i+1],edges[i]+1)
+            next_start = edges[i+1]
+            next_end = edges[i+2] if i+2 < edges.shape[0] else n
+            avg_x = np.nanmean(x[next_start:next_end])
+            avg_y = np.nanmean(y[next_start:next_end])
+            area = np.abs((x[a]-avg_x)*(y[start:end]-y[a]) - (x[a]-x[start:end])*(avg_y-y[a]))
+            area = np.nan_to_num(area,nan=-1.0)
+            a = start + int(np.argmax(area))
+            selected.append(a)
+    selected.append(n-1)
+    return np.unique(selected)
+def decimate(x:np.ndarray,
+             y:np.ndarray,
+             max_points:int,
+             threshold:float|None=None) -> tuple[np.ndarray,np.ndarray]:
+    """
+    Downsamples a series to about max_points with LTTB, additionally keeping
+    the points at both sides of every crossing of the threshold so that the 
+    steps where a criterion converges are not lost.
+    """
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    if x.shape[0] <= max_points:
+        return x, y
+    indices = lttb_indices(x,y,max_points)
+    if threshold is not None:
+        with np.errstate(invalid='ignore'):
+            above = y > threshold
+        valid = np.isfinite(y)
+        changes = np.flatnonzero((above[1:] != above[:-1]) & valid[1:] & valid[:-1])
+        indices = np.union1d(indices,np.concatenate([changes,changes+1]))
+    return x[indices], y[indices]
@@ -8,6 +8,10 @@ from ..utils import add_parser_as_subparser
 
 from . import custom
 from . import slurm
+from . import local
+from . import walltime
+from . import dedup
+from . import workflow
 
 parser = argparse.ArgumentParser(description=__doc__)
 subparsers = parser.add_subparsers(help='sub-command help',dest='submit_mode')
@@ -20,6 +24,22 @@ add_parser_as_subparser(subparsers,
                         slurm.parser, 'slurm',
                         help=slurm.__doc__)
 
+add_parser_as_subparser(subparsers,
+                        local.parser, 'local',
+                        help=local.__doc__)
+
+add_parser_as_subparser(subparsers,
+                        walltime.parser, 'walltime',
+                        help=walltime.__doc__)
+
+add_parser_as_subparser(subparsers,
+                        dedup.parser, 'dedup',
+                        help=dedup.__doc__)
+
+add_parser_as_subparser(subparsers,
+                        workflow.parser, 'workflow',
+                        help=workflow.__doc__)
+
 def main(
          submit_mode:str|None=None,
          **kwargs):
@@ -28,3 +48,11 @@ def main(
         custom.main(**kwargs)
     if submit_mode == 'slurm': 
         slurm.main(**kwargs)
+    if submit_mode == 'local': 
+        local.main(**kwargs)
+    if submit_mode == 'walltime': 
+        walltime.main(**kwargs)
+    if submit_mode == 'dedup': 
+        dedup.main(**kwargs)
+    if submit_mode == 'workflow': 
+        workflow.main(**kwargs)
@@ -12,10 +12,9 @@ from pathlib import Path
 from collections import namedtuple
 from itertools import groupby
 
-from pyssian.gaussianclasses import GaussianInFile
-
 from ..initialize import load_app_defaults
-from ..utils import DirectoryTree
+from ..utils import DirectoryTree, read_input_header
+from .dedup import filter_done
 
 # Load app defaults
 DEFAULTS = load_app_defaults()
@@ -64,14 +63,11 @@ def submitline(ifile:Path,
         formatted line for the submission script
     """
 
-    with GaussianInFile(ifile) as GIF: 
-        GIF.read()
-        nprocs = int(GIF.nprocs)
-        mem = GIF.mem
-
-    memory = int(mem[:-2])             # Assume 'xxxMB'
-    if mem[-2:] == 'GB': 
-        memory = memory*1024    # Translate to MB in case of GB
+    header = read_input_header(ifile)
+    nprocs = header.nprocs
+    memory = header.memory_mb
+    if nprocs is None or memory is None: 
+        raise ValueError(f"'%nprocshared' and '%mem' must be specified in {ifile}")
     
     if nprocs == 4 and software == 'g16':
         queue = QUEUES['q4']
@@ -193,6 +189,18 @@ parser.add_argument('--norun',
                     action='store_true',default=False,
                     help="If enabled the submit command will instead just "
                     f"generate the {GAUSSIAN_INPUT_SUFFIX}.sub file")
+done = parser.add_mutually_exclusive_group()
+done.add_argument('--skip-done',
+                  dest='done_action',
+                  action='store_const',const='skip',default=None,
+                  help="Skip the inputs already computed according to the "
+                  "index of 'pyssianutils submit dedup'. With --ascomments "
+                  "they are included as comments")
+done.add_argument('--link-done',
+                  dest='done_action',
+                  action='store_const',const='link',default=None,
+                  help="Same as --skip-done but also creates a symbolic link "
+                  f"to the existing {GAUSSIAN_OUTPUT_SUFFIX} next to each input")
 
 
 def main(
@@ -202,7 +210,8 @@ def main(
          recursive:bool=False,
          as_comments:bool=False,
          no_run:bool=False,
-         scriptname:str=DEFAULT_SCRIPT):
+         scriptname:str=DEFAULT_SCRIPT,
+         done_action:str|None=None):
 
     if folder is None: 
         folder = Path.cwd()
@@ -213,6 +222,11 @@ def main(
                                                      in_suffix,
                                                      out_suffix,
                                                      recursive)
+    if done_action is not None: 
+        remaining = filter_done(without_output,done_action,out_suffix)
+        done = [file for file in without_output if file not in remaining]
+        without_output = remaining
+        with_outputs.extend(file.with_suffix(out_suffix) for file in done)
     
     entry = namedtuple('entry','folder file ascomment')
     
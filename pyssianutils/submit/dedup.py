@@ -0,0 +1,352 @@
+__doc__ = """
+Content-addressed index of finished gaussian calculations. Each calculation is
+identified by a hash of its route section, charge, spin and geometry, with the
+cartesian coordinates centered and rounded to a tolerance. Inputs with any 
+section after the geometry (e.g. basis sets or modredundant lines) are never
+considered computed. The 'index' command
+hashes the outputs with a normal termination found in the folders provided and
+stores them ({index}). 'slurm' and 'submit custom' use the index with
+'--skip-done' or '--link-done' to avoid recomputing inputs already done.
+"""
+
+import os
+import re
+import json
+import hashlib
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from ..initialize import get_appdir, load_app_defaults
+from ..utils import (DirectoryTree, run_in_pool, atomic_write,
+                     has_normal_termination, join_route_lines)
+
+# Load app defaults
+DEFAULTS = load_app_defaults()
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+DEFAULT_TOLERANCE = DEFAULTS['submit.dedup'].getfloat('tolerance')
+INDEX_PATH = get_appdir()/DEFAULTS['submit.dedup']['index_file']
+
+CHARGE_PATTERN = re.compile(r'Charge\s*=\s*(-?[0-9]+)\s*Multiplicity\s*=\s*([0-9]+)')
+PRINT_LEVEL_PATTERN = re.compile(r'^#([pnt](?=\s|$))?')
+INDEX_VERSION = 2 # Increase it whenever the signatures change
+
+# Utility Functions and classes
+def canonical_route(route:str) -> str:
+    """
+    Lowercases the route section, removes the print level and all the
+    whitespace, as gaussian outputs wrap the route at a fixed column and the 
+    spaces between keywords can not be recovered reliably.
+    """
+    route = PRINT_LEVEL_PATTERN.sub('',route.strip().lower())
+    return ''.join(route.split())
+def canonical_geometry(lines:list[str],tolerance:float) -> str:
+    """
+    Canonical text of a geometry. Cartesian coordinates are centered at their
+    centroid, rounded to the tolerance and sorted, so that the order of the
+    atoms and translations do not change the result. Any other geometry
+    specification (e.g. z-matrix) is kept as whitespace-normalized text.
+    """
+    symbols, coordinates, others = [], [], []
+    for line in lines:
+        tokens = line.replace(',',' ').split()
+        try:
+            xyz = [float(t) for t in tokens[-3:]]
+        except ValueError:
+            xyz = None
+        if xyz is None or len(tokens) < 4:
+            others.append(' '.join(tokens).lower())
+            continue
+        symbols.append(tokens[0].split('(')[0].split('-')[0].capitalize())
+        coordinates.append(xyz)
+    parts = sorted(others)
+    if coordinates:
+        coordinates = np.array(coordinates)
+        coordinates = coordinates - coordinates.mean(axis=0)
+        rounded = np.rint(coordinates/tolerance).astype(np.int64) + 0
+        parts.extend(sorted(f'{s} {x} {y} {z}'
+                            for s,(x,y,z) in zip(symbols,rounded)))
+    return '\n'.join(parts)
+def signature(route:str,
+              charge:int,
+              spin:int,
+              geometry:list[str],
+              tolerance:float) -> str:
+    """
+    sha256 of the canonical route, charge, spin and geometry.
+    """
+    text = '\n'.join([canonical_route(route),
+                      f'{charge} {spin}',
+                      canonical_geometry(geometry,tolerance)])
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def input_signature(ifile:str|Path,tolerance:float=DEFAULT_TOLERANCE) -> str|None:
+    """
+    Signature of a gaussian input file. Returns None for inputs with several
+    jobs ('--Link1--'), without an explicit geometry or with any section 
+    after it (e.g. gen basis sets, modredundant lines or solvent parameters),
+    as it is not available in the outputs.
+    """
+    with open(ifile,'r') as F:
+        txt = F.read()
+    if '--link1--' in txt.lower():
+        return None
+    lines = [line.strip() for line in txt.splitlines()]
+    # sections: link0 + route, title, charge/spin + geometry and any other
+    sections, current = [], []
+    for line in lines:
+        if line:
+            current.append(line)
+        elif current:
+            sections.append(current)
+            current = []
+    if current:
+        sections.append(current)
+    if len(sections) != 3:
+        return None
+    route = ' '.join(line for line in sections[0] if not line.startswith('%'))
+    try:
+        charge, spin = map(int,sections[2][0].split()[:2])
+    except ValueError:
+        return None
+    geometry = sections[2][1:]
+    if not geometry:
+        return None
+    return signature(route,charge,spin,geometry,tolerance)
+def output_signature(ofile:str|Path,tolerance:float=DEFAULT_TOLERANCE) -> str|None:
+    """
+    Signature of a gaussian output file with a normal termination, computed
+    from its route section and the input geometry reprinted in the
+    'Symbolic Z-matrix' section. Returns None for outputs that did not finish
+    properly, with several jobs or without said section.
+    """
+    if not has_normal_termination(ofile):
+        return None
+    route, width = [], None
+    in_route, route_done = False, False
+    charge, spin, geometry = None, None, None
+    with open(ofile,'r',errors='replace') as F:
+        for line in F:
+            if not route_done:
+                if line.startswith(' #'):
+                    in_route = True
+                if in_route and line.startswith(' -'):
+                    in_route, route_done = False, True
+                    width = len(line.strip())
+                elif in_route:
+                    route.append(line)
+                continue
+            if 'Link1:' in line:
+                return None
+            if geometry is None and line.startswith(' Symbolic Z-matrix:'):
+                match = CHARGE_PATTERN.search(next(F,''))
+                if match is None:
+                    return None
+                charge, spin = int(match.group(1)), int(match.group(2))
+                geometry = []
+                for line in F:
+                    if not line.strip():
+                        break
+                    geometry.append(line.strip())
+    if geometry is None or not route:
+        return None
+    return signature(join_route_lines(route,width),charge,spin,geometry,tolerance)
+
+class DedupIndex(object):
+    """
+    Index of finished calculations stored as a json file.
+
+    Parameters
+    ----------
+    filepath : Path
+        json file where the index is stored.
+    tolerance : float
+        tolerance used to round the coordinates. If it differs from the one of
+        the stored index, or the index was built by a version with other
+        signatures, the stored index is discarded.
+    """
+    def __init__(self,filepath:Path=INDEX_PATH,tolerance:float=DEFAULT_TOLERANCE):
+        self.filepath = Path(filepath)
+        self.tolerance = tolerance
+        # output -> [mtime_ns, signature]
+        self.files:dict[str,list] = dict()
+        if self.filepath.exists():
+            with open(self.filepath,'r') as F:
+                data = json.load(F)
+            if (data['tolerance'] == tolerance 
+                and data.get('version') == INDEX_VERSION):
+                self.files = data['files']
+        self._update_signatures()
+
+    def _update_signatures(self):
+        self.signatures:dict[str,str] = dict()
+        for ofile,(_,key) in sorted(self.files.items()):
+            if key is not None:
+                self.signatures.setdefault(key,ofile)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    @classmethod
+    def load(cls,filepath:Path=INDEX_PATH):
+        """
+        Loads a stored index with its own tolerance.
+        """
+        if not Path(filepath).exists():
+            raise FileNotFoundError(f"No index found at {filepath}. Please run "
+                                    "'pyssianutils submit dedup index' first")
+        with open(filepath,'r') as F:
+            tolerance = json.load(F)['tolerance']
+        return cls(filepath,tolerance)
+
+    def update(self,
+               folders:list[Path],
+               suffix:str=GAUSSIAN_OUTPUT_SUFFIX,
+               jobs:int=DEFAULT_JOBS) -> tuple[int,int]:
+        """
+        Hashes the outputs found in the folders that are new or were modified
+        since the last update and forgets the outputs that no longer exist.
+        Returns the number of outputs hashed and removed.
+        """
+        ofiles = []
+        for folder in folders:
+            tree = DirectoryTree(folder,GAUSSIAN_INPUT_SUFFIX,suffix)
+            ofiles.extend(str(Path(f).resolve()) for f in tree.outfiles)
+
+        removed = [f for f in self.files if not os.path.exists(f)]
+        for ofile in removed:
+            del self.files[ofile]
+
+        pending = []
+        for ofile in ofiles:
+            mtime = os.stat(ofile).st_mtime_ns
+            if ofile in self.files and self.files[ofile][0] == mtime:
+                continue
+            pending.append((ofile,mtime))
+        tasks = [(ofile,self.tolerance) for ofile,_ in pending]
+        for (ofile,mtime),(key,error) in zip(pending,
+                                             run_in_pool(output_signature,tasks,jobs)):
+            if error is not None:
+                print(f'Could not read {ofile}: {error}')
+                key = None
+            self.files[ofile] = [mtime,key]
+        self._update_signatures()
+        return len(pending), len(removed)
+
+    def lookup(self,ifile:str|Path) -> Path|None:
+        """
+        Returns the output of a finished calculation identical to the input
+        or None.
+        """
+        key = input_signature(ifile,self.tolerance)
+        if key is None or key not in self.signatures:
+            return None
+        ofile = Path(self.signatures[key])
+        if not ofile.exists():
+            return None
+        return ofile
+
+    def write(self):
+        self.filepath.parent.mkdir(parents=True,exist_ok=True)
+        data = dict(version=INDEX_VERSION,tolerance=self.tolerance,files=self.files)
+        atomic_write(self.filepath,json.dumps(data,indent=1))
+
+def filter_done(ifiles:list[Path],
+                action:str|None,
+                out_suffix:str=GAUSSIAN_OUTPUT_SUFFIX) -> list[Path]:
+    """
+    Removes from the inputs the ones already computed according to the index.
+    With action 'link' a symbolic link to the existing output is created as
+    the output of the input.
+
+    Parameters
+    ----------
+    ifiles : list[Path]
+        gaussian input files
+    action : str | None
+        None (the inputs are returned unchanged), 'skip' or 'link'
+    out_suffix : str, optional
+        suffix of the output of the inputs, used when linking
+
+    Returns
+    -------
+    list[Path]
+        inputs that have not been computed
+    """
+    if action is None:
+        return list(ifiles)
+    index = DedupIndex.load(INDEX_PATH)
+    remaining = []
+    for ifile in ifiles:
+        ofile = index.lookup(ifile)
+        if ofile is None:
+            remaining.append(ifile)
+            continue
+        target = Path(ifile).with_suffix(out_suffix)
+        if action == 'link' and not target.exists():
+            target.symlink_to(ofile.resolve())
+            print(f'Skipping {ifile}, linked {target} -> {ofile}')
+        else:
+            print(f'Skipping {ifile}, already computed in {ofile}')
+    return remaining
+
+# Define Parser and main
+__doc__ = __doc__.format(index=INDEX_PATH)
+
+parser = argparse.ArgumentParser(description=__doc__)
+subparsers = parser.add_subparsers(help='sub-command help',dest='dedup_mode')
+
+index = subparsers.add_parser('index',
+                              help="Add to the index the finished outputs "
+                              "found recursively in the folders provided")
+index.add_argument('folders',
+                   nargs='+',type=Path,
+                   help="Folders with gaussian output files")
+index.add_argument('--suffix',
+                   default=GAUSSIAN_OUTPUT_SUFFIX,
+                   help="suffix of the gaussian output files")
+index.add_argument('-j','--jobs',
+                   type=int,default=DEFAULT_JOBS,
+                   help="Number of parallel processes used to read the "
+                   f"outputs, by default {DEFAULT_JOBS}")
+index.add_argument('--tolerance',
+                   type=float,default=DEFAULT_TOLERANCE,
+                   help="Coordinates are rounded to this value (in the units "
+                   f"of the inputs), by default {DEFAULT_TOLERANCE}. Changing "
+                   "it rebuilds the index.")
+
+check = subparsers.add_parser('check',
+                              help="Display the inputs that are already "
+                              "computed according to the index")
+check.add_argument('inputfiles',
+                   nargs='+',type=Path,
+                   help="Gaussian input files")
+
+def _main_index(folders:list[Path],
+                suffix:str=GAUSSIAN_OUTPUT_SUFFIX,
+                jobs:int=DEFAULT_JOBS,
+                tolerance:float=DEFAULT_TOLERANCE):
+    dedup = DedupIndex(INDEX_PATH,tolerance)
+    hashed, removed = dedup.update(folders,suffix,jobs)
+    dedup.write()
+    print(f'{hashed} outputs hashed, {removed} removed, {len(dedup)} '
+          f'calculations in the index stored at {INDEX_PATH}')
+def _main_check(inputfiles:list[Path]):
+    dedup = DedupIndex.load(INDEX_PATH)
+    for ifile in inputfiles:
+        ofile = dedup.lookup(ifile)
+        if ofile is not None:
+            print(f'{ifile}    {ofile}')
+
+def main(dedup_mode:str|None=None,
+         **kwargs):
+    match dedup_mode:
+        case 'index':
+            _main_index(**kwargs)
+        case 'check':
+            _main_check(**kwargs)
+        case _:
+            parser.print_help()
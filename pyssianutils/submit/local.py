@@ -0,0 +1,336 @@
+__doc__ = """
+Runs gaussian input files in the current machine, running concurrently as many
+as fit within the available cores and memory according to the '%nprocshared'
+and '%mem' of each input. The progress is stored in a state file ({state_file})
+so that an interrupted run can be resumed by running the same command again.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+from pathlib import Path
+
+from ..initialize import load_app_defaults
+from ..utils import (DirectoryTree, read_input_header, mem_to_mb,
+                     atomic_write, has_normal_termination)
+
+# Load app defaults
+DEFAULTS = load_app_defaults()
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_EXECUTABLE = DEFAULTS['submit.local']['executable']
+DEFAULT_MEMORY = DEFAULTS['submit.local']['memory']
+DEFAULT_STATE = DEFAULTS['submit.local']['state_file']
+DEFAULT_POLL = DEFAULTS['submit.local'].getfloat('poll')
+DEFAULT_CORES = os.cpu_count() or 1
+STOP_TIMEOUT = 30 # seconds given to a calculation to stop before killing it
+
+ORDERS = ['input','small-first','large-first']
+
+# Utility Functions and classes
+class LocalQueue(object):
+    """
+    Persistent queue of calculations. Each job is stored as a dict with the
+    keys: 'input', 'output', 'cores', 'memory' (MB), 'status' ('pending',
+    'running', 'done' or 'failed'), 'attempts', 'returncode' and 'elapsed'
+    (seconds of the last attempt).
+
+    Parameters
+    ----------
+    filepath : Path
+        json file where the state of the queue is stored.
+    """
+    def __init__(self,filepath:Path):
+        self.filepath = Path(filepath)
+        self.jobs:list[dict] = []
+        if self.filepath.exists():
+            with open(self.filepath,'r') as F:
+                self.jobs = json.load(F)['jobs']
+        # Calculations running when a previous run was interrupted are repeated
+        for job in self.jobs:
+            if job['status'] == 'running':
+                job['status'] = 'pending'
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self,ifile:Path,out_suffix:str) -> dict|None:
+        """
+        Adds a new input to the queue. Inputs already in the queue are ignored.
+        """
+        ifile = Path(ifile).resolve()
+        if any(job['input'] == str(ifile) for job in self.jobs):
+            return None
+        header = read_input_header(ifile)
+        if header.nprocs is None or header.memory_mb is None:
+            raise ValueError(f"'%nprocshared' and '%mem' must be specified in {ifile}")
+        job = dict(input=str(ifile),
+                   output=str(ifile.with_suffix(out_suffix)),
+                   cores=header.nprocs,
+                   memory=header.memory_mb,
+                   status='pending',
+                   attempts=0,
+                   returncode=None,
+                   elapsed=None)
+        self.jobs.append(job)
+        return job
+
+    def reset(self,job:dict):
+        """
+        Sets a job as pending reading again the resources of its input, as it
+        may have been modified.
+        """
+        header = read_input_header(job['input'])
+        if header.nprocs is None or header.memory_mb is None:
+            raise ValueError(f"'%nprocshared' and '%mem' must be specified in {job['input']}")
+        job.update(cores=header.nprocs,
+                   memory=header.memory_mb,
+                   status='pending',
+                   attempts=0,
+                   returncode=None,
+                   elapsed=None)
+
+    def save(self):
+        atomic_write(self.filepath,json.dumps(dict(jobs=self.jobs),indent=1))
+
+    def with_status(self,*status:str) -> list[dict]:
+        return [job for job in self.jobs if job['status'] in status]
+
+def sort_jobs(jobs:list[dict],order:str='input') -> list[dict]:
+    """
+    Sorts the jobs according to the priority order selected.
+    """
+    match order:
+        case 'small-first':
+            return sorted(jobs,key=lambda j: j['cores']*j['memory'])
+        case 'large-first':
+            return sorted(jobs,key=lambda j: -j['cores']*j['memory'])
+        case _:
+            return list(jobs)
+def start_job(job:dict,executable:str) -> subprocess.Popen:
+    """
+    Starts the calculation as 'executable < input > output' in the folder of
+    the input, in its own session so that all its processes can be stopped.
+    """
+    ifile = Path(job['input'])
+    with open(ifile,'r') as stdin, open(job['output'],'w') as stdout:
+        process = subprocess.Popen(executable,
+                                   shell=True,
+                                   stdin=stdin,
+                                   stdout=stdout,
+                                   stderr=subprocess.STDOUT,
+                                   cwd=ifile.parent,
+                                   start_new_session=True)
+    return process
+def stop_job(process:subprocess.Popen,timeout:float=STOP_TIMEOUT):
+    """
+    Terminates all the processes of a calculation (the shell and the gaussian
+    links it started) and waits for them, killing them after the timeout.
+    """
+    for sig in (signal.SIGTERM,signal.SIGKILL):
+        try:
+            os.killpg(process.pid,sig)
+        except ProcessLookupError:
+            break
+        try:
+            process.wait(timeout)
+            break
+        except subprocess.TimeoutExpired:
+            continue
+def print_stats(queue:LocalQueue,
+                used_cores:int,
+                cores:int,
+                used_memory:int,
+                memory:int,
+                completed:int,
+                start:float):
+    done = len(queue.with_status('done'))
+    failed = len(queue.with_status('failed'))
+    running = len(queue.with_status('running'))
+    pending = len(queue.with_status('pending'))
+    hours = (time.time() - start)/3600
+    throughput = completed/hours if hours > 0 else 0.0
+    print(f'done {done}/{len(queue)} | running {running} | pending {pending} '
+          f'| failed {failed} | cores {used_cores}/{cores} '
+          f'| memory {used_memory}/{memory}MB | {throughput:.1f} jobs/h',
+          flush=True)
+
+# Define Parser and main
+__doc__ = __doc__.format(state_file=DEFAULT_STATE)
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('inputfiles',
+                    nargs='*',
+                    help="Gaussian input files. They are added to the "
+                    "calculations of the state file, if it exists.")
+group_input = parser.add_mutually_exclusive_group()
+group_input.add_argument('-l','--listfile',
+                         dest='is_listfile',
+                         action='store_true',default=False,
+                         help="When enabled instead of considering the "
+                         "files provided as the gaussian input files "
+                         "considers the file provided as a list of gaussian "
+                         "input files")
+group_input.add_argument('-r','--folder',
+                         dest='is_folder',
+                         action='store_true',default=False,
+                         help="Takes the folder and finds recursively all the "
+                         f"{GAUSSIAN_INPUT_SUFFIX} files in it")
+parser.add_argument('--exe',
+                    dest='executable',
+                    default=DEFAULT_EXECUTABLE,
+                    help="Command that runs a calculation reading the input "
+                    "from the stdin and writing the output to the stdout, "
+                    f"by default '{DEFAULT_EXECUTABLE}'")
+parser.add_argument('--cores',
+                    type=int,default=DEFAULT_CORES,
+                    help="Total cores available for the calculations, by "
+                    f"default {DEFAULT_CORES}")
+parser.add_argument('--memory',
+                    default=DEFAULT_MEMORY,
+                    help="Total memory available for the calculations, by "
+                    f"default {DEFAULT_MEMORY}")
+parser.add_argument('--order',
+                    choices=ORDERS,default='input',
+                    help="Priority of the calculations: in the order provided, "
+                    "the smallest (cores*memory) first or the largest first")
+parser.add_argument('--retries',
+                    type=int,default=0,
+                    help="Number of times a failed calculation is repeated")
+parser.add_argument('--retry-failed',
+                    dest='retry_failed',
+                    action='store_true',default=False,
+                    help="Run again the calculations of the state file that "
+                    "failed. Calculations that were not started because they "
+                    "requested more resources than available are always "
+                    "checked again.")
+parser.add_argument('--state',
+                    dest='state_file',
+                    type=Path,default=Path(DEFAULT_STATE),
+                    help="File where the state of the queue is stored, "
+                    f"by default {DEFAULT_STATE}")
+parser.add_argument('--suffix',
+                    default=GAUSSIAN_OUTPUT_SUFFIX,
+                    help="suffix of the output files")
+parser.add_argument('--poll',
+                    type=float,default=DEFAULT_POLL,
+                    help="Seconds between checks of the running calculations")
+
+def main(
+         inputfiles:list[str|Path],
+         is_listfile:bool=False,
+         is_folder:bool=False,
+         executable:str=DEFAULT_EXECUTABLE,
+         cores:int=DEFAULT_CORES,
+         memory:str=DEFAULT_MEMORY,
+         order:str='input',
+         retries:int=0,
+         retry_failed:bool=False,
+         state_file:Path=Path(DEFAULT_STATE),
+         suffix:str=GAUSSIAN_OUTPUT_SUFFIX,
+         poll:float=DEFAULT_POLL,
+         ):
+
+    total_memory = mem_to_mb(memory)
+    if total_memory is None:
+        raise ValueError(f'Could not interpret the memory {memory}')
+
+    if is_folder:
+        ifiles = list(DirectoryTree(inputfiles[0],
+                                    GAUSSIAN_INPUT_SUFFIX,
+                                    suffix).infiles)
+    elif is_listfile:
+        with open(Path(inputfiles[0]),'r') as F:
+            ifiles = [Path(line.strip()) for line in F if line.strip()]
+    else:
+        ifiles = [Path(f) for f in inputfiles]
+
+    queue = LocalQueue(state_file)
+    for ifile in ifiles:
+        queue.add(ifile,suffix)
+
+    # Jobs that were never started failed because of their resources
+    for job in queue.with_status('failed'):
+        if not (retry_failed or job['attempts'] == 0):
+            continue
+        try:
+            queue.reset(job)
+        except (OSError,ValueError) as e:
+            print(f"{job['input']} can not be run again: {e}")
+
+    for job in queue.with_status('pending'):
+        if job['cores'] > cores or job['memory'] > total_memory:
+            print(f"{job['input']} requests more resources than available")
+            job['status'] = 'failed'
+    queue.save()
+
+    running:dict[int,tuple[dict,subprocess.Popen,float]] = dict()
+    used_cores, used_memory = 0, 0
+    completed = 0 # finished in this run, to compute the throughput
+    start = time.time()
+    try:
+        while queue.with_status('pending') or running:
+            # Start the pending jobs in order while they fit in the free
+            # resources. Jobs are not started ahead of one that does not fit,
+            # otherwise a stream of small jobs could delay it indefinitely
+            changed = False
+            for job in sort_jobs(queue.with_status('pending'),order):
+                if (used_cores + job['cores'] > cores or
+                    used_memory + job['memory'] > total_memory):
+                    break
+                process = start_job(job,executable)
+                running[process.pid] = (job,process,time.time())
+                job['status'] = 'running'
+                job['attempts'] += 1
+                used_cores += job['cores']
+                used_memory += job['memory']
+                print(f"Started {job['input']}")
+                changed = True
+
+            # Check the finished jobs
+            for pid,(job,process,t0) in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del running[pid]
+                used_cores -= job['cores']
+                used_memory -= job['memory']
+                job['returncode'] = returncode
+                job['elapsed'] = time.time() - t0
+                if returncode == 0 and has_normal_termination(job['output']):
+                    job['status'] = 'done'
+                    completed += 1
+                    print(f"Finished {job['input']}")
+                elif job['attempts'] <= retries:
+                    job['status'] = 'pending'
+                    print(f"Failed {job['input']}, it will be repeated")
+                else:
+                    job['status'] = 'failed'
+                    print(f"Failed {job['input']}")
+                changed = True
+
+            if changed:
+                queue.save()
+                print_stats(queue,used_cores,cores,used_memory,total_memory,
+                            completed,start)
+            else:
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        for job,process,_ in running.values():
+            stop_job(process)
+            job['status'] = 'pending'
+            job['attempts'] -= 1
+        queue.save()
+        print(f'Interrupted. Run again the command to resume the calculations '
+              f'stored in {state_file}',file=sys.stderr)
+        raise
+
+    failed = queue.with_status('failed')
+    if failed:
+        print(f'{len(failed)} calculations failed:')
+        for job in failed:
+            print(f"    {job['input']}")
@@ -0,0 +1,188 @@
+"""
+Bin-packing of many small gaussian calculations into node-sized allocations.
+Each allocation runs its calculations in order as a first-in first-out work
+queue, starting the next one as soon as enough cores and memory are free.
+"""
+import os
+import math
+from pathlib import Path
+from collections import namedtuple
+
+PackJob = namedtuple('PackJob','filepath cores memory runtime'.split())
+
+# Utility Functions
+def walltime_to_seconds(walltime:str) -> int:
+    """
+    Converts a slurm walltime in 'DD-HH:MM:SS', 'HH:MM:SS' or 'MM:SS' formats
+    to seconds.
+    """
+    days = 0
+    if '-' in walltime:
+        days,walltime = walltime.split('-')
+        days = int(days)
+    fields = [int(f) for f in walltime.split(':')]
+    while len(fields) < 3:
+        fields.insert(0,0)
+    hours,minutes,seconds = fields
+    return ((days*24 + hours)*60 + minutes)*60 + seconds
+def seconds_to_walltime(seconds:float) -> str:
+    """
+    Converts seconds to a slurm walltime in 'DD-HH:MM:SS' format rounding up
+    to the next minute.
+    """
+    minutes = math.ceil(seconds/60)
+    days,minutes = divmod(minutes,24*60)
+    hours,minutes = divmod(minutes,60)
+    return f'{days:02d}-{hours:02d}:{minutes:02d}:00'
+
+class Allocation(object):
+    """
+    A node-sized allocation where the calculations are started in the order in
+    which they were added.
+
+    Parameters
+    ----------
+    cores : int
+        number of cores of the node
+    memory : int
+        memory of the node in MB
+    max_time : float
+        maximum time in seconds of the allocation
+    """
+    def __init__(self,cores:int,memory:int,max_time:float):
+        self.cores = cores
+        self.memory = memory
+        self.max_time = max_time
+        self.jobs:list[PackJob] = []
+        self.starts:list[float] = []
+        self.makespan = 0.0
+        self._last_start = 0.0
+        # (end,cores,memory) of the jobs that may still be running at _last_start
+        self._active:list[tuple[float,int,int]] = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def fits(self,job:PackJob) -> bool:
+        return (job.cores <= self.cores and job.memory <= self.memory
+                and job.runtime <= self.max_time)
+
+    def earliest_start(self,job:PackJob) -> float:
+        """
+        Time at which the job would start if added at the end of the queue.
+        """
+        active = [a for a in self._active if a[0] > self._last_start]
+        times = [self._last_start,] + sorted(set(a[0] for a in active))
+        for t in times:
+            running = [a for a in active if a[0] > t]
+            free_cores = self.cores - sum(a[1] for a in running)
+            free_memory = self.memory - sum(a[2] for a in running)
+            if job.cores <= free_cores and job.memory <= free_memory:
+                return t
+        # Unreachable for jobs that fit in an empty allocation
+        return max(times)
+
+    def try_add(self,job:PackJob) -> bool:
+        """
+        Adds the job at the end of the queue if it finishes before max_time.
+        """
+        if not self.fits(job):
+            return False
+        start = self.earliest_start(job)
+        end = start + job.runtime
+        if end > self.max_time:
+            return False
+        self.jobs.append(job)
+        self.starts.append(start)
+        self._last_start = start
+        self._active = [a for a in self._active if a[0] > start]
+        self._active.append((end,job.cores,job.memory))
+        self.makespan = max(self.makespan,end)
+        return True
+
+    @property
+    def utilization(self) -> float:
+        """
+        Fraction of the core-time of the allocation used by the calculations
+        """
+        if self.makespan == 0:
+            return 0.0
+        used = sum(job.cores*job.runtime for job in self.jobs)
+        return used/(self.cores*self.makespan)
+
+def pack_jobs(jobs:list[PackJob],
+              cores:int,
+              memory:int,
+              max_time:float) -> tuple[list[Allocation],list[PackJob]]:
+    """
+    Distributes the jobs among allocations using a first-fit decreasing
+    strategy on the runtime: each job, from the longest to the shortest, is
+    added to the first allocation where it can finish before max_time.
+
+    Parameters
+    ----------
+    jobs : list[PackJob]
+        calculations to distribute
+    cores : int
+        cores of each allocation
+    memory : int
+        memory in MB of each allocation
+    max_time : float
+        max time in seconds of each allocation
+
+    Returns
+    -------
+    tuple[list[Allocation],list[PackJob]]
+        allocations and jobs that do not fit in an empty allocation
+    """
+    allocations:list[Allocation] = []
+    unpackable:list[PackJob] = []
+    ordered = sorted(jobs,key=lambda j: (-j.runtime,-j.cores,str(j.filepath)))
+    for job in ordered:
+        for allocation in allocations:
+            if allocation.try_add(job):
+                break
+        else:
+            allocation = Allocation(cores,memory,max_time)
+            if allocation.try_add(job):
+                allocations.append(allocation)
+            else:
+                unpackable.append(job)
+    return allocations, unpackable
+
+def simulate(jobs:list[PackJob],
+             allocations:list[Allocation],
+             cores:int,
+             memory:int,
+             overhead:float=0.0) -> dict[str,float]:
+    """
+    Estimates the node-hours consumed when each job is submitted independently
+    (each one charged by its fraction of a node) and when they are submitted as
+    the packed allocations (each one charged as a full node during its
+    makespan). overhead is the time in seconds lost per submitted job
+    (scheduling, start-up and clean-up).
+    """
+    baseline = 0.0
+    for job in jobs:
+        fraction = max(job.cores/cores,job.memory/memory)
+        baseline += fraction*(job.runtime + overhead)
+    packed = sum(a.makespan + overhead for a in allocations)
+    return dict(jobs=len(jobs),
+                allocations=len(allocations),
+                baseline=baseline/3600,
+                packed=packed/3600,
+                saved=(baseline - packed)/3600)
+
+def write_manifest(filepath:Path,
+                   allocation:Allocation,
+                   rootdir:Path):
+    """
+    Writes the jobs of the allocation in order, one per line as
+    'cores memory path' where the path is relative to the rootdir and without
+    suffix.
+    """
+    with open(filepath,'w') as F:
+        for job in allocation.jobs:
+            path = Path(job.filepath)
+            relpath = Path(os.path.relpath(path.parent.resolve(),rootdir.resolve()))
+            F.write(f'{job.cores} {job.memory} {relpath/path.stem}\n')
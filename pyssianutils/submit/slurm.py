@@ -1,6 +1,8 @@
 """
 Generate slurm scripts for gaussian calculations.
 """
+import os
+import copy
 import shutil
 import argparse
 import re
@@ -14,7 +16,11 @@ import warnings
 from pyssian import GaussianInFile
 
 from ..initialize import get_appdir, load_app_defaults
-from ..utils import DirectoryTree
+from ..utils import DirectoryTree, read_input_header
+from .packing import (PackJob, pack_jobs, simulate, write_manifest,
+                      walltime_to_seconds, seconds_to_walltime)
+from .walltime import predict_walltime, predict_seconds
+from .dedup import filter_done
 
 from typing import Any
 
@@ -28,6 +34,9 @@ DEFAULT_JOBNAME = DEFAULTS['submit.slurm']['jobname']
 DEFAULT_GUESS =  DEFAULTS['submit.slurm'].getboolean('guess_default')
 DEFAULT_INPLACE = DEFAULTS['submit.slurm'].getboolean('inplace_default')
 SLURM_SUFFIX = DEFAULTS['submit.slurm']['slurm_suffix']
+ARRAY_NAME = 'array'
+PACK_NAME = 'pack'
+ARRAY_JOBNAME_TOKEN = '@@jobname@@'
 
 # Maybe I need to create the "CandidateTemplate" class, a simpler version to 
 # avoid throwing errors during instantiation to simplify the checking process
@@ -368,8 +377,7 @@ class TemplateSlurm(TemplateText):
         if not any([guesscores,guessmemory]):
             return 
         
-        with open(ifile) as F: 
-            txt = F.read()
+        txt = read_input_header(ifile).text
 
         if guesscores: 
             self._guess_cores(txt)
@@ -493,6 +501,185 @@ def inplace_transformations(filepath:Path,
 
     GIF.write(filepath=filepath)
 
+def resources_key(template:TemplateSlurm) -> tuple:
+    """
+    Returns the values of the template that determine the resources requested
+    to slurm. Templates that share the key can be submitted in the same array.
+    """
+    return (template.partition['name'],
+            getattr(template,'cores',None),
+            template.memory,
+            template.walltime,
+            template.in_suffix,
+            template.out_suffix)
+def set_predicted_walltime(template:TemplateSlurm,ifile:Path):
+    """
+    Sets the walltime of the template to the one predicted for the input file
+    with the walltime model, capped to the max walltime of the partition. If
+    it can not be predicted the default walltime of the template is used.
+    """
+    cores = getattr(template,'cores',None)
+    try:
+        template.walltime = predict_walltime(ifile,
+                                             nprocs=cores,
+                                             max_walltime=template.partition['max_walltime'])
+    except ValueError as e:
+        template.walltime = template.defaults.get('walltime',DEFAULT_WALLTIME)
+        print(f'    {e}, using the default walltime {template.walltime}')
+def split_sbatch_header(text:str) -> tuple[str,str]:
+    """
+    Splits the text of a slurm script after its last '#SBATCH' line of the
+    leading block of comments.
+    """
+    lines = text.splitlines(keepends=True)
+    end = 0
+    for i,line in enumerate(lines): 
+        stripped = line.strip()
+        if stripped.startswith('#SBATCH'):
+            end = i+1
+        elif stripped and not stripped.startswith('#'):
+            break
+    return ''.join(lines[:end]), ''.join(lines[end:])
+def array_script(template:TemplateSlurm,
+                 name:str,
+                 manifest:str,
+                 ntasks:int,
+                 throttle:int|None=None) -> str:
+    """
+    Renders the template as a slurm array script where each task runs the 
+    input specified in the line 'SLURM_ARRAY_TASK_ID + 1' of the manifest.
+
+    Parameters
+    ----------
+    template : TemplateSlurm
+        template with the resources of the array. It must include the 
+        'jobname' keyword.
+    name : str
+        name of the array job.
+    manifest : str
+        path to the manifest, relative to the directory where the array is 
+        submitted. 
+    ntasks : int
+        number of lines of the manifest
+    throttle : int | None, optional
+        max number of tasks running simultaneously, by default None (no limit)
+
+    Returns
+    -------
+    str
+        text of the slurm script
+    """
+    if 'jobname' not in template.expected_keywords: 
+        raise MissingDefault("Array scripts require the 'jobname' keyword in "
+                             "the slurm template")
+    template = copy.copy(template)
+    template.jobname = ARRAY_JOBNAME_TOKEN
+    header,body = split_sbatch_header(str(template))
+    
+    array = f'0-{ntasks-1}'
+    if throttle is not None: 
+        array += f'%{throttle}'
+    
+    preamble = ('\n# Input of this task, line SLURM_ARRAY_TASK_ID+1 of the manifest\n'
+                f'task_input=$(sed -n "$((SLURM_ARRAY_TASK_ID+1))p" {manifest})\n'
+                'cd "${SLURM_SUBMIT_DIR}/$(dirname "${task_input}")"\n'
+                'task_name=$(basename "${task_input}")\n')
+    
+    header = header.replace(ARRAY_JOBNAME_TOKEN,name)
+    body = body.replace(ARRAY_JOBNAME_TOKEN,'${task_name}')
+    return f'{header}#SBATCH --array={array}\n{preamble}{body}'
+
+def pack_script(template:TemplateSlurm,
+                name:str,
+                manifest:str,
+                cores:int,
+                memory:int,
+                poll:int=10) -> str:
+    """
+    Renders the template as a slurm script for a whole node that runs all the
+    inputs of the manifest. Each line of the manifest is 'cores memory input'
+    and the inputs are started in order as soon as enough cores and memory 
+    (in MB) are free within the allocation.
+
+    Parameters
+    ----------
+    template : TemplateSlurm
+        template with the resources of the allocation. It must include the 
+        'jobname' keyword.
+    name : str
+        name of the slurm job.
+    manifest : str
+        path to the manifest, relative to the directory where the job is 
+        submitted.
+    cores : int
+        cores available within the allocation
+    memory : int
+        memory available within the allocation in MB
+    poll : int, optional
+        seconds between checks of finished calculations, by default 10
+
+    Returns
+    -------
+    str
+        text of the slurm script
+    """
+    if 'jobname' not in template.expected_keywords: 
+        raise MissingDefault("Packed scripts require the 'jobname' keyword in "
+                             "the slurm template")
+    template = copy.copy(template)
+    template.jobname = ARRAY_JOBNAME_TOKEN
+    header,body = split_sbatch_header(str(template))
+    header = header.replace(ARRAY_JOBNAME_TOKEN,name)
+    body = body.replace(ARRAY_JOBNAME_TOKEN,'${task_name}')
+    body = ''.join(f'    {line}' if line.strip() else line 
+                   for line in body.splitlines(keepends=True))
+    
+    driver = f"""
+# Runs a single input of the manifest, $1 is its index and $2 its path 
+run_task() {{
+    cd "${{SLURM_SUBMIT_DIR}}/$(dirname "$2")" || return 1
+    task_name=$(basename "$2")
+    # Ensures a different scratch folder per task
+    SLURM_JOBID="${{SLURM_JOBID}}_$1"
+{body}
+}}
+
+# Work queue: start the inputs in order as soon as there are enough resources
+free_cores={cores}
+free_memory={memory}
+declare -A task_cores task_memory
+reap() {{
+    for pid in "${{!task_cores[@]}}"; do
+        if ! kill -0 "${{pid}}" 2> /dev/null; then
+            wait "${{pid}}"
+            echo "Task with pid ${{pid}} finished with status $?"
+            free_cores=$((free_cores + task_cores[${{pid}}]))
+            free_memory=$((free_memory + task_memory[${{pid}}]))
+            unset "task_cores[${{pid}}]" "task_memory[${{pid}}]"
+        fi
+    done
+}}
+
+index=0
+while read -r cores memory task_input; do
+    reap
+    while (( cores > free_cores || memory > free_memory )); do
+        sleep {poll}
+        reap
+    done
+    echo "Starting task ${{index}}: ${{task_input}}"
+    ( run_task "${{index}}" "${{task_input}}" ) &
+    task_cores[$!]=${{cores}}
+    task_memory[$!]=${{memory}}
+    free_cores=$((free_cores - cores))
+    free_memory=$((free_memory - memory))
+    index=$((index + 1))
+done < {manifest}
+
+wait
+"""
+    return f'{header}{driver}'
+
 # File(s) manipulation functions
 def prepare_suffix(suffix:str): 
     if suffix.startswith('.'): 
@@ -683,7 +870,9 @@ def add_template_common_options(parser:argparse.ArgumentParser,
                           default=walltime_default,
                           help="Fixed value of walltime in DD-HH:MM:SS format. "
                           "If none is provided it will use the default value of "
-                          f"'{walltime_default}'",)
+                          f"'{walltime_default}'. If 'auto' it is predicted for "
+                          "each input with the model of "
+                          "'pyssianutils submit walltime train'",)
     walltime.add_argument('--use-max-walltime',
                           dest='use_max_walltime', 
                           default=False, action='store_true',
@@ -712,6 +901,36 @@ def add_template_common_options(parser:argparse.ArgumentParser,
                             action='store_true',default=False,
                             help="attempt to guess the memory from "
                             "the gaussian input file")
+    done = parser.add_mutually_exclusive_group()
+    done.add_argument('--skip-done',
+                      dest='done_action',
+                      action='store_const',const='skip',default=None,
+                      help="Skip the inputs already computed according to the "
+                      "index of 'pyssianutils submit dedup'")
+    done.add_argument('--link-done',
+                      dest='done_action',
+                      action='store_const',const='link',default=None,
+                      help="Skip the inputs already computed according to the "
+                      "index of 'pyssianutils submit dedup' and create a "
+                      f"symbolic link to the existing {GAUSSIAN_OUT_SUFFIX} "
+                      "next to each input")
+    array = parser.add_argument_group(title='job arrays',
+                                      description="Arguments to submit the "
+                                      "inputs as slurm job arrays")
+    array.add_argument('--array',
+                       dest='as_array',
+                       action='store_true',default=False,
+                       help="Instead of a slurm script per input, group the "
+                       "inputs that request the same partition, cores, memory "
+                       "and walltime and create one array script and one "
+                       f"manifest per group ({ARRAY_NAME}_0{SLURM_SUFFIX}, "
+                       f"{ARRAY_NAME}_0.manifest ...). The scripts must be "
+                       "submitted from the folder where they are created.")
+    array.add_argument('--array-throttle',
+                       dest='array_throttle',
+                       type=int,default=None,
+                       help="Maximum number of tasks of each array running "
+                       "simultaneously")
     inplace = parser.add_argument_group(title='inplace modifications',
                                         description="Arguments to modify "
                                         "in-place the provided gaussian input files")
@@ -775,6 +994,9 @@ def _main_generate(templatename:str,
                    guess_memory:bool=False,
                    inplace_mem:None|str=None,
                    inplace_nprocs:None|str=None,
+                   as_array:bool=False,
+                   array_throttle:int|None=None,
+                   done_action:str|None=None,
                    **kwargs):
 
     slurmpath,json_t = USERTEMPLATES[templatename]
@@ -792,6 +1014,7 @@ def _main_generate(templatename:str,
         base_template.set_mem_from_cpu() 
     if use_max_walltime:
         base_template.use_max_walltime()
+    auto_walltime = (not use_max_walltime and kwargs.get('walltime',None) == 'auto')
 
     if len(inputfiles) == 0: 
         print(f'Creating base template: {base_template.jobname}{suffix}')
@@ -799,6 +1022,24 @@ def _main_generate(templatename:str,
             F.write(str(base_template))
         return 
 
+    if as_array:
+        _generate_arrays(base_template,
+                         updated_params,
+                         auto_walltime,
+                         inputfiles,
+                         outdir,
+                         is_folder,
+                         is_listfile,
+                         do_overwrite,
+                         suffix,
+                         guess_cores,
+                         guess_memory,
+                         inplace_mem,
+                         inplace_nprocs,
+                         array_throttle,
+                         done_action)
+        return
+
     ifiles,newfiles = prepare_filepaths(inputfiles,
                                         outdir,
                                         GAUSSIAN_IN_SUFFIX,
@@ -808,6 +1049,10 @@ def _main_generate(templatename:str,
                                         is_inplace,
                                         do_overwrite,
                                         skip)
+    if done_action is not None: 
+        remaining = set(filter_done(ifiles,done_action,GAUSSIAN_OUT_SUFFIX))
+        newfiles = [nf for ifile,nf in zip(ifiles,newfiles) if ifile in remaining]
+        ifiles = [ifile for ifile in ifiles if ifile in remaining]
                                         
     for ifile,newfile in zip(ifiles,newfiles):
         print(f'Creating file {newfile}')
@@ -815,12 +1060,281 @@ def _main_generate(templatename:str,
         template.guess_fromfile(ifile,
                                 guesscores=guess_cores,
                                 guessmemory=guess_memory)
+        if auto_walltime: 
+            set_predicted_walltime(template,ifile)
         with open(newfile,'w') as F: 
             F.write(str(template))
         
         if inplace_mem is not None or inplace_nprocs is not None: 
             inplace_transformations(ifile,template,inplace_mem,inplace_nprocs)
 
+def _generate_arrays(base_template:TemplateSlurm,
+                     updated_params:dict,
+                     auto_walltime:bool,
+                     inputfiles:list[Path],
+                     outdir:str|Path|None,
+                     is_folder:bool,
+                     is_listfile:bool,
+                     do_overwrite:bool,
+                     suffix:str,
+                     guess_cores:bool,
+                     guess_memory:bool,
+                     inplace_mem:None|str,
+                     inplace_nprocs:None|str,
+                     throttle:int|None,
+                     done_action:str|None=None):
+    
+    if is_folder: 
+        ifiles = list(DirectoryTree(inputfiles[0],
+                                    GAUSSIAN_IN_SUFFIX,
+                                    GAUSSIAN_OUT_SUFFIX).infiles)
+    elif is_listfile:
+        with open(Path(inputfiles[0]),'r') as F:
+            ifiles = [Path(line.strip()) for line in F if line.strip()]
+    else:
+        ifiles = [Path(f) for f in inputfiles]
+    ifiles = filter_done(ifiles,done_action,GAUSSIAN_OUT_SUFFIX)
+
+    outdir = Path.cwd() if outdir is None else Path(outdir)
+    outdir.mkdir(parents=True,exist_ok=True)
+
+    # Group the inputs, keeping the order in which each group first appears
+    groups:dict[tuple,list] = dict()
+    for ifile in ifiles:
+        template = base_template.copy_with(**updated_params)
+        template.guess_fromfile(ifile,
+                                guesscores=guess_cores,
+                                guessmemory=guess_memory)
+        if auto_walltime: 
+            set_predicted_walltime(template,ifile)
+        key = resources_key(template)
+        groups.setdefault(key,[]).append((ifile,template))
+    
+    names = [f'{ARRAY_NAME}_{i}' for i in range(len(groups))]
+    
+    if not do_overwrite:
+        for name in names: 
+            for filepath in [outdir/f'{name}{suffix}',outdir/f'{name}.manifest']:
+                if filepath.exists():
+                    raise FileExistsError(f"{filepath} would be overwritten, "
+                                          "and maybe other files. If that is "
+                                          "the desired action please enable "
+                                          "the --overwrite flag")
+
+    for name,(key,items) in zip(names,groups.items()): 
+        partition,cores,memory,walltime,_,_ = key
+        print(f'Creating file {outdir/name}{suffix} with {len(items)} tasks '
+              f'(partition={partition}, cores={cores}, memory={memory}, '
+              f'walltime={walltime})')
+        manifest = outdir/f'{name}.manifest'
+        with open(manifest,'w') as F: 
+            for ifile,_ in items: 
+                relpath = os.path.relpath(ifile.parent.resolve(),outdir.resolve())
+                F.write(f'{Path(relpath)/ifile.stem}\n')
+        text = array_script(items[0][1],name,manifest.name,len(items),throttle)
+        with open(outdir/f'{name}{suffix}','w') as F: 
+            F.write(text)
+        
+        if inplace_mem is not None or inplace_nprocs is not None:
+            for ifile,template in items: 
+                inplace_transformations(ifile,template,inplace_mem,inplace_nprocs)
+
+pack = subparsers.add_parser('pack',
+                             help="""Packs many small calculations into 
+                             allocations of a whole node that run them 
+                             concurrently""")
+pack.add_argument('templatename',
+                  choices=list(USERTEMPLATES.keys()),
+                  help="Name of the template used for the allocations")
+pack.add_argument('inputfiles',
+                  nargs='+',
+                  help="Gaussian input files. Their '%%nprocshared' and "
+                  "'%%mem' are used to distribute them.")
+group_input = pack.add_mutually_exclusive_group()
+group_input.add_argument('-l','--listfile',
+                         dest='is_listfile',
+                         action='store_true',default=False,
+                         help="When enabled instead of considering the "
+                         "files provided as the gaussian input files "
+                         "considers the file provided as a list of gaussian "
+                         "input files")
+group_input.add_argument('-r','--folder',
+                         dest='is_folder',
+                         action='store_true',default=False,
+                         help="Takes the folder and finds recursively all the "
+                         f"{GAUSSIAN_IN_SUFFIX} files in it")
+pack.add_argument('-o','--outdir',
+                  default=None,type=Path,
+                  help="Where to create the new files, defaults to the "
+                  "current directory. The scripts have to be submitted from "
+                  "this folder")
+pack.add_argument('--suffix',
+                  default=SLURM_SUFFIX,
+                  help="suffix of the generated files")
+pack.add_argument('-ow','--overwrite',
+                  dest='do_overwrite',
+                  action='store_true',default=False,
+                  help="When creating the new files if a file with the "
+                  "same name exists overwrites its contents.")
+pack.add_argument('--partition',
+                  default=None,
+                  help="Partition of the template used, by default the "
+                  "default partition of the template")
+pack.add_argument('--node-cores',
+                  dest='node_cores',
+                  type=int,default=None,
+                  help="Cores of a node of the partition. If not provided "
+                  "the 'cores_per_node' of the partition in the template json "
+                  "is used")
+pack.add_argument('--runtime',
+                  default='01:00:00',
+                  help="Estimated runtime of each calculation in "
+                  "DD-HH:MM:SS format, by default 01:00:00. If 'auto' it is "
+                  "predicted for each input with the model of "
+                  "'pyssianutils submit walltime train'")
+pack.add_argument('--max-walltime',
+                  dest='max_walltime',
+                  default=None,
+                  help="Max walltime of each allocation. If not provided the "
+                  "max_walltime of the partition is used")
+pack.add_argument('--margin',
+                  type=float,default=0.25,
+                  help="Fraction added to the estimated time of each "
+                  "allocation when requesting its walltime, by default 0.25")
+pack.add_argument('--overhead',
+                  type=float,default=60,
+                  help="Time in seconds lost per submitted job (queueing, "
+                  "start-up, clean-up) used in the node-hours estimate, by "
+                  "default 60")
+pack.add_argument('--simulate',
+                  dest='only_simulate',
+                  action='store_true',default=False,
+                  help="Only display the packing and the estimate of the "
+                  "node-hours saved, without creating any file")
+pack.add_argument('--skip-done',
+                  dest='skip_done',
+                  action='store_true',default=False,
+                  help="Skip the inputs already computed according to the "
+                  "index of 'pyssianutils submit dedup'")
+def _main_pack(templatename:str,
+               inputfiles:list[str|Path],
+               is_listfile:bool=False,
+               is_folder:bool=False,
+               outdir:Path|None=None,
+               suffix:str=SLURM_SUFFIX,
+               do_overwrite:bool=False,
+               partition:str|None=None,
+               node_cores:int|None=None,
+               runtime:str='01:00:00',
+               max_walltime:str|None=None,
+               margin:float=0.25,
+               overhead:float=60,
+               only_simulate:bool=False,
+               skip_done:bool=False):
+    
+    slurmpath,json_t = USERTEMPLATES[templatename]
+    json_t.ensure_reasonable_defaults()
+    suffix = prepare_suffix(suffix)
+
+    if partition is None: 
+        partition = json_t.defaults['partition']
+    if partition not in json_t.choices['partition']:
+        raise ErrorDefault(f"partition={partition} is not within the available "
+                           f"choices {list(json_t.choices['partition'].keys())}")
+    partition_info = json_t.choices['partition'][partition]
+
+    if node_cores is None: 
+        node_cores = partition_info.get('cores_per_node',None)
+    if node_cores is None: 
+        raise ValueError("The number of cores of a node was not provided and "
+                         f"the partition '{partition}' has no 'cores_per_node'")
+    node_cores = int(node_cores)
+    node_memory = node_cores*int(partition_info['mem_per_cpu'])
+    if max_walltime is None: 
+        max_walltime = partition_info['max_walltime']
+    max_time = walltime_to_seconds(max_walltime)
+    if max_time <= 0: 
+        raise ValueError(f"Invalid max walltime {max_walltime}")
+    max_time = max_time/(1+margin)
+
+    # Read the requested resources of each input
+    if is_folder: 
+        ifiles = list(DirectoryTree(inputfiles[0],
+                                    GAUSSIAN_IN_SUFFIX,
+                                    GAUSSIAN_OUT_SUFFIX).infiles)
+    elif is_listfile:
+        with open(Path(inputfiles[0]),'r') as F:
+            ifiles = [Path(line.strip()) for line in F if line.strip()]
+    else:
+        ifiles = [Path(f) for f in inputfiles]
+    if skip_done: 
+        ifiles = filter_done(ifiles,'skip',GAUSSIAN_OUT_SUFFIX)
+    
+    jobs = []
+    for ifile in ifiles: 
+        header = read_input_header(ifile)
+        cores = header.nprocs
+        memory = header.memory_mb
+        if cores is None or memory is None: 
+            raise ValueError(f"'%nprocshared' and '%mem' must be specified in {ifile}")
+        if runtime == 'auto': 
+            try:
+                seconds = predict_seconds(ifile,cores)
+            except ValueError as e:
+                default = json_t.defaults.get('walltime',DEFAULT_WALLTIME)
+                print(f'{e}, using the default walltime {default}')
+                seconds = walltime_to_seconds(default)
+        else: 
+            seconds = walltime_to_seconds(runtime)
+        jobs.append(PackJob(ifile,cores,memory,seconds))
+
+    allocations,unpackable = pack_jobs(jobs,node_cores,node_memory,max_time)
+    
+    for job in unpackable: 
+        print(f'{job.filepath} does not fit in a single allocation and was not packed')
+
+    summary = simulate([j for j in jobs if j not in unpackable],
+                       allocations,node_cores,node_memory,overhead)
+    print(f"{summary['jobs']} calculations packed in {summary['allocations']} "
+          f"allocations of {node_cores} cores and {node_memory}MB")
+    for i,allocation in enumerate(allocations): 
+        print(f'    {PACK_NAME}_{i}: {len(allocation)} calculations, '
+              f'{seconds_to_walltime(allocation.makespan)} estimated, '
+              f'{allocation.utilization:.0%} of the cores used')
+    print(f"Estimated node-hours: {summary['baseline']:.2f} as independent "
+          f"jobs, {summary['packed']:.2f} packed "
+          f"({summary['saved']:.2f} saved)")
+    
+    if only_simulate: 
+        return
+
+    outdir = Path.cwd() if outdir is None else Path(outdir)
+    outdir.mkdir(parents=True,exist_ok=True)
+    names = [f'{PACK_NAME}_{i}' for i in range(len(allocations))]
+    if not do_overwrite:
+        for name in names: 
+            for filepath in [outdir/f'{name}{suffix}',outdir/f'{name}.manifest']:
+                if filepath.exists():
+                    raise FileExistsError(f"{filepath} would be overwritten, "
+                                          "and maybe other files. If that is "
+                                          "the desired action please enable "
+                                          "the --overwrite flag")
+
+    base_template = TemplateSlurm.from_file(slurmpath,
+                                            json_t,
+                                            partition=partition)
+    for name,allocation in zip(names,allocations): 
+        walltime = seconds_to_walltime(allocation.makespan*(1+margin))
+        template = base_template.copy_with(walltime=walltime)
+        template.cores = node_cores
+        template.memory = f'{node_memory}MB'
+        manifest = outdir/f'{name}.manifest'
+        write_manifest(manifest,allocation,outdir)
+        print(f'Creating file {outdir/name}{suffix}')
+        with open(outdir/f'{name}{suffix}','w') as F: 
+            F.write(pack_script(template,name,manifest.name,
+                                node_cores,node_memory))
+
 check = subparsers.add_parser('check-template',
                               help="""Inspects a template to display the keywords
                               in present, and ensures that it contains the 
@@ -950,6 +1464,8 @@ def main(
             _main_add_template(**kwargs)
         case 'rm-template': 
             _main_rm_template(**kwargs)
+        case 'pack': 
+            _main_pack(**kwargs)
         case _:
             if slurm_mode not in USERTEMPLATES: 
                 raise RuntimeError(f"Slurm template name {slurm_mode} is not"
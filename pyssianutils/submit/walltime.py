@@ -0,0 +1,419 @@
+__doc__ = """
+Estimates the walltime of gaussian calculations from previous calculations.
+The 'train' command harvests the elapsed times, cores, number of basis
+functions, atoms, method and job type of finished outputs and fits, for each
+method and job type, a linear regression of log(elapsed time) vs log(basis
+functions) together with the serial fraction of Amdahl's law when the outputs
+were run with several core counts. The model is stored in the app directory ({model}) and used by
+the 'predict' command and by 'slurm' with '--walltime auto'.
+"""
+
+import re
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+from pyssian.chemistryutils import PeriodicTable
+
+from ..initialize import get_appdir, load_app_defaults
+from ..utils import (DirectoryTree, harvest_output, parse_route, run_in_pool,
+                     read_input_header, atomic_write, NATOMS_PATTERN)
+from ..others.scaling import amdahl_efficiency
+from .packing import walltime_to_seconds, seconds_to_walltime
+
+# Load app defaults
+DEFAULTS = load_app_defaults()
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+MODEL_PATH = get_appdir()/'models'/'walltime.json'
+
+MIN_SAMPLES = 3
+DEFAULT_Z = 1.645 # one-sided 95% of a normal distribution
+MIN_WALLTIME = 15*60 # seconds
+# Predicted walltimes are rounded up to the next value (in hours) to keep
+# similar calculations with identical requests
+WALLTIME_LADDER = [0.25,0.5,1,2,4,6,8,12,24,48,72]
+SERIAL_FRACTIONS = np.linspace(0,1,201) # candidates of the fit
+FCHK_NATOMS_PATTERN = re.compile(r'^Number of atoms\s+I\s+([0-9]+)')
+# Tokens after the symbol of an atom: z-matrix (0,2,4,6 and a trailing flag)
+# or cartesian (3 and a leading freeze flag). Variables have a single value.
+ATOM_TOKENS = (0,2,3,4,6,7)
+
+# Utility Functions and classes
+def speedup(cores:int|np.ndarray,f:float) -> float|np.ndarray:
+    """
+    Speedup over a single core according to Amdahl's law.
+    """
+    return cores*amdahl_efficiency(cores,f)
+def fit_serial_fraction(x:np.ndarray,
+                        elapsed:np.ndarray,
+                        cores:np.ndarray) -> float:
+    """
+    Serial fraction that best explains the elapsed times of calculations run
+    with different core counts, choosing the one that minimizes the residuals
+    of the regression of the single core times vs x (log of the basis 
+    functions).
+    """
+    best, best_rss = 0.0, np.inf
+    for f in SERIAL_FRACTIONS:
+        y = np.log(elapsed*speedup(cores,f))
+        b,a = np.polyfit(x,y,1)
+        rss = float(np.sum((y - (a + b*x))**2))
+        if rss < best_rss:
+            best, best_rss = float(f), rss
+    return best
+
+class WalltimeModel(object):
+    """
+    Per method and job type regressions of log(elapsed time) vs log(basis
+    functions).
+
+    Parameters
+    ----------
+    regressions : dict[str,dict[str,float]]
+        maps 'method|jobtype' (where either can be '*' for all the methods or
+        job types) to the intercept 'a', slope 'b', standard deviation of the
+        residuals 'sigma', 'serial_fraction' of Amdahl's law (None if all the
+        outputs used the same core count), 'cores' the regression refers to
+        (1 if the serial fraction is known) and number of 'samples'.
+    ratios : dict[str,float]
+        basis functions per atom of each basis set, '*' for all basis sets.
+    """
+    def __init__(self,
+                 regressions:dict[str,dict[str,float]],
+                 ratios:dict[str,float]):
+        self.regressions = regressions
+        self.ratios = ratios
+
+    @classmethod
+    def fit(cls,records:list[dict],min_samples:int=MIN_SAMPLES):
+        """
+        Fits the model to the outputs harvested with utils.harvest_output.
+        Only outputs with a normal termination and with elapsed time, number 
+        of atoms and basis functions are used.
+        """
+        records = [r for r in records
+                   if r['normal'] and r['elapsed'] and r['nbasis'] and r['natoms']]
+
+        ratios = dict()
+        by_basis = dict()
+        for r in records:
+            by_basis.setdefault(r['basis'],[]).append(r['nbasis']/r['natoms'])
+        for basis,values in by_basis.items():
+            ratios[str(basis)] = float(np.median(values))
+        if records:
+            ratios['*'] = float(np.median([r['nbasis']/r['natoms'] for r in records]))
+
+        groups = dict()
+        for r in records:
+            for key in [f"{r['method']}|{r['jobtype']}",
+                        f"*|{r['jobtype']}",
+                        '*|*']:
+                groups.setdefault(key,[]).append(r)
+
+        regressions = dict()
+        for key,items in groups.items():
+            x = np.log([r['nbasis'] for r in items])
+            if len(items) < min_samples or np.ptp(x) == 0:
+                continue
+            elapsed = np.array([r['elapsed'] for r in items],dtype=float)
+            cores = np.array([r['nprocs'] for r in items])
+            # The speedup can only be measured across several core counts
+            if len(set(cores)) > 1:
+                f = fit_serial_fraction(x,elapsed,cores)
+                reference = 1
+                y = np.log(elapsed*speedup(cores,f))
+            else:
+                f = None
+                reference = int(cores[0])
+                y = np.log(elapsed)
+            b,a = np.polyfit(x,y,1)
+            residuals = y - (a + b*x)
+            sigma = float(np.sqrt(np.sum(residuals**2)/max(len(items)-2,1)))
+            regressions[key] = dict(a=float(a),b=float(b),sigma=sigma,
+                                    serial_fraction=f,cores=reference,
+                                    samples=len(items))
+        return cls(regressions,ratios)
+
+    def regression(self,method:str|None,jobtype:str) -> dict[str,float]:
+        for key in [f'{method}|{jobtype}',f'*|{jobtype}','*|*']:
+            if key in self.regressions:
+                return self.regressions[key]
+        raise KeyError(f'No walltime model available for {method} {jobtype}')
+
+    def predict(self,
+                method:str|None,
+                basis:str|None,
+                jobtype:str,
+                natoms:int,
+                nprocs:int,
+                z:float=DEFAULT_Z) -> float:
+        """
+        Returns the upper estimate of the elapsed time in seconds, z standard
+        deviations above the regression.
+        """
+        reg = self.regression(method,jobtype)
+        ratio = self.ratios.get(str(basis),self.ratios.get('*'))
+        nbasis = max(ratio*natoms,1.0)
+        elapsed = np.exp(reg['a'] + reg['b']*np.log(nbasis) + z*reg['sigma'])
+        if reg['serial_fraction'] is not None:
+            return float(elapsed/speedup(nprocs,reg['serial_fraction']))
+        # Without a measured speedup, fewer cores are assumed to scale
+        # perfectly and more cores are assumed not to reduce the time
+        return float(elapsed*max(1.0,reg['cores']/nprocs))
+
+    def write(self,filepath:Path=MODEL_PATH):
+        filepath = Path(filepath)
+        filepath.parent.mkdir(parents=True,exist_ok=True)
+        data = dict(regressions=self.regressions,ratios=self.ratios)
+        atomic_write(filepath,json.dumps(data,indent=4))
+
+    @classmethod
+    def from_file(cls,filepath:Path=MODEL_PATH):
+        if not Path(filepath).exists():
+            raise FileNotFoundError(f"No walltime model found at {filepath}. "
+                                    "Please run 'pyssianutils submit walltime "
+                                    "train' first")
+        with open(filepath,'r') as F:
+            data = json.load(F)
+        if any('serial_fraction' not in reg for reg in data['regressions'].values()):
+            raise ValueError(f"The walltime model at {filepath} was trained "
+                             "with a previous version. Please run "
+                             "'pyssianutils submit walltime train' again")
+        return cls(data['regressions'],data['ratios'])
+
+def round_walltime(seconds:float,max_walltime:str|None=None) -> str:
+    """
+    Rounds up the seconds to the next value of WALLTIME_LADDER (or to the next
+    day for longer times), caps it to the max_walltime and formats it as
+    'DD-HH:MM:SS'.
+    """
+    seconds = max(seconds,MIN_WALLTIME)
+    for hours in WALLTIME_LADDER:
+        if seconds <= hours*3600:
+            seconds = hours*3600
+            break
+    else:
+        seconds = np.ceil(seconds/86400)*86400
+    if max_walltime is not None:
+        seconds = min(seconds,walltime_to_seconds(max_walltime))
+    return seconds_to_walltime(seconds)
+def is_atom_line(line:str) -> bool:
+    """
+    True if the line of a molecule specification defines an atom (not a dummy
+    atom nor a z-matrix variable).
+    """
+    tokens = line.replace(',',' ').split()
+    if not tokens or len(tokens)-1 not in ATOM_TOKENS:
+        return False
+    symbol = re.split(r'[-(]',tokens[0])[0]
+    if not symbol.isdigit():
+        symbol = symbol.rstrip('0123456789').capitalize()
+    element = PeriodicTable.get(symbol,None)
+    return element is not None and element not in ('X',0)
+def count_input_atoms(ifile:str|Path) -> int:
+    """
+    Number of atoms in the molecule specification of a gaussian input file,
+    0 if the geometry is read from the checkpoint.
+    """
+    header = read_input_header(ifile)
+    with open(ifile,'r') as F:
+        text = F.read()
+    lines = text[len(header.text):].splitlines()
+    # title, blank line, charge and spin and then the molecule specification
+    i = 0
+    while i < len(lines) and not lines[i].strip():
+        i += 1
+    while i < len(lines) and lines[i].strip():
+        i += 1
+    i += 2
+    natoms = 0
+    for line in lines[i:]:
+        if not line.strip():
+            break
+        natoms += is_atom_line(line)
+    return natoms
+def count_checkpoint_atoms(ifile:str|Path,
+                           out_suffix:str=GAUSSIAN_OUTPUT_SUFFIX) -> int|None:
+    """
+    Number of atoms of an input that reads its geometry from a checkpoint,
+    read from the formatted checkpoint or the output of the calculation that
+    wrote it or from a previous output of the input. None if none is found.
+    """
+    ifile = Path(ifile)
+    header = read_input_header(ifile)
+    candidates = []
+    for key in ('oldchk','chk'):
+        if key in header.link0:
+            chk = ifile.parent/header.link0[key].strip().strip('"')
+            candidates.extend([chk.with_suffix('.fchk'),
+                               chk.with_suffix('.fch'),
+                               chk.with_suffix(out_suffix)])
+    candidates.append(ifile.with_suffix(out_suffix))
+    for candidate in candidates:
+        if not candidate.is_file():
+            continue
+        with open(candidate,'r',errors='replace') as F:
+            for line in F:
+                match = FCHK_NATOMS_PATTERN.match(line) or NATOMS_PATTERN.search(line)
+                if match is not None:
+                    return int(match.group(1))
+    return None
+def input_features(ifile:str|Path) -> tuple[str|None,str|None,str,int|None]:
+    """
+    Returns the method, basis, jobtype and number of atoms of a gaussian input
+    file. The number of atoms is None if the geometry is read from a 
+    checkpoint and it could not be found in a related file.
+    """
+    header = read_input_header(ifile)
+    method, basis, jobtype = parse_route(header.route)
+    natoms = count_input_atoms(ifile) or count_checkpoint_atoms(ifile)
+    return method, basis, jobtype, natoms
+def predict_seconds(ifile:str|Path,
+                    nprocs:int|None=None,
+                    model:WalltimeModel|None=None,
+                    z:float=DEFAULT_Z) -> float:
+    """
+    Predicts the elapsed time in seconds of a gaussian input file.
+
+    Parameters
+    ----------
+    ifile : str | Path
+        gaussian input file
+    nprocs : int | None, optional
+        cores used, by default the '%nprocshared' of the input
+    model : WalltimeModel | None, optional
+        model used, by default the one stored in the app directory
+    z : float, optional
+        standard deviations above the regression, by default 1.645
+
+    Returns
+    -------
+    float
+        upper estimate of the elapsed time in seconds
+
+    Raises
+    ------
+    ValueError
+        If the number of atoms of the input can not be determined
+    """
+    if model is None:
+        model = load_model()
+    if nprocs is None:
+        nprocs = read_input_header(ifile).nprocs or 1
+    method, basis, jobtype, natoms = input_features(ifile)
+    if not natoms:
+        raise ValueError(f'The number of atoms of {ifile} could not be determined')
+    return model.predict(method,basis,jobtype,natoms,int(nprocs),z)
+def predict_walltime(ifile:str|Path,
+                     nprocs:int|None=None,
+                     max_walltime:str|None=None,
+                     model:WalltimeModel|None=None,
+                     z:float=DEFAULT_Z) -> str:
+    """
+    Predicts a walltime in 'DD-HH:MM:SS' format for a gaussian input file 
+    rounded up with round_walltime. See predict_seconds for the parameters. 
+    """
+    seconds = predict_seconds(ifile,nprocs,model,z)
+    return round_walltime(seconds,max_walltime)
+
+_MODEL = None
+def load_model() -> WalltimeModel:
+    global _MODEL
+    if _MODEL is None:
+        _MODEL = WalltimeModel.from_file(MODEL_PATH)
+    return _MODEL
+
+# Define Parser and main
+__doc__ = __doc__.format(model=MODEL_PATH)
+
+parser = argparse.ArgumentParser(description=__doc__)
+subparsers = parser.add_subparsers(help='sub-command help',dest='walltime_mode')
+
+train = subparsers.add_parser('train',
+                              help="Fit the model to the outputs found "
+                              "recursively in the folders provided")
+train.add_argument('folders',
+                   nargs='+',type=Path,
+                   help="Folders with gaussian output files")
+train.add_argument('--suffix',
+                   default=GAUSSIAN_OUTPUT_SUFFIX,
+                   help="suffix of the gaussian output files")
+train.add_argument('-j','--jobs',
+                   type=int,default=DEFAULT_JOBS,
+                   help="Number of parallel processes used to read the "
+                   f"outputs, by default {DEFAULT_JOBS}")
+train.add_argument('--min-samples',
+                   dest='min_samples',
+                   type=int,default=MIN_SAMPLES,
+                   help="Minimum number of outputs to fit the regression of "
+                   f"a method and job type, by default {MIN_SAMPLES}")
+
+predict = subparsers.add_parser('predict',
+                                help="Predict the walltime of gaussian "
+                                "input files")
+predict.add_argument('inputfiles',
+                     nargs='+',type=Path,
+                     help="Gaussian input files")
+predict.add_argument('--cores',
+                     type=int,default=None,
+                     help="Cores used, by default the '%%nprocshared' of "
+                     "each input")
+predict.add_argument('-z',
+                     dest='z',
+                     type=float,default=DEFAULT_Z,
+                     help="Standard deviations above the regression used for "
+                     f"the prediction, by default {DEFAULT_Z}")
+
+def _main_train(folders:list[Path],
+                suffix:str=GAUSSIAN_OUTPUT_SUFFIX,
+                jobs:int=DEFAULT_JOBS,
+                min_samples:int=MIN_SAMPLES):
+    ofiles = []
+    for folder in folders:
+        ofiles.extend(DirectoryTree(folder,GAUSSIAN_INPUT_SUFFIX,suffix).outfiles)
+
+    records = []
+    for ofile,(record,error) in zip(ofiles,run_in_pool(harvest_output,
+                                                       [(f,) for f in ofiles],
+                                                       jobs)):
+        if error is not None:
+            print(f'Could not read {ofile}: {error}')
+        elif record is not None:
+            records.append(record)
+    print(f'{len(records)} outputs read from {len(ofiles)} files')
+
+    model = WalltimeModel.fit(records,min_samples)
+    for key,reg in sorted(model.regressions.items()):
+        method,jobtype = key.split('|')
+        f = reg['serial_fraction']
+        f = f'{f:.3f}' if f is not None else f"n/a ({reg['cores']} cores)"
+        print(f"    {method:>12} {jobtype:<12} samples={reg['samples']:<5d} "
+              f"slope={reg['b']:.2f} sigma={reg['sigma']:.2f} "
+              f"serial_fraction={f}")
+    if not model.regressions:
+        raise RuntimeError('Not enough finished outputs to fit the model')
+    model.write(MODEL_PATH)
+    print(f'Model stored at {MODEL_PATH}')
+def _main_predict(inputfiles:list[Path],
+                  cores:int|None=None,
+                  z:float=DEFAULT_Z):
+    model = load_model()
+    for ifile in inputfiles:
+        try:
+            walltime = predict_walltime(ifile,cores,model=model,z=z)
+        except ValueError as e:
+            walltime = f'unknown, {e}'
+        print(f'{ifile}    {walltime}')
+
+def main(walltime_mode:str|None=None,
+         **kwargs):
+    match walltime_mode:
+        case 'train':
+            _main_train(**kwargs)
+        case 'predict':
+            _main_predict(**kwargs)
+        case _:
+            parser.print_help()
@@ -0,0 +1,371 @@
+__doc__ = """
+Chains the stages of a protocol (e.g. optimization -> distort-ts -> single
+points) as slurm jobs with dependencies. 'generate' reads a workflow
+specification, creates placeholder inputs for every downstream stage, one
+slurm script per input and a script ({script_suffix}) that submits them with
+'--dependency=afterok'. At the end of each job a hook
+('{hook} submit workflow materialize') creates the inputs of the next stages
+from the finished output.
+"""
+
+import os
+import re
+import json
+import copy
+import argparse
+import itertools
+from pathlib import Path
+
+from ..initialize import load_app_defaults
+from ..utils import atomic_write, has_normal_termination
+from ..input.asinput import generate_variants, prepare_tail
+from ..input.distortts import distort_file, distortion_label
+from ..input.distortts import FORWARD_MARK, REVERSE_MARK, DEFAULT_FACTOR
+from .slurm import USERTEMPLATES, TemplateSlurm, SLURM_SUFFIX
+
+try:
+    import yaml
+except ImportError as e:
+    YAML_LOADED = False
+    YAML_ERROR = e
+else:
+    YAML_LOADED = True
+
+# Load app defaults
+DEFAULTS = load_app_defaults()
+GAUSSIAN_INPUT_SUFFIX = DEFAULTS['common']['in_suffix']
+GAUSSIAN_OUTPUT_SUFFIX = DEFAULTS['common']['out_suffix']
+DEFAULT_HOOK = DEFAULTS['submit.workflow']['hook']
+DEFAULT_NAME = DEFAULTS['submit.workflow']['name']
+SCRIPT_SUFFIX = '.sh'
+
+KINDS = ('asinput','distort-ts')
+ASINPUT_OPTIONS = ('method','basis','solvent','solvation_model','add_text',
+                   'tail','as_SP')
+CHK_PATTERN = re.compile(r'^%chk=.*$',re.IGNORECASE|re.MULTILINE)
+PLACEHOLDER = ("! Placeholder of the workflow stage '{stage}'. It is created "
+               "from {parent} when it finishes\n")
+
+# Utility Functions
+def read_spec(filepath:Path) -> dict:
+    """
+    Reads and validates a workflow specification (json or yaml). It contains
+    the name of the slurm 'template' and the 'stages', a mapping of stage names
+    to their definition:
+
+    - after: name of the stage whose outputs are used. Exactly one stage (the
+      one of the inputs provided) has no 'after'.
+    - kind: 'asinput' (default) or 'distort-ts'.
+    - options: for 'asinput' any of method, basis, solvent, solvation_model,
+      add_text, tail and as_SP. For 'distort-ts' modes and factors.
+    - slurm: values of the slurm template used for the stage (e.g. walltime).
+      By default the cores and memory of the previous stage are used.
+    """
+    filepath = Path(filepath)
+    with open(filepath,'r') as F:
+        if filepath.suffix in ['.yaml','.yml']:
+            if not YAML_LOADED:
+                raise YAML_ERROR
+            spec = yaml.safe_load(F)
+        else:
+            spec = json.load(F)
+
+    if spec.get('template',None) not in USERTEMPLATES:
+        raise ValueError(f"template={spec.get('template',None)} is not among "
+                         f"the slurm templates {list(USERTEMPLATES.keys())}")
+    stages = spec['stages']
+    roots = [name for name,stage in stages.items() if not stage.get('after',None)]
+    if len(roots) != 1:
+        raise ValueError(f'Exactly one stage without "after" is required, found {roots}')
+    for name,stage in stages.items():
+        stage.setdefault('options',dict())
+        stage.setdefault('slurm',dict())
+        if name == roots[0]:
+            continue
+        stage.setdefault('kind','asinput')
+        if stage['after'] not in stages:
+            raise ValueError(f"stage '{name}' is after the unknown stage '{stage['after']}'")
+        if stage['kind'] not in KINDS:
+            raise ValueError(f"Unknown kind '{stage['kind']}' of stage '{name}', "
+                             f"valid kinds are {list(KINDS)}")
+        if stage['kind'] == 'asinput':
+            unknown = set(stage['options']) - set(ASINPUT_OPTIONS)
+        else:
+            unknown = set(stage['options']) - {'modes','factors'}
+        if unknown:
+            raise ValueError(f"Unknown options {sorted(unknown)} in stage '{name}'")
+    spec['root'] = roots[0]
+    return spec
+def stage_order(spec:dict) -> list[str]:
+    """
+    Stages sorted so that every stage comes after its parent.
+    """
+    order = [spec['root'],]
+    pending = [name for name in spec['stages'] if name != spec['root']]
+    while pending:
+        ready = [n for n in pending if spec['stages'][n]['after'] in order]
+        if not ready:
+            raise ValueError(f'The stages {pending} form a cycle')
+        order.extend(ready)
+        pending = [n for n in pending if n not in ready]
+    return order
+def child_inputs(parent:Path,stage_name:str,stage:dict) -> list[Path]:
+    """
+    Names of the inputs that a stage creates from the input of its parent
+    stage. 'distort-ts' stages create a forward and reverse input per mode
+    and factor, in the order of itertools.product(modes,factors).
+    """
+    base = f'{parent.stem}_{stage_name}'
+    if stage['kind'] == 'asinput':
+        return [parent.with_stem(base),]
+    modes = stage['options'].get('modes',[1,])
+    factors = stage['options'].get('factors',[DEFAULT_FACTOR,])
+    combinations = list(itertools.product(modes,factors))
+    children = []
+    for mode,factor in combinations:
+        label = f'_{distortion_label(mode,factor)}' if len(combinations) > 1 else ''
+        children.append(parent.with_stem(f'{base}{label}_{FORWARD_MARK}'))
+        children.append(parent.with_stem(f'{base}{label}_{REVERSE_MARK}'))
+    return children
+def build_nodes(spec:dict,
+                ifiles:list[Path],
+                out_suffix:str=GAUSSIAN_OUTPUT_SUFFIX) -> list[dict]:
+    """
+    Creates the calculations of the workflow. Each node is a dict with its
+    'stage', 'input', 'output', 'parent' (index) and 'children' (indices).
+    Parents always precede their children.
+    """
+    nodes = []
+    for ifile in ifiles:
+        nodes.append(dict(stage=spec['root'],input=Path(ifile),
+                          output=Path(ifile).with_suffix(out_suffix),
+                          parent=None,children=[]))
+    for stage_name in stage_order(spec)[1:]:
+        stage = spec['stages'][stage_name]
+        for i,node in enumerate(list(nodes)):
+            if node['stage'] != stage['after']:
+                continue
+            for child in child_inputs(node['input'],stage_name,stage):
+                node['children'].append(len(nodes))
+                nodes.append(dict(stage=stage_name,input=child,
+                                  output=child.with_suffix(out_suffix),
+                                  parent=i,children=[]))
+    return nodes
+def node_templates(spec:dict,nodes:list[dict]) -> list[TemplateSlurm]:
+    """
+    Slurm template of each node. The cores and memory of the inputs provided
+    are read from them, the downstream stages inherit them from their parent
+    unless specified in the 'slurm' of the stage.
+    """
+    slurmpath,json_t = USERTEMPLATES[spec['template']]
+    json_t.ensure_reasonable_defaults()
+    base = TemplateSlurm.from_file(slurmpath,json_t)
+    per_stage = {name:base.copy_with(**stage['slurm'])
+                 for name,stage in spec['stages'].items()}
+
+    templates = []
+    for node in nodes:
+        stage = spec['stages'][node['stage']]
+        template = copy.copy(per_stage[node['stage']])
+        if node['parent'] is None:
+            template.guess_fromfile(node['input'],
+                                    guesscores='cores' not in stage['slurm'],
+                                    guessmemory='memory' not in stage['slurm'])
+        else:
+            template.guess_fromfile(node['input'],False,False)
+            parent = templates[node['parent']]
+            if 'cores' not in stage['slurm'] and hasattr(parent,'cores'):
+                template.cores = parent.cores
+            if 'memory' not in stage['slurm']:
+                template.memory = parent.memory
+        templates.append(template)
+    return templates
+def hook_text(hook:str,workflow_file:Path,index:int,folder:Path) -> str:
+    relpath = os.path.relpath(workflow_file.resolve(),folder.resolve())
+    return ("\n# Workflow hook: creates the inputs of the next stages\n"
+            f"{hook} submit workflow materialize {relpath} {index} || exit 1\n")
+def submit_script(nodes:list[dict],scripts:list[Path],rootdir:Path) -> str:
+    """
+    Text of the bash script that submits all the jobs, each one from its
+    folder and depending on the job of its parent.
+    """
+    lines = ['#!/bin/bash',
+             '# Automated Submit Script',
+             'BASEDIR=$PWD;']
+    for i,(node,script) in enumerate(zip(nodes,scripts)):
+        folder = os.path.relpath(script.parent.resolve(),rootdir.resolve())
+        dependency = ''
+        if node['parent'] is not None:
+            dependency = (f"--dependency=afterok:${{job_{node['parent']}}} "
+                          "--kill-on-invalid-dep=yes ")
+        lines.append(f'cd {folder}; job_{i}=$(sbatch --parsable {dependency}'
+                     f'{script.name}); cd ${{BASEDIR}};')
+        lines.append(f'echo "Submitted {script.name} as ${{job_{i}}}";')
+    return '\n'.join(lines)+'\n'
+
+def own_checkpoint(ifile:Path):
+    """
+    Renames the checkpoint of an input after the input, to avoid calculations
+    of the same stage, which run simultaneously, sharing their checkpoint.
+    """
+    with open(ifile,'r') as F:
+        text = F.read()
+    text = CHK_PATTERN.sub(f'%chk={ifile.stem}.chk',text,count=1)
+    atomic_write(ifile,text)
+def materialize(workflow_file:Path,index:int) -> list[Path]:
+    """
+    Creates the inputs of the stages that follow a finished calculation of
+    the workflow.
+    """
+    workflow_file = Path(workflow_file)
+    rootdir = workflow_file.parent
+    with open(workflow_file,'r') as F:
+        workflow = json.load(F)
+    stages = workflow['stages']
+    nodes = workflow['nodes']
+    node = nodes[index]
+    tfile = rootdir/node['input']
+    ofile = rootdir/node['output']
+    if not has_normal_termination(ofile):
+        raise RuntimeError(f'{ofile} did not finish with a normal termination')
+
+    created = []
+    children = [nodes[i] for i in node['children']]
+    for stage_name,group in itertools.groupby(children,key=lambda n: n['stage']):
+        stage = stages[stage_name]
+        newfiles = [rootdir/child['input'] for child in group]
+        options = stage['options']
+        if stage['kind'] == 'asinput':
+            kwargs = {k:options.get(k,None) for k in ASINPUT_OPTIONS}
+            kwargs['as_SP'] = bool(kwargs['as_SP'])
+            if kwargs['tail'] is not None:
+                kwargs['tail'] = prepare_tail(rootdir/kwargs['tail'])
+            for newfile in newfiles:
+                generate_variants(tfile,ofile,[newfile,],[dict(),],**kwargs)
+        else:
+            pairs = list(zip(newfiles[0::2],newfiles[1::2]))
+            distort_file(tfile,ofile,pairs,
+                         modes=options.get('modes',[1,]),
+                         factors=options.get('factors',[DEFAULT_FACTOR,]))
+        for newfile in newfiles:
+            own_checkpoint(newfile)
+        created.extend(newfiles)
+    return created
+
+# Define Parser and main
+__doc__ = __doc__.format(script_suffix=f'{DEFAULT_NAME}{SCRIPT_SUFFIX}',
+                         hook=DEFAULT_HOOK)
+
+parser = argparse.ArgumentParser(description=__doc__)
+subparsers = parser.add_subparsers(help='sub-command help',dest='workflow_mode')
+
+generate = subparsers.add_parser('generate',
+                                 help="Create the placeholder inputs, slurm "
+                                 "scripts and submit script of a workflow")
+generate.add_argument('specfile',
+                      type=Path,
+                      help="json or yaml file with the workflow specification")
+generate.add_argument('inputfiles',
+                      nargs='+',type=Path,
+                      help="Gaussian input files of the first stage")
+generate.add_argument('-o','--outdir',
+                      default=None,type=Path,
+                      help="Where the workflow state and the submit script are "
+                      "created, defaults to the current directory. The inputs "
+                      "and slurm scripts are created next to the inputs provided.")
+generate.add_argument('--name',
+                      default=DEFAULT_NAME,
+                      help="Name of the workflow state (.json) and submit "
+                      f"script ({SCRIPT_SUFFIX}) files, by default {DEFAULT_NAME}")
+generate.add_argument('--hook',
+                      default=DEFAULT_HOOK,
+                      help="Command used to run pyssianutils in the jobs, by "
+                      f"default '{DEFAULT_HOOK}'")
+generate.add_argument('--suffix',
+                      default=SLURM_SUFFIX,
+                      help="suffix of the generated slurm scripts")
+generate.add_argument('-ow','--overwrite',
+                      dest='do_overwrite',
+                      action='store_true',default=False,
+                      help="Overwrite previously existing files")
+
+materialize_parser = subparsers.add_parser('materialize',
+                                           help="Create the inputs of the "
+                                           "next stages of a finished "
+                                           "calculation. Run by the slurm jobs")
+materialize_parser.add_argument('workflow_file',
+                                type=Path,
+                                help="Workflow state file created by 'generate'")
+materialize_parser.add_argument('index',
+                                type=int,
+                                help="Index of the finished calculation")
+
+def _main_generate(specfile:Path,
+                   inputfiles:list[Path],
+                   outdir:Path|None=None,
+                   name:str=DEFAULT_NAME,
+                   hook:str=DEFAULT_HOOK,
+                   suffix:str=SLURM_SUFFIX,
+                   do_overwrite:bool=False):
+    spec = read_spec(specfile)
+    outdir = Path.cwd() if outdir is None else Path(outdir)
+    outdir.mkdir(parents=True,exist_ok=True)
+    workflow_file = outdir/f'{name}.json'
+    script_file = outdir/f'{name}{SCRIPT_SUFFIX}'
+
+    nodes = build_nodes(spec,inputfiles)
+    scripts = [node['input'].with_suffix(suffix) for node in nodes]
+
+    if not do_overwrite:
+        placeholders = [n['input'] for n in nodes if n['parent'] is not None]
+        existing = [f for f in placeholders+scripts+[workflow_file,script_file]
+                    if f.exists()]
+        if existing:
+            existing = '\n'.join(map(str,existing))
+            raise FileExistsError("The following files would be overwritten, "
+                                  "to do so enable the --overwrite flag:\n"
+                                  f"{existing}")
+
+    templates = node_templates(spec,nodes)
+    for i,(node,template,script) in enumerate(zip(nodes,templates,scripts)):
+        if node['parent'] is not None:
+            parent = nodes[node['parent']]
+            with open(node['input'],'w') as F:
+                F.write(PLACEHOLDER.format(stage=node['stage'],
+                                           parent=parent['output'].name))
+        text = str(template)
+        if node['children']:
+            text += hook_text(hook,workflow_file,i,script.parent)
+        with open(script,'w') as F:
+            F.write(text)
+
+    rootdir = workflow_file.parent
+    state = dict(stages=spec['stages'],
+                 nodes=[dict(stage=n['stage'],
+                             input=os.path.relpath(n['input'].resolve(),rootdir.resolve()),
+                             output=os.path.relpath(n['output'].resolve(),rootdir.resolve()),
+                             parent=n['parent'],
+                             children=n['children']) for n in nodes])
+    atomic_write(workflow_file,json.dumps(state,indent=1))
+    with open(script_file,'w') as F:
+        F.write(submit_script(nodes,scripts,rootdir))
+
+    counts = dict()
+    for node in nodes:
+        counts[node['stage']] = counts.get(node['stage'],0) + 1
+    for stage_name in stage_order(spec):
+        print(f'    {stage_name}: {counts.get(stage_name,0)} calculations')
+    print(f'Workflow stored at {workflow_file}. Submit it with: bash {script_file}')
+def _main_materialize(workflow_file:Path,index:int):
+    for newfile in materialize(workflow_file,index):
+        print(f'Created {newfile}')
+
+def main(workflow_mode:str|None=None,
+         **kwargs):
+    match workflow_mode:
+        case 'generate':
+            _main_generate(**kwargs)
+        case 'materialize':
+            _main_materialize(**kwargs)
+        case _:
+            parser.print_help()
@@ -2,22 +2,29 @@
 
 """
 Generates an xyz file from the provided gaussian files. For output files, it 
-extracts the last geometry (unless --step is specified). This util is meant 
-for quick inspections of gaussian outputs using other GUI tools such as jmol. 
+extracts the last geometry (unless --step is specified) or all of them as a
+trajectory (--trajectory). This util is meant for quick inspections of 
+gaussian outputs using other GUI tools such as jmol. 
 """
 
 from pathlib import Path
+import time
 import argparse
 
 from pyssian import GaussianOutFile, GaussianInFile
 from pyssian.classutils import Geometry
+from pyssian.chemistryutils import PeriodicTable
 
 from .initialize import load_app_defaults
+from .utils import run_in_pool
+from .trajectory import STORE_SUFFIX, TrajectoryWriter
 
 DEFAULTS = load_app_defaults()
 GAUSSIAN_IN_SUFFIXES = DEFAULTS['common']['gaussian_in_suffixes'][1:-1].split(',')
 GAUSSIAN_OUT_SUFFIXES = DEFAULTS['common']['gaussian_out_suffixes'][1:-1].split(',')
 DEFAULT_OUTFILE = Path(DEFAULTS['toxyz']['outfile'])
+DEFAULT_JOBS = DEFAULTS['common'].getint('jobs')
+FORMATS = ('xyz','extxyz','npy')
 # Utility Functions
 def select_input_files(files,is_listfile=False): 
     if is_listfile:
@@ -51,6 +58,140 @@ def extract_geom(filepath,step=None):
     if suffix == '.xyz': 
         return Geometry.from_xyz(filepath)
     raise NotImplementedError(f'files with suffix "{suffix}" cannot be interpreted')
+def read_trajectory(filepath,
+                    unique:bool=True,
+                    first_job:bool=False) -> list[tuple[Geometry,float|None]]:
+    """
+    Reads in a single pass all the geometries of a gaussian output file with 
+    the energy computed for each of them (None if the output ends before it).
+    Consecutive repeated geometries, such as the one of a frequency 
+    calculation after an optimization, are only included once unless unique 
+    is False. With first_job only the first job is read. Input and xyz files
+    are read as a single frame without energy.
+    """
+    suffix = Path(filepath).suffix
+    if suffix not in GAUSSIAN_OUT_SUFFIXES:
+        return [(extract_geom(filepath),None),]
+    with GaussianOutFile(filepath,[1,202,502,508]) as GOF:
+        GOF.read()
+    jobs = GOF.InternalJobs[:1] if first_job else GOF.InternalJobs
+    frames = []
+    for job in jobs:
+        for link in job.Links:
+            if link.number == 202:
+                geom = Geometry.from_L202(link)
+                if unique and frames and frames[-1][0].coordinates == geom.coordinates:
+                    continue
+                frames.append([geom,None])
+            elif link.number == 502 and frames and frames[-1][1] is None:
+                frames[-1][1] = link.energy
+            elif link.number == 508 and frames and link.energy is not None:
+                frames[-1][1] = link.energy
+    return [tuple(frame) for frame in frames]
+def subsample(n:int,stride:int=1,max_frames:int|None=None) -> list[int]:
+    """
+    Indices of the frames kept out of n, taking one every 'stride' frames and 
+    then at most max_frames evenly spaced. The last frame is always kept.
+    """
+    if n == 0:
+        return []
+    indices = list(range(0,n,stride))
+    if indices[-1] != n-1:
+        indices.append(n-1)
+    if max_frames is not None and len(indices) > max_frames:
+        if max_frames == 1:
+            return [n-1,]
+        step = (len(indices)-1)/(max_frames-1)
+        indices = [indices[round(i*step)] for i in range(max_frames)]
+    return indices
+def frame_title(name:str,frame:int|None,energy:float|None,fmt:str='xyz') -> str:
+    if fmt == 'extxyz':
+        title = f'Properties=species:S:1:pos:R:3 source={name}'
+        if frame is not None:
+            title += f' frame={frame}'
+        if energy is not None:
+            title += f' energy={energy:.8f}'
+        return title
+    if energy is None:
+        return f'{name} frame {frame}'
+    return f'{name} frame {frame} E= {energy:.8f}'
+def selected_frames(filepath,
+                    stride:int=1,
+                    max_frames:int|None=None,
+                    step:int|None=None) -> list[tuple[int,Geometry,float|None]]:
+    """
+    Frame number (first = 1), geometry and energy of the frames of a file 
+    kept after subsampling or, if step is provided, only of that frame. Steps
+    are counted as in extract_geom, over all the geometries of the first job.
+    """
+    if step is not None and Path(filepath).suffix in GAUSSIAN_OUT_SUFFIXES:
+        frames = read_trajectory(filepath,unique=False,first_job=True)
+        return [(step,*frames[step-1]),]
+    frames = read_trajectory(filepath)
+    if step is not None:
+        indices = [0,]
+    else:
+        indices = subsample(len(frames),stride,max_frames)
+    return [(i+1,*frames[i]) for i in indices]
+def trajectory_block(filepath,
+                     stride:int=1,
+                     max_frames:int|None=None,
+                     fmt:str='xyz') -> str:
+    """
+    Multi-frame xyz text of all the geometries of a file with the energy of
+    each frame in its comment line.
+    """
+    name = Path(filepath).stem
+    blocks = []
+    for frame,geom,energy in selected_frames(filepath,stride,max_frames):
+        blocks.append(geom.to_xyz(title=frame_title(name,frame,energy,fmt)))
+    return ''.join(blocks)
+def trajectory_arrays(filepath,
+                      stride:int=1,
+                      max_frames:int|None=None,
+                      step:int|None=None,
+                      last:bool=False) -> list[tuple[list[int],list,float|None,int]]:
+    """
+    Atomic numbers, coordinates, energy and frame number of the frames of a 
+    file, to be stored in a trajectory store. If last is True only the last
+    frame is kept.
+    """
+    frames = selected_frames(filepath,stride,max_frames,step)
+    if last:
+        frames = frames[-1:]
+    arrays = []
+    for frame,geom,energy in frames:
+        numbers = [PeriodicTable[atom.split('(')[0].split('-')[0].capitalize()] 
+                   for atom in geom.atoms]
+        arrays.append((numbers,geom.coordinates,energy,frame))
+    return arrays
+def xyz_block(filepath,step=None,fmt:str='xyz') -> str:
+    """
+    xyz text of the geometry of a file titled with the file stem.
+    """
+    geom = extract_geom(filepath, step=step)
+    if fmt == 'extxyz':
+        return geom.to_xyz(title=frame_title(Path(filepath).stem,step,None,fmt))
+    return geom.to_xyz(title=f'{Path(filepath).stem}')
+
+class ProgressReport(object):
+    """
+    Displays the number of processed files and the throughput at most once
+    every 'interval' seconds.
+    """
+    def __init__(self,total:int,interval:float=1.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+    def update(self,n:int=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last >= self.interval or self.done == self.total:
+            self.last = now
+            rate = self.done/max(now-self.start,1e-9)
+            print(f'{self.done}/{self.total} files ({rate:.1f} files/s)',flush=True)
 
 # Parser and main definition
 parser = argparse.ArgumentParser(description=__doc__)
@@ -66,28 +207,99 @@ parser.add_argument('-o','--outfile',
                     default=DEFAULT_OUTFILE,
                     help="Name of the xyz file with all the provided "
                     "geometries sorted by filename")
-parser.add_argument('--step',
+group = parser.add_mutually_exclusive_group()
+group.add_argument('--step',
                     default=None, type=int,
                     help="Will attempt to access the ith optimization step of "
                     "a gaussian output file to extract its geometry on all files "
                     "provided. 'initial geometry'='1'")
+group.add_argument('--trajectory',
+                    action='store_true',default=False,
+                    help="Extract all the geometries of each output file as "
+                    "frames, with their energy in the comment line")
+parser.add_argument('--stride',
+                    type=int,default=1,
+                    help="With --trajectory, keep one every n frames (the "
+                    "last one is always kept)")
+parser.add_argument('--max-frames',
+                    dest='max_frames',
+                    type=int,default=None,
+                    help="With --trajectory, keep at most n evenly spaced "
+                    "frames per file")
+parser.add_argument('--format',
+                    dest='fmt',
+                    choices=FORMATS,default=FORMATS[0],
+                    help="Format of the comment line of each frame. 'extxyz' "
+                    "writes the energy and frame as key=value pairs. 'npy' "
+                    "writes a binary trajectory store (a folder, by default "
+                    f"named as the outfile with suffix '{STORE_SUFFIX}') that "
+                    "can be read without parsing any text, by default "
+                    f"{FORMATS[0]}")
+parser.add_argument('-j','--jobs',
+                    type=int,default=DEFAULT_JOBS,
+                    help="Number of parallel processes used to read the "
+                    f"files, by default {DEFAULT_JOBS}")
+parser.add_argument('--progress',
+                    action='store_true',default=False,
+                    help="Periodically display the number of processed files "
+                    "and the throughput")
 
 def main(files:list[str|Path],
          outfile:Path=DEFAULT_OUTFILE,
          is_listfile:bool=False,
-         step:int|None=None
+         step:int|None=None,
+         trajectory:bool=False,
+         stride:int=1,
+         max_frames:int|None=None,
+         fmt:str=FORMATS[0],
+         jobs:int=DEFAULT_JOBS,
+         progress:bool=False,
          ):
 
+    if stride < 1 or (max_frames is not None and max_frames < 1):
+        raise ValueError('--stride and --max-frames must be positive')
+
     inputfiles = select_input_files(files,is_listfile)
 
-    xyz = []
-    for ifile in inputfiles:
-        print(ifile)
-        infilepath = Path(ifile)
-        stem = infilepath.stem
-        title = f'{stem}'
-        geom = extract_geom(infilepath, step=step)
-        xyz.append(geom.to_xyz(title=title))
+    # Blocks are written as soon as they and all the previous ones are ready,
+    # run_in_pool bounds how many finished blocks wait to be written
+    if fmt == 'npy':
+        function = trajectory_arrays
+        tasks = ((ifile,stride,max_frames,step,not trajectory and step is None) 
+                 for ifile in inputfiles)
+    elif trajectory:
+        function = trajectory_block
+        tasks = ((ifile,stride,max_frames,fmt) for ifile in inputfiles)
+    else:
+        function = xyz_block
+        tasks = ((ifile,step,fmt) for ifile in inputfiles)
+    report = ProgressReport(len(inputfiles)) if progress else None
+    errors = []
+    if fmt == 'npy':
+        outfile = Path(outfile).with_suffix(STORE_SUFFIX)
+        writer = TrajectoryWriter(outfile)
+    else:
+        writer = open(outfile,'w')
+    with writer:
+        for ifile,(block,error) in zip(inputfiles,run_in_pool(function,tasks,jobs)):
+            if error is not None:
+                print(f'Error reading {ifile}: {error}')
+                errors.append(ifile)
+            elif fmt == 'npy':
+                mismatch = writer.mismatch(numbers for numbers,_,_,_ in block)
+                if mismatch is not None:
+                    print(f'Skipping {ifile}: {mismatch}')
+                    errors.append(ifile)
+                else:
+                    source = writer.add_source(ifile)
+                    for numbers,coordinates,energy,frame in block:
+                        writer.add_frame(numbers,coordinates,energy,source,frame)
+            else:
+                writer.write(block)
+            if report is not None:
+                report.update()
 
-    with open(outfile,'w') as F:
-        F.write(''.join(xyz))
+    if fmt == 'npy':
+        print(f'{len(writer)} frames written to {outfile}')
+    if errors:
+        raise RuntimeError(f'{len(errors)} files could not be processed')
@@ -0,0 +1,170 @@
+"""
+Binary storage of geometry trajectories. A trajectory store is a folder with
+one .npy file per array, so that each of them can be opened as a read-only
+memory map and accessing a single frame does not require reading the whole
+file:
+
+- coordinates.npy: (n_frames, n_atoms, 3) cartesian coordinates in Angstrom
+- atomic_numbers.npy: (n_atoms,) atomic numbers
+- energies.npy: (n_frames,) energy of each frame, nan if unknown
+- source_index.npy: (n_frames,) index of the file each frame comes from
+- frame_index.npy: (n_frames,) number of the frame in its file (first = 1)
+- sources.json: names of the files the frames come from
+"""
+import json
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+STORE_SUFFIX = '.traj'
+ARRAYS = ('coordinates','atomic_numbers','energies','source_index','frame_index')
+
+def is_store(path:str|Path) -> bool:
+    """
+    True if the path is a trajectory store folder.
+    """
+    path = Path(path)
+    return path.is_dir() and (path/'coordinates.npy').exists()
+
+class TrajectoryWriter(object):
+    """
+    Writes a trajectory store frame by frame without keeping the frames in
+    memory. The coordinates are streamed to a temporary file and the .npy
+    files are assembled when the writer is closed.
+
+    Parameters
+    ----------
+    path : str | Path
+        folder of the trajectory store, it is created if it does not exist and
+        removed if the writer exits with an error before closing it
+    """
+    def __init__(self,path:str|Path):
+        self.path = Path(path)
+        self._created = not self.path.exists()
+        self.path.mkdir(parents=True,exist_ok=True)
+        self.atomic_numbers:np.ndarray|None = None
+        self.energies:list[float] = []
+        self.source_index:list[int] = []
+        self.frame_index:list[int] = []
+        self.sources:list[str] = []
+        self._raw = tempfile.TemporaryFile(dir=self.path)
+    def __enter__(self):
+        return self
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self._raw.close()
+        if self._created:
+            try:
+                self.path.rmdir()
+            except OSError:
+                pass
+    def __len__(self):
+        return len(self.energies)
+
+    def add_source(self,name:str) -> int:
+        """
+        Registers a new source file and returns its index.
+        """
+        self.sources.append(str(name))
+        return len(self.sources)-1
+
+    def mismatch(self,atomic_numbers:Iterable[list[int]]) -> str|None:
+        """
+        Checks the atoms of a set of frames before adding them. Returns why
+        they can not be added to the store or None if they can.
+        """
+        reference = self.atomic_numbers
+        for i,numbers in enumerate(atomic_numbers,1):
+            numbers = np.asarray(numbers,dtype=np.int32)
+            if reference is None:
+                reference = numbers
+            elif not np.array_equal(reference,numbers):
+                return (f'the atoms of frame {i} do not match the ones of the '
+                        'previous frames')
+        return None
+
+    def add_frame(self,
+                  atomic_numbers:list[int],
+                  coordinates:list[tuple[float,float,float]],
+                  energy:float|None,
+                  source:int,
+                  frame:int):
+        """
+        Appends a frame. All the frames must have the same atoms in the same
+        order.
+        """
+        atomic_numbers = np.asarray(atomic_numbers,dtype=np.int32)
+        if self.atomic_numbers is None:
+            self.atomic_numbers = atomic_numbers
+        elif not np.array_equal(self.atomic_numbers,atomic_numbers):
+            raise ValueError(f"The atoms of frame {frame} of '{self.sources[source]}' "
+                             "do not match the ones of the previous frames")
+        xyz = np.asarray(coordinates,dtype=np.float64)
+        if xyz.shape != (atomic_numbers.shape[0],3):
+            raise ValueError(f'Unexpected shape of the coordinates {xyz.shape}')
+        self._raw.write(xyz.tobytes())
+        self.energies.append(np.nan if energy is None else energy)
+        self.source_index.append(source)
+        self.frame_index.append(frame)
+
+    def close(self):
+        n_atoms = 0 if self.atomic_numbers is None else self.atomic_numbers.shape[0]
+        shape = (len(self),n_atoms,3)
+        self._raw.seek(0)
+        with open(self.path/'coordinates.npy','wb') as F:
+            header = dict(descr=np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+                          fortran_order=False,shape=shape)
+            np.lib.format.write_array_header_1_0(F,header)
+            shutil.copyfileobj(self._raw,F)
+        self._raw.close()
+        if self.atomic_numbers is None:
+            self.atomic_numbers = np.zeros(0,dtype=np.int32)
+        np.save(self.path/'atomic_numbers.npy',self.atomic_numbers)
+        np.save(self.path/'energies.npy',np.array(self.energies,dtype=np.float64))
+        np.save(self.path/'source_index.npy',np.array(self.source_index,dtype=np.int32))
+        np.save(self.path/'frame_index.npy',np.array(self.frame_index,dtype=np.int32))
+        with open(self.path/'sources.json','w') as F:
+            json.dump(self.sources,F,indent=1)
+
+class Trajectory(object):
+    """
+    Read-only view of a trajectory store. The arrays are memory mapped, so
+    indexing a frame only reads that frame from disk.
+
+    Parameters
+    ----------
+    path : str | Path
+        folder of the trajectory store
+    """
+    def __init__(self,path:str|Path):
+        self.path = Path(path)
+        if not is_store(self.path):
+            raise FileNotFoundError(f'{self.path} is not a trajectory store')
+        for name in ARRAYS:
+            setattr(self,name,np.load(self.path/f'{name}.npy',mmap_mode='r'))
+        with open(self.path/'sources.json','r') as F:
+            self.sources:list[str] = json.load(F)
+    def __repr__(self):
+        return f'<{type(self).__name__}({self.path}) frames={len(self)}>'
+    def __len__(self):
+        return self.coordinates.shape[0]
+    def __getitem__(self,k):
+        return self.coordinates[k]
+
+    def frames_of(self,source:str|int) -> np.ndarray:
+        """
+        Indices of the frames that come from a source, given by its index or
+        by its name (with or without suffix).
+        """
+        if isinstance(source,str):
+            matches = [i for i,name in enumerate(self.sources)
+                       if name == source or Path(name).stem == source]
+            if not matches:
+                raise KeyError(f"'{source}' is not a source of {self.path}")
+            source = matches[0]
+        return np.flatnonzero(np.asarray(self.source_index) == source)
@@ -4,12 +4,18 @@ well as the basic variables for registering the subparsers and main functions
 """
 import os
 import re
+import stat
 import argparse
+import tempfile
+import functools
+import itertools
+import collections
+import concurrent.futures
 from pathlib import Path
 from ._version import __version__
-from pyssian.gaussianclasses import GaussianOutFile
+from pyssian.gaussianclasses import GaussianOutFile, GaussianInFile
 
-from typing import Callable
+from typing import Callable, Iterable, Iterator, Any
 
 # Core functions/Gobals for pyssianutils command line inner workings
 MAINS = dict()
@@ -244,6 +250,130 @@ def write_2_file(filepath:Path) -> Callable[[str],None]:
             F.write('\n')
     return Writer
 
+def _current_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+def atomic_write(filepath:str|Path,txt:str):
+    """
+    Writes the text to a temporary file in the same directory as filepath and
+    then renames it to filepath, so that an interrupted process never leaves a
+    partially written file behind. The file keeps the permissions of the file
+    it replaces or, for new files, the ones given by the umask.
+
+    Parameters
+    ----------
+    filepath : str | Path
+        final location of the file.
+    txt : str
+        full contents of the file.
+    """
+    filepath = Path(filepath)
+    fd,tmppath = tempfile.mkstemp(dir=filepath.parent,
+                                  prefix=f'.{filepath.name}.',
+                                  suffix='.tmp')
+    try:
+        with os.fdopen(fd,'w') as F:
+            F.write(txt)
+        # mkstemp creates the file only readable by the owner
+        if filepath.exists():
+            mode = stat.S_IMODE(os.stat(filepath).st_mode)
+        else:
+            mode = 0o666 & ~_current_umask()
+        os.chmod(tmppath,mode)
+        os.replace(tmppath,filepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+def _call_and_capture(args:tuple[Callable,tuple]) -> tuple[Any,str|None]:
+    function,task = args
+    try:
+        result = function(*task)
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+    return result, None
+def run_in_pool(function:Callable,
+                tasks:Iterable[tuple],
+                jobs:int=1,
+                window:int|None=None) -> Iterator[tuple[Any,str|None]]:
+    """
+    Applies the function to each of the tasks, using a pool of processes if
+    jobs > 1. Results are yielded in the same order as the tasks were 
+    provided regardless of the order in which they finish. Exceptions raised 
+    by the function do not stop the remaining tasks, instead they are 
+    captured and yielded as text.
+
+    Parameters
+    ----------
+    function : Callable
+        module-level function (it has to be picklable) 
+    tasks : Iterable[tuple]
+        positional arguments of each call to the function
+    jobs : int, optional
+        number of worker processes, by default 1 (no pool is used)
+    window : int | None, optional
+        max number of tasks submitted but not yet yielded, which bounds the 
+        memory used by results that finished before earlier tasks, by default
+        4*jobs
+
+    Yields
+    ------
+    tuple[Any,str|None]
+        result of the function (None if it failed) and the error message (None
+        if it succeeded)
+    """
+    tasks = iter((function,task) for task in tasks)
+    if jobs <= 1:
+        for task in tasks:
+            yield _call_and_capture(task)
+        return
+    if window is None:
+        window = 4*jobs
+    window = max(window,jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for task in itertools.islice(tasks,window):
+            pending.append(executor.submit(_call_and_capture,task))
+        while pending:
+            result = pending.popleft().result()
+            for task in itertools.islice(tasks,1):
+                pending.append(executor.submit(_call_and_capture,task))
+            yield result
+
+def read_tail(filepath:str|Path,size:int=4096) -> str:
+    """
+    Reads only the last bytes of a file.
+
+    Parameters
+    ----------
+    filepath : str | Path
+        file to read
+    size : int, optional
+        max number of bytes read, by default 4096
+
+    Returns
+    -------
+    str
+        decoded text of the end of the file (decoding errors are replaced)
+    """
+    with open(filepath,'rb') as F:
+        F.seek(0,os.SEEK_END)
+        end = F.tell()
+        F.seek(max(0,end-size))
+        data = F.read()
+    return data.decode('utf-8',errors='replace')
+def has_normal_termination(filepath:str|Path) -> bool:
+    """
+    Checks whether a gaussian output file finished with a 'Normal termination'
+    reading only the end of the file.
+    """
+    filepath = Path(filepath)
+    if not filepath.exists():
+        return False
+    lines = [line for line in read_tail(filepath).splitlines() if line.strip()]
+    return bool(lines) and 'Normal termination' in lines[-1]
+
 # GaussianOutFile utils
 def thermochemistry(GOF:GaussianOutFile) -> tuple[float|None,float|None,float|None]:
     """
@@ -374,6 +504,283 @@ def potential_energies(GOF:GaussianOutFile,method:str='default',withscf:bool=Fal
                     energies.append(energy)
     return energies
 
+# Gaussian output statistics
+TIME_PATTERN = re.compile(r'(Job cpu time|Elapsed time):\s*([0-9]+)\s*days\s*([0-9]+)\s*hours\s*([0-9]+)\s*minutes\s*([0-9.]+)\s*seconds')
+NBASIS_PATTERN = re.compile(r'^\s*([0-9]+)\s+basis functions,|NBasis=\s*([0-9]+)')
+NATOMS_PATTERN = re.compile(r'NAtoms=\s*([0-9]+)')
+JOBTYPES = ('opt','freq','irc','scan','td','nmr','stable')
+def parse_route(route:str) -> tuple[str|None,str|None,str]:
+    """
+    Extracts the method, basis and job type from a gaussian route section.
+    The job type is the '+' joined job keywords found (e.g. 'opt+freq') or 
+    'sp' if none is found.
+    """
+    method, basis = None, None
+    jobtypes = set()
+    for token in route.lower().split():
+        token = token.lstrip('#').strip()
+        if not token or token in ('p','n','t'):
+            continue
+        keyword = re.split(r'[=(]',token)[0]
+        if keyword in JOBTYPES:
+            jobtypes.add(keyword)
+        elif '/' in token and method is None and '=' not in token.split('/')[0]:
+            method, basis = token.split('/',1)
+    jobtype = '+'.join(k for k in JOBTYPES if k in jobtypes) or 'sp'
+    return method, basis, jobtype
+def join_route_lines(lines:list[str],width:int|None=None) -> str:
+    """
+    Rebuilds the route section echoed in a gaussian output. Gaussian wraps it
+    at a fixed column, the length of the dashed lines around it, regardless
+    of where the keywords end. The lines are joined without spaces except 
+    after the lines shorter than said column, which lost a trailing space.
+    """
+    chunks = [line.rstrip('\n') for line in lines]
+    chunks = [chunk[1:] if chunk.startswith(' ') else chunk for chunk in chunks]
+    route = ''
+    for i,chunk in enumerate(chunks):
+        route += chunk.rstrip()
+        if width is not None and i < len(chunks)-1 and len(chunk.rstrip()) < width:
+            route += ' '
+    return route.strip()
+def harvest_output(filepath:str|Path) -> dict|None:
+    """
+    Extracts in a single pass through the text of a gaussian output file the
+    information relevant to estimate its computational cost. 
+
+    Parameters
+    ----------
+    filepath : str | Path
+        gaussian output file
+
+    Returns
+    -------
+    dict|None
+        None if the file has no Link 0 nor route section. Otherwise a dict with
+        the keys: 'file', 'nprocs', 'mem' (MB), 'route', 'method', 'basis', 
+        'jobtype', 'natoms', 'nbasis', 'cpu_time' and 'elapsed' (seconds, 
+        summed over all the internal jobs, None if not found) and 'normal' 
+        (True if it finished with a normal termination).
+    """
+    link0 = dict()
+    route, width = [], None
+    in_route, route_done = False, False
+    natoms, nbasis = None, None
+    times = {'Job cpu time':None,'Elapsed time':None}
+    last = ''
+    with open(filepath,'r',errors='replace') as F:
+        for line in F:
+            if line.strip():
+                last = line
+            if not route_done:
+                match = LINK0_PATTERN.match(line)
+                if match is not None:
+                    link0[match.group(1).lower()] = match.group(2)
+                    continue
+                if line.startswith(' #'):
+                    in_route = True
+                if in_route and line.startswith(' -'):
+                    in_route, route_done = False, True
+                    width = len(line.strip())
+                elif in_route:
+                    route.append(line)
+                continue
+            if natoms is None and 'NAtoms=' in line:
+                natoms = int(NATOMS_PATTERN.search(line).group(1))
+            if nbasis is None and ('basis functions,' in line or 'NBasis=' in line):
+                match = NBASIS_PATTERN.search(line)
+                if match is not None:
+                    nbasis = int(match.group(1) or match.group(2))
+            if 'time:' in line:
+                match = TIME_PATTERN.search(line)
+                if match is not None:
+                    key = match.group(1)
+                    days,hours,minutes = map(int,match.groups()[1:4])
+                    seconds = ((days*24 + hours)*60 + minutes)*60 + float(match.group(5))
+                    times[key] = (times[key] or 0.0) + seconds
+    if not route:
+        return None
+    route = join_route_lines(route,width)
+    method, basis, jobtype = parse_route(route)
+    nprocs = link0.get('nprocshared',link0.get('nproc',None))
+    return dict(file=str(filepath),
+                nprocs=int(nprocs) if nprocs is not None else 1,
+                mem=mem_to_mb(link0.get('mem',None)),
+                route=route,
+                method=method,
+                basis=basis,
+                jobtype=jobtype,
+                natoms=natoms,
+                nbasis=nbasis,
+                cpu_time=times['Job cpu time'],
+                elapsed=times['Elapsed time'],
+                normal='Normal termination' in last)
+
+# GaussianInFile utils
+def clone_gaussian_input(GIF:GaussianInFile) -> GaussianInFile:
+    """
+    Creates an independent copy of a previously read GaussianInFile without
+    re-reading the file. Only the containers that are modified in-place by the
+    GaussianInFile methods (preprocessing, commandline and tail) are copied,
+    the remaining attributes are immutable and thus shared.
+
+    Parameters
+    ----------
+    GIF : GaussianInFile
+        Gaussian Input File instance. (It assumes that previously the .read()
+        method has been used)
+
+    Returns
+    -------
+    GaussianInFile
+        new instance not linked to any file, whose modifications do not affect
+        the original one.
+    """
+    new = GaussianInFile()
+    new.preprocessing = dict(GIF.preprocessing)
+    new.commandline = {k:(list(v) if isinstance(v,list) else v)
+                       for k,v in GIF.commandline.items()}
+    new.tail = list(GIF.tail)
+    new.title = GIF.title
+    new._method = GIF._method
+    new._basis = GIF._basis
+    new.spin = GIF.spin
+    new.charge = GIF.charge
+    new.geometry = GIF.geometry
+    new.extra_printout = GIF.extra_printout
+    new.structure = GIF.structure
+    return new
+
+@functools.lru_cache(maxsize=64)
+def _read_gaussian_input(filepath:str,mtime_ns:int) -> GaussianInFile:
+    # mtime_ns is only used as part of the cache key
+    with GaussianInFile(filepath) as GIF:
+        GIF.read()
+    return GIF
+def read_gaussian_input(filepath:str|Path) -> GaussianInFile:
+    """
+    Reads a gaussian input file, keeping the parsed file in memory so that 
+    subsequent calls with the same unmodified file do not read it again. The 
+    files are identified by their resolved path and modification time, and up
+    to 64 of them are kept.
+
+    Parameters
+    ----------
+    filepath : str | Path
+        Gaussian input file. 
+
+    Returns
+    -------
+    GaussianInFile
+        an independent copy of the parsed file (see clone_gaussian_input) that
+        can be modified freely.
+    """
+    filepath = Path(filepath).resolve()
+    GIF = _read_gaussian_input(str(filepath),filepath.stat().st_mtime_ns)
+    return clone_gaussian_input(GIF)
+
+# Gaussian input header utils
+LINK0_PATTERN = re.compile(r'^\s*%\s*([A-Za-z0-9]+)\s*=\s*(\S+)')
+MEMORY_PATTERN = re.compile(r'^([0-9]+)\s*([KMGT]?)([BW]?)$',re.IGNORECASE)
+def mem_to_mb(mem:str|None) -> int|None:
+    """
+    Converts a gaussian memory specification (e.g. '8GB', '500MW', '2000MB') 
+    to MB. Words are considered of 8 bytes and values without units are 
+    considered as words, as gaussian does.
+
+    Parameters
+    ----------
+    mem : str | None
+        memory specification
+
+    Returns
+    -------
+    int | None
+        memory in MB. None if mem is None or could not be interpreted.
+    """
+    if mem is None:
+        return None
+    match = MEMORY_PATTERN.match(mem.strip())
+    if match is None:
+        return None
+    value,prefix,unit = match.groups()
+    exponent = {'':-2,'K':-1,'M':0,'G':1,'T':2}[prefix.upper()]
+    memory = int(value)*1024**exponent
+    if unit.upper() in ('W',''):
+        memory = memory*8
+    return int(memory)
+
+class InputHeader(object):
+    """
+    Link 0 commands and route section of a gaussian input file.
+
+    Parameters
+    ----------
+    link0 : dict[str,str]
+        Link 0 commands (without the '%') with their values, keys lowercased.
+    route : str
+        route section as a single line.
+    text : str
+        lines of the file from the beginning to the end of the route section
+    """
+    def __init__(self,link0:dict[str,str],route:str,text:str):
+        self.link0 = link0
+        self.route = route
+        self.text = text
+    def __repr__(self):
+        return f'<{type(self).__name__}({self.route})>'
+    @property
+    def nprocs(self) -> int|None:
+        value = self.link0.get('nprocshared',self.link0.get('nproc',None))
+        if value is None:
+            return None
+        return int(value)
+    @property
+    def mem(self) -> str|None:
+        return self.link0.get('mem',None)
+    @property
+    def memory_mb(self) -> int|None:
+        return mem_to_mb(self.mem)
+
+@functools.lru_cache(maxsize=None)
+def _read_input_header(filepath:str,mtime_ns:int) -> InputHeader:
+    # mtime_ns is only used as part of the cache key
+    link0 = dict()
+    route = []
+    lines = []
+    with open(filepath,'r') as F:
+        for line in F:
+            lines.append(line)
+            stripped = line.strip()
+            if route and not stripped:
+                break
+            elif route or stripped.startswith('#'):
+                route.append(stripped)
+                continue
+            match = LINK0_PATTERN.match(line)
+            if match is not None:
+                key,value = match.groups()
+                link0[key.lower()] = value
+    return InputHeader(link0,' '.join(route),''.join(lines))
+def read_input_header(filepath:str|Path) -> InputHeader:
+    """
+    Reads only the Link 0 commands and route section of a gaussian input file,
+    stopping at the first blank line after the route section. The results are
+    kept in memory and identified by the resolved path and modification time
+    of the file so that repeated calls do not read the file again.
+
+    Parameters
+    ----------
+    filepath : str | Path
+        Gaussian input file.
+
+    Returns
+    -------
+    InputHeader
+    """
+    filepath = Path(filepath).resolve()
+    return _read_input_header(str(filepath),filepath.stat().st_mtime_ns)
+
 # Console Utils
 def print_convergence(GOF:GaussianOutFile,JobId:int,Last:bool=False):
     """